@@ -1,12 +1,13 @@
 import os
 from django.core.asgi import get_asgi_application
 from channels.routing import ProtocolTypeRouter, URLRouter
-from chat.middleware import JWTAuthMiddleware
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'ChatApp.settings')
 
+# Sets up Django; modules that import models must be imported after this
 django_asgi_app = get_asgi_application()
 
+from chat.middleware import JWTAuthMiddleware
 from chat.routing import websocket_urlpatterns as chat_patterns
 from calls.routing import websocket_urlpatterns as calls_patterns
 
@@ -0,0 +1,127 @@
+import json
+import logging
+import logging.config
+import queue
+import random
+from logging.handlers import QueueHandler, QueueListener
+
+
+class _Listener(QueueListener):
+    def enqueue_sentinel(self):
+        # Block rather than fail when the queue is full; the thread is draining it
+        self.queue.put(self._sentinel)
+
+
+class QueueLogHandler(QueueHandler):
+    """
+    Puts records on a bounded in-memory queue; a QueueListener thread hands them
+    to the real handlers, so file and console I/O never runs on the event loop.
+
+    `handlers` are names of other handlers from the same LOGGING dict;
+    configure_logging() starts the listener on them once they are built.
+    Records logged before that wait in the queue. When the queue is full
+    records are dropped and counted instead of blocking the caller.
+    """
+
+    def __init__(self, handlers=(), maxsize=10000):
+        super().__init__(queue.Queue(maxsize))
+        self.dropped = 0
+        self.target_names = list(handlers)
+        self.listener = None
+
+    def start(self, targets):
+        """Start the listener thread that writes queued records to targets"""
+        self.listener = _Listener(self.queue, *targets, respect_handler_level=True)
+        self.listener.start()
+
+    def stop(self):
+        """Write out everything queued and stop the listener thread"""
+        if self.listener is not None:
+            listener, self.listener = self.listener, None
+            listener.stop()
+
+    def close(self):
+        # Called by logging.shutdown() at interpreter exit
+        self.stop()
+        super().close()
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def prepare(self, record):
+        # Only merge the arguments here; timestamps and layout are formatted by
+        # the target handlers on the listener thread
+        record = logging.makeLogRecord(record.__dict__)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+def configure_logging(config):
+    """
+    LOGGING_CONFIG callable: dictConfig, then start every QueueLogHandler's
+    listener on the handlers its `handlers` names refer to.
+    """
+    configurator = logging.config.dictConfigClass(config)
+    configurator.configure()
+    # After configure() the handlers section maps each name to the built handler
+    built = configurator.config.get('handlers', {})
+    for handler in built.values():
+        if isinstance(handler, QueueLogHandler):
+            missing = [name for name in handler.target_names if name not in built]
+            if missing:
+                raise ValueError(f"Log handlers {missing} are not configured")
+            handler.start([built[name] for name in handler.target_names])
+
+
+def queue_log_handlers():
+    """The QueueLogHandlers attached to the root logger or any named logger"""
+    loggers = [logging.root] + [logger for logger in list(logging.Logger.manager.loggerDict.values())
+                                if isinstance(logger, logging.Logger)]
+    return {handler for logger in loggers for handler in logger.handlers if isinstance(handler, QueueLogHandler)}
+
+
+class EventSamplingFilter(logging.Filter):
+    """Keep only a fraction of the records of high-volume events, per event name"""
+
+    def __init__(self, rates=None):
+        super().__init__()
+        self.rates = rates or {}
+
+    def filter(self, record):
+        rate = self.rates.get(getattr(record, 'event', None))
+        if rate is None or record.levelno >= logging.WARNING:
+            return True
+        return random.random() < rate
+
+
+class JSONFormatter(logging.Formatter):
+    """One JSON object per line with the event name and its fields"""
+
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        event = getattr(record, 'event', None)
+        if event:
+            entry['event'] = event
+            entry.update(getattr(record, 'fields', {}))
+        if record.exc_text:
+            entry['exc'] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+def log_event(logger, event, level=logging.INFO, **fields):
+    """Log a structured event; `event` is the key EventSamplingFilter samples on"""
+    if logger.isEnabledFor(level):
+        message = ' '.join([event] + [f'{key}={value}' for key, value in fields.items()])
+        logger.log(level, message, extra={'event': event, 'fields': fields}, stacklevel=2)
@@ -0,0 +1,450 @@
+"""
+In-process metrics with a Prometheus text endpoint.
+
+Counters, gauges and histograms keep one accumulator per thread, so
+recording is a plain list update with no lock and no contention; a scrape
+sums the per-thread values. Callback metrics read numbers other modules
+already keep (outbound queue stats, dropped log records) only when scraped.
+
+With METRICS['MULTIPROCESS_DIR'] set, every serving process writes a
+snapshot of its metrics to `<dir>/<pid>.json` every WRITE_INTERVAL seconds
+and the endpoint sums the snapshots of all live processes, so any worker can
+answer a scrape for the whole deployment.
+"""
+import functools
+import json
+import logging
+import os
+import threading
+import time
+from bisect import bisect_left
+from pathlib import Path
+from channels.db import database_sync_to_async as channels_database_sync_to_async
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseForbidden
+from django.utils.crypto import constant_time_compare
+from .profiling import sampled_profile
+
+logger = logging.getLogger(__name__)
+
+METRICS_DEFAULTS = {
+    'ENABLED': True,
+    'TOKEN': None,
+    'MULTIPROCESS_DIR': None,
+    'WRITE_INTERVAL': 5,
+}
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def get_metrics_config():
+    config = dict(METRICS_DEFAULTS)
+    config.update(getattr(settings, 'METRICS', {}))
+    return config
+
+
+class _Shards:
+    """`size` numbers accumulated per thread; only the owning thread writes its list"""
+
+    def __init__(self, size):
+        self.size = size
+        self._local = threading.local()
+        self._all = []
+        self._lock = threading.Lock()
+
+    def mine(self):
+        try:
+            return self._local.values
+        except AttributeError:
+            values = [0.0] * self.size
+            with self._lock:
+                self._all.append(values)
+            self._local.values = values
+            return values
+
+    def total(self):
+        with self._lock:
+            shards = list(self._all)
+        return [sum(column) for column in zip(*shards)] if shards else [0.0] * self.size
+
+
+class _CounterChild:
+    __slots__ = ('_shards',)
+
+    def __init__(self, metric):
+        self._shards = _Shards(1)
+
+    def inc(self, amount=1):
+        self._shards.mine()[0] += amount
+
+    def values(self):
+        return self._shards.total()
+
+
+class _GaugeChild:
+    """A single value under a lock; per-thread shards would let set() race with inc() on other threads"""
+    __slots__ = ('_value', '_lock')
+
+    def __init__(self, metric):
+        self._value = 0.0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self._value += amount
+
+    def dec(self, amount=1):
+        with self._lock:
+            self._value -= amount
+
+    def set(self, value):
+        with self._lock:
+            self._value = value
+
+    def values(self):
+        return [self._value]
+
+
+class _HistogramChild:
+    """Slots: one count per bucket plus +Inf, then sum and count"""
+    __slots__ = ('_shards', '_buckets')
+
+    def __init__(self, metric):
+        self._buckets = metric.buckets
+        self._shards = _Shards(len(metric.buckets) + 3)
+
+    def observe(self, value):
+        values = self._shards.mine()
+        values[bisect_left(self._buckets, value)] += 1
+        values[-2] += value
+        values[-1] += 1
+
+    def values(self):
+        return self._shards.total()
+
+    def time(self):
+        return _Timer(self)
+
+
+class _Timer:
+    __slots__ = ('_child', '_start')
+
+    def __init__(self, child):
+        self._child = child
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._child.observe(time.perf_counter() - self._start)
+
+
+class Metric:
+    type = None
+    child_class = None
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._children = {}
+        self._lock = threading.Lock()
+        if not self.labelnames:
+            self._unlabelled = self.labels()
+
+    def labels(self, *values, **labels):
+        """The child for one label combination; keep it around on hot paths"""
+        key = tuple(str(v) for v in values) or tuple(str(labels[name]) for name in self.labelnames)
+        child = self._children.get(key)
+        if child is None:
+            if len(key) != len(self.labelnames):
+                raise ValueError(f'{self.name} takes labels {self.labelnames}')
+            with self._lock:
+                child = self._children.setdefault(key, self.child_class(self))
+        return child
+
+    def samples(self):
+        return [(dict(zip(self.labelnames, key)), child.values()) for key, child in list(self._children.items())]
+
+
+class Counter(Metric):
+    type = 'counter'
+    child_class = _CounterChild
+
+    def inc(self, amount=1):
+        self._unlabelled.inc(amount)
+
+
+class Gauge(Metric):
+    type = 'gauge'
+    child_class = _GaugeChild
+
+    def inc(self, amount=1):
+        self._unlabelled.inc(amount)
+
+    def dec(self, amount=1):
+        self._unlabelled.dec(amount)
+
+    def set(self, value):
+        self._unlabelled.set(value)
+
+
+class Histogram(Metric):
+    type = 'histogram'
+    child_class = _HistogramChild
+
+    def observe(self, value):
+        self._unlabelled.observe(value)
+
+    def time(self):
+        return self._unlabelled.time()
+
+
+class CallbackMetric:
+    """A counter or gauge whose value is read from `function()` at scrape time"""
+
+    def __init__(self, name, documentation, type, function):
+        self.name = name
+        self.documentation = documentation
+        self.type = type
+        self.buckets = ()
+        self.function = function
+
+    def samples(self):
+        try:
+            value = self.function()
+        except Exception as e:
+            logger.error(f"Metric callback {self.name} failed: {e}")
+            return []
+        if value is None:
+            return []
+        if isinstance(value, dict):
+            return [(dict(labels), [float(v)]) for labels, v in value.items()]
+        return [({}, [float(value)])]
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+        self._writer = None
+
+    def _get_or_create(self, cls, name, documentation, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, documentation, **kwargs)
+            elif type(metric) is not cls:
+                raise ValueError(f'Metric {name} is already registered as a {metric.type}')
+            return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._get_or_create(Counter, name, documentation, labelnames=labelnames)
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self._get_or_create(Gauge, name, documentation, labelnames=labelnames)
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._get_or_create(Histogram, name, documentation, labelnames=labelnames, buckets=buckets)
+
+    def callback(self, name, documentation, type, function):
+        """Register (or replace) a metric computed by `function()` when scraped"""
+        with self._lock:
+            self._metrics[name] = CallbackMetric(name, documentation, type, function)
+
+    def snapshot(self):
+        """{name: {type, help, buckets, samples: [[labels, values], ...]}}, JSON serializable"""
+        return {
+            metric.name: {
+                'type': metric.type,
+                'help': metric.documentation,
+                'buckets': list(metric.buckets),
+                'samples': [[labels, values] for labels, values in metric.samples()],
+            }
+            for metric in list(self._metrics.values())
+        }
+
+    def start_writer(self, directory, interval):
+        """Write this process's snapshot to `directory` every `interval` seconds"""
+        if self._writer is not None:
+            return
+        path = Path(directory)
+        path.mkdir(parents=True, exist_ok=True)
+
+        def run():
+            while True:
+                try:
+                    write_snapshot(self.snapshot(), path)
+                except Exception as e:
+                    logger.error(f"Writing metrics snapshot to {path} failed: {e}")
+                time.sleep(interval)
+
+        self._writer = threading.Thread(target=run, name='metrics-writer', daemon=True)
+        self._writer.start()
+
+
+def write_snapshot(snapshot, directory):
+    target = Path(directory) / f'{os.getpid()}.json'
+    temporary = target.with_suffix('.tmp')
+    temporary.write_text(json.dumps(snapshot))
+    temporary.replace(target)
+
+
+def merge_snapshots(snapshots):
+    """Sum the samples of several processes' snapshots label set by label set"""
+    merged = {}
+    for snapshot in snapshots:
+        for name, metric in snapshot.items():
+            target = merged.setdefault(name, dict(metric, samples={}))
+            for labels, values in metric['samples']:
+                key = tuple(sorted(labels.items()))
+                current = target['samples'].get(key)
+                target['samples'][key] = list(values) if current is None else [a + b for a, b in zip(current, values)]
+    for metric in merged.values():
+        metric['samples'] = [[dict(key), values] for key, values in metric['samples'].items()]
+    return merged
+
+
+def collect_multiprocess(registry, directory, interval):
+    """This process's fresh snapshot merged with every other live process's last one"""
+    directory = Path(directory)
+    write_snapshot(registry.snapshot(), directory)
+    stale_before = time.time() - interval * 3
+    snapshots = []
+    for path in directory.glob('*.json'):
+        try:
+            if path.stat().st_mtime < stale_before:
+                # The process has exited; its counters leave with it
+                path.unlink(missing_ok=True)
+                continue
+            snapshots.append(json.loads(path.read_text()))
+        except (OSError, ValueError):
+            continue
+    return merge_snapshots(snapshots)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(labels, extra=None):
+    items = list(labels.items()) + ([extra] if extra else [])
+    if not items:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in items) + '}'
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+def exposition(snapshot):
+    """Render a snapshot in the Prometheus text format"""
+    lines = []
+    for name in sorted(snapshot):
+        metric = snapshot[name]
+        lines.append(f"# HELP {name} {metric['help']}")
+        lines.append(f"# TYPE {name} {metric['type']}")
+        for labels, values in metric['samples']:
+            if metric['type'] != 'histogram':
+                lines.append(f'{name}{_labels(labels)} {_number(values[0])}')
+                continue
+            cumulative = 0
+            for bound, count in zip(list(metric['buckets']) + [float('inf')], values):
+                cumulative += count
+                lines.append(f"{name}_bucket{_labels(labels, ('le', _number(bound)))} {_number(cumulative)}")
+            lines.append(f'{name}_sum{_labels(labels)} {_number(values[-2])}')
+            lines.append(f'{name}_count{_labels(labels)} {_number(values[-1])}')
+    return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+counter = registry.counter
+gauge = registry.gauge
+histogram = registry.histogram
+
+
+def _dropped_log_records():
+    from .log import queue_log_handlers
+    return sum(handler.dropped for handler in queue_log_handlers())
+
+
+registry.callback('log_records_dropped_total', 'Log records dropped because the log queue was full',
+                  'counter', _dropped_log_records)
+
+
+DB_CALL_SECONDS = histogram('db_call_seconds', 'Time spent in database_sync_to_async calls, in the worker thread',
+                            ['call'])
+
+
+def database_sync_to_async(func):
+    """channels' database_sync_to_async that also times the call and samples it for the query profiler"""
+    child = DB_CALL_SECONDS.labels(call=func.__qualname__)
+
+    name = f'db {func.__qualname__}'
+
+    @functools.wraps(func)
+    def timed(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            with sampled_profile(name):
+                return func(*args, **kwargs)
+        finally:
+            child.observe(time.perf_counter() - start)
+
+    return channels_database_sync_to_async(timed)
+
+
+HTTP_REQUESTS = counter('http_requests_total', 'HTTP requests by route, method and status',
+                        ['route', 'method', 'status'])
+HTTP_SECONDS = histogram('http_request_duration_seconds', 'HTTP request latency by route', ['route', 'method'])
+
+
+class MetricsMiddleware:
+    """Counts and times every HTTP request by URL route; put it first in MIDDLEWARE"""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        config = get_metrics_config()
+        if config['ENABLED'] and config['MULTIPROCESS_DIR']:
+            registry.start_writer(config['MULTIPROCESS_DIR'], config['WRITE_INTERVAL'])
+
+    def __call__(self, request):
+        start = time.perf_counter()
+        response = self.get_response(request)
+        match = getattr(request, 'resolver_match', None)
+        route = match.route if match is not None else 'unmatched'
+        HTTP_SECONDS.labels(route, request.method).observe(time.perf_counter() - start)
+        HTTP_REQUESTS.labels(route, request.method, response.status_code).inc()
+        return response
+
+
+def metrics_authorized(request):
+    """The Bearer TOKEN or a staff session; without a TOKEN anyone may read metrics only while DEBUG"""
+    user = getattr(request, 'user', None)
+    if user is not None and user.is_staff:
+        return True
+    token = get_metrics_config()['TOKEN']
+    if token:
+        return constant_time_compare(request.headers.get('Authorization', ''), f'Bearer {token}')
+    return settings.DEBUG
+
+
+def metrics_view(request):
+    """Prometheus text exposition of this process, or of every process sharing MULTIPROCESS_DIR"""
+    config = get_metrics_config()
+    if not config['ENABLED']:
+        return HttpResponse(status=404)
+    if not metrics_authorized(request):
+        return HttpResponseForbidden()
+    if config['MULTIPROCESS_DIR']:
+        snapshot = collect_multiprocess(registry, config['MULTIPROCESS_DIR'], config['WRITE_INTERVAL'])
+    else:
+        snapshot = registry.snapshot()
+    return HttpResponse(exposition(snapshot), content_type=CONTENT_TYPE)
@@ -0,0 +1,286 @@
+"""
+Sampled per-request database profiling.
+
+For a SAMPLE_RATE fraction of HTTP requests (QueryProfilerMiddleware) and of
+consumer database calls (ChatApp.metrics.database_sync_to_async), every SQL
+statement is timed through a connection execute wrapper. A profiled unit
+slower than SLOW_REQUEST_MS is logged with its query count, SQL time and its
+slowest statements, each with the line of project code that ran it. Totals per
+request and per statement are kept over a rolling WINDOW and served as JSON
+at /metrics/queries/, worst first.
+"""
+import heapq
+import logging
+import os
+import random
+import re
+import sys
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connection
+from django.http import HttpResponse, HttpResponseForbidden, JsonResponse
+
+logger = logging.getLogger(__name__)
+
+PROFILER_DEFAULTS = {
+    'ENABLED': False,
+    'SAMPLE_RATE': 0.01,
+    'SLOW_REQUEST_MS': 500,
+    'SLOWEST': 5,
+    'TOP_N': 20,
+    'WINDOW': 300,
+}
+
+# Lists of placeholders vary with the number of ids; count them as one statement
+_PLACEHOLDER_LIST = re.compile(r"\((?:%s, )*%s\)")
+_SQL_PREVIEW = 300
+# Middleware and wrappers that run every query are never its origin
+_INFRASTRUCTURE = (__file__, os.path.join(os.path.dirname(__file__), 'metrics.py'))
+
+
+def get_profiler_config():
+    config = dict(PROFILER_DEFAULTS)
+    config.update(getattr(settings, 'DB_PROFILER', {}))
+    return config
+
+
+def fingerprint(sql):
+    return _PLACEHOLDER_LIST.sub('(...)', sql)
+
+
+def query_origin():
+    """`path:line in function` of the innermost project frame outside the profiling machinery"""
+    root = str(settings.BASE_DIR) + os.sep
+    frame = sys._getframe(1)
+    while frame is not None:
+        filename = frame.f_code.co_filename
+        if filename.startswith(root) and filename not in _INFRASTRUCTURE and 'site-packages' not in filename:
+            return f'{filename[len(root):]}:{frame.f_lineno} in {frame.f_code.co_name}'
+        frame = frame.f_back
+    return None
+
+
+class QueryProfile:
+    """The statements one request or consumer call ran; installed as a connection execute wrapper"""
+
+    def __init__(self, name, slowest=5):
+        self.name = name
+        self.keep = slowest
+        self.count = 0
+        self.sql_seconds = 0.0
+        self.duration = 0.0
+        # fingerprint -> [count, seconds, max seconds, origin]
+        self.statements = {}
+        # min-heap of (seconds, sequence, sql, origin)
+        self._slowest = []
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.record(sql, time.perf_counter() - start)
+
+    def record(self, sql, seconds):
+        self.count += 1
+        self.sql_seconds += seconds
+        key = fingerprint(sql)
+        entry = self.statements.get(key)
+        if entry is None:
+            entry = self.statements[key] = [0, 0.0, 0.0, query_origin()]
+        entry[0] += 1
+        entry[1] += seconds
+        entry[2] = max(entry[2], seconds)
+        if len(self._slowest) < self.keep:
+            heapq.heappush(self._slowest, (seconds, self.count, sql, entry[3]))
+        elif seconds > self._slowest[0][0]:
+            heapq.heapreplace(self._slowest, (seconds, self.count, sql, entry[3]))
+
+    def slowest(self):
+        """[(seconds, sql, origin)], slowest first"""
+        return [(seconds, sql, origin) for seconds, _, sql, origin in sorted(self._slowest, reverse=True)]
+
+
+class QueryStats:
+    """Totals per profiled name and per statement over the last one to two windows"""
+
+    def __init__(self, window=300):
+        self.window = window
+        self._lock = threading.Lock()
+        self._current = self._empty()
+        self._previous = self._empty()
+        self._started = time.monotonic()
+
+    @staticmethod
+    def _empty():
+        return {'requests': {}, 'statements': {}}
+
+    def _rotate(self):
+        now = time.monotonic()
+        if now - self._started >= self.window:
+            self._previous = self._current if now - self._started < 2 * self.window else self._empty()
+            self._current = self._empty()
+            self._started = now
+
+    def add(self, profile):
+        with self._lock:
+            self._rotate()
+            request = self._current['requests'].setdefault(profile.name, [0, 0, 0.0, 0.0, 0.0])
+            request[0] += 1
+            request[1] += profile.count
+            request[2] += profile.sql_seconds
+            request[3] += profile.duration
+            request[4] = max(request[4], profile.duration)
+            for key, (count, seconds, max_seconds, origin) in profile.statements.items():
+                statement = self._current['statements'].setdefault(key, [0, 0.0, 0.0, origin])
+                statement[0] += count
+                statement[1] += seconds
+                statement[2] = max(statement[2], max_seconds)
+
+    def top(self, n=20):
+        """The n worst requests and statements by total time in the window"""
+        with self._lock:
+            self._rotate()
+            windows = [self._previous, self._current]
+            requests, statements = {}, {}
+            for window in windows:
+                for name, values in window['requests'].items():
+                    total = requests.setdefault(name, [0, 0, 0.0, 0.0, 0.0])
+                    total[:4] = [a + b for a, b in zip(total[:4], values[:4])]
+                    total[4] = max(total[4], values[4])
+                for key, values in window['statements'].items():
+                    total = statements.setdefault(key, [0, 0.0, 0.0, values[3]])
+                    total[:2] = [a + b for a, b in zip(total[:2], values[:2])]
+                    total[2] = max(total[2], values[2])
+
+        return {
+            'window_seconds': self.window,
+            'requests': [
+                {
+                    'name': name,
+                    'samples': samples,
+                    'queries_per_request': round(queries / samples, 1),
+                    'sql_ms_per_request': round(sql_seconds / samples * 1000, 3),
+                    'ms_per_request': round(seconds / samples * 1000, 3),
+                    'max_ms': round(max_seconds * 1000, 3),
+                }
+                for name, (samples, queries, sql_seconds, seconds, max_seconds)
+                in sorted(requests.items(), key=lambda item: item[1][3], reverse=True)[:n]
+            ],
+            'statements': [
+                {
+                    'sql': key[:_SQL_PREVIEW],
+                    'origin': origin,
+                    'count': count,
+                    'total_ms': round(seconds * 1000, 3),
+                    'max_ms': round(max_seconds * 1000, 3),
+                }
+                for key, (count, seconds, max_seconds, origin)
+                in sorted(statements.items(), key=lambda item: item[1][1], reverse=True)[:n]
+            ],
+        }
+
+    def clear(self):
+        with self._lock:
+            self._current = self._empty()
+            self._previous = self._empty()
+            self._started = time.monotonic()
+
+
+class QueryProfiler:
+    def __init__(self, sample_rate=0.01, slow_request_ms=500, slowest=5, window=300):
+        self.sample_rate = sample_rate
+        self.slow_request_ms = slow_request_ms
+        self.slowest = slowest
+        self.stats = QueryStats(window)
+
+    def sampled(self):
+        return random.random() < self.sample_rate
+
+    @contextmanager
+    def profile(self, name):
+        """Profile the queries run inside the block on this thread's connection; the name may be changed inside"""
+        profile = QueryProfile(name, self.slowest)
+        start = time.perf_counter()
+        try:
+            with connection.execute_wrapper(profile):
+                yield profile
+        finally:
+            profile.duration = time.perf_counter() - start
+            self.finish(profile)
+
+    def finish(self, profile):
+        self.stats.add(profile)
+        if profile.duration * 1000 >= self.slow_request_ms:
+            lines = [
+                f'  {seconds * 1000:.1f}ms at {origin or "?"}: {sql[:_SQL_PREVIEW]}'
+                for seconds, sql, origin in profile.slowest()
+            ]
+            logger.warning(
+                f"Slow {profile.name}: {profile.duration * 1000:.1f}ms, {profile.count} queries "
+                f"in {profile.sql_seconds * 1000:.1f}ms\n" + '\n'.join(lines)
+            )
+
+
+_profiler = None
+
+
+def get_query_profiler():
+    """Return the process-wide profiler, or None when DB_PROFILER is disabled"""
+    global _profiler
+    config = get_profiler_config()
+    if not config['ENABLED']:
+        return None
+    if _profiler is None:
+        _profiler = QueryProfiler(
+            sample_rate=config['SAMPLE_RATE'],
+            slow_request_ms=config['SLOW_REQUEST_MS'],
+            slowest=config['SLOWEST'],
+            window=config['WINDOW'],
+        )
+    return _profiler
+
+
+def sampled_profile(name):
+    """Profile the block for a sampled fraction of calls; a no-op context otherwise"""
+    profiler = get_query_profiler()
+    if profiler is None or not profiler.sampled():
+        return nullcontext()
+    return profiler.profile(name)
+
+
+class QueryProfilerMiddleware:
+    """Profiles a sampled fraction of HTTP requests; only loaded when DB_PROFILER is enabled"""
+
+    def __init__(self, get_response):
+        if not get_profiler_config()['ENABLED']:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+
+    def __call__(self, request):
+        profiler = get_query_profiler()
+        if profiler is None or not profiler.sampled():
+            return self.get_response(request)
+        with profiler.profile(request.method) as profile:
+            response = self.get_response(request)
+            match = getattr(request, 'resolver_match', None)
+            profile.name = f"{request.method} {match.route if match is not None else 'unmatched'}"
+        return response
+
+
+def query_profile_view(request):
+    """The rolling top-N requests and statements as JSON; guarded like /metrics/"""
+    from .metrics import metrics_authorized
+    profiler = get_query_profiler()
+    if profiler is None:
+        return HttpResponse(status=404)
+    if not metrics_authorized(request):
+        return HttpResponseForbidden()
+    try:
+        n = int(request.GET.get('n', get_profiler_config()['TOP_N']))
+    except ValueError:
+        return JsonResponse({'error': 'n must be an integer'}, status=400)
+    return JsonResponse(profiler.stats.top(n))
@@ -0,0 +1,26 @@
+import asyncio
+import weakref
+from django.conf import settings
+
+_sync_client = None
+_async_clients = weakref.WeakKeyDictionary()
+
+
+def get_redis():
+    """Return the process-wide blocking Redis client"""
+    global _sync_client
+    if _sync_client is None:
+        import redis
+        _sync_client = redis.Redis.from_url(settings.REDIS_URL)
+    return _sync_client
+
+
+def get_async_redis():
+    """Return an asyncio Redis client bound to the running event loop"""
+    import redis.asyncio
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        client = redis.asyncio.Redis.from_url(settings.REDIS_URL)
+        _async_clients[loop] = client
+    return client
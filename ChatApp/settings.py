@@ -31,6 +31,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'ChatApp.metrics.MetricsMiddleware',
+    'ChatApp.profiling.QueryProfilerMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -115,6 +117,136 @@ if DEBUG and not os.environ.get('REDIS_URL'):
         },
     }
 
+# Daily message quota counters (payments/quota.py), synced to MessageUsage every SYNC_INTERVAL seconds
+MESSAGE_QUOTA = {
+    'BACKEND': 'payments.quota.RedisQuotaStore',
+    'SYNC_INTERVAL': int(os.environ.get('MESSAGE_QUOTA_SYNC_INTERVAL', '5')),
+    'LIMIT_CACHE_TTL': 60,
+    'FREE_DAILY_LIMIT': 10,
+}
+
+if DEBUG and not os.environ.get('REDIS_URL'):
+    MESSAGE_QUOTA['BACKEND'] = 'payments.quota.InMemoryQuotaStore'
+
+# Who is online per chat room (chat/presence.py). Each worker refreshes its
+# sockets every HEARTBEAT_INTERVAL seconds; entries expire after TTL seconds.
+CHAT_PRESENCE = {
+    'BACKEND': 'chat.presence.RedisPresenceStore',
+    'HEARTBEAT_INTERVAL': int(os.environ.get('CHAT_PRESENCE_HEARTBEAT_INTERVAL', '30')),
+    'TTL': int(os.environ.get('CHAT_PRESENCE_TTL', '90')),
+}
+
+if DEBUG and not os.environ.get('REDIS_URL'):
+    CHAT_PRESENCE['BACKEND'] = 'chat.presence.InMemoryPresenceStore'
+
+# Number of recent messages kept per room and sent to sockets on connect (chat/history.py)
+CHAT_HISTORY_SIZE = int(os.environ.get('CHAT_HISTORY_SIZE', '20'))
+
+# Sockets reconnecting with ?since=<message_id> get exactly the messages they
+# missed, CHUNK_SIZE per frame; past MAX_MESSAGES they get a resync frame and
+# page through the REST API instead (chat/history.py)
+CHAT_RESYNC = {
+    'MAX_MESSAGES': int(os.environ.get('CHAT_RESYNC_MAX_MESSAGES', '500')),
+    'CHUNK_SIZE': int(os.environ.get('CHAT_RESYNC_CHUNK_SIZE', '100')),
+}
+
+# Per-socket outbound queue (chat/outbound.py). When a socket falls MAX_SIZE
+# frames behind, POLICY is drop_oldest, coalesce (drop_oldest, and newer
+# typing/read frames replace queued ones) or disconnect (close with a resync hint).
+# A socket whose send blocks for SEND_TIMEOUT seconds is closed. Both triggers
+# need a server with send backpressure (uvicorn); under daphne they never fire
+CHAT_OUTBOUND = {
+    'MAX_SIZE': int(os.environ.get('CHAT_OUTBOUND_MAX_SIZE', '256')),
+    'POLICY': os.environ.get('CHAT_OUTBOUND_POLICY', 'coalesce'),
+    'SEND_TIMEOUT': float(os.environ.get('CHAT_OUTBOUND_SEND_TIMEOUT', '10')),
+}
+
+# In-memory token buckets for chat sockets (chat/ratelimit.py): RATE is
+# tokens per second, BURST the bucket size. CONNECTION and ANONYMOUS limit
+# every frame of a socket; PLANS limit chat messages per user by plan type.
+CHAT_RATE_LIMIT = {
+    'ENABLED': os.environ.get('CHAT_RATE_LIMIT', 'True') == 'True',
+    'CONNECTION': {'RATE': 10, 'BURST': 20},
+    'ANONYMOUS': {'RATE': 0.5, 'BURST': 3},
+    'PLANS': {
+        'free': {'RATE': 1, 'BURST': 5},
+        'basic': {'RATE': 2, 'BURST': 10},
+        'pro': {'RATE': 5, 'BURST': 20},
+    },
+}
+
+# Typing indicators and read receipts are broadcast at most once per room
+# every CHAT_ACTIVITY_WINDOW seconds (chat/activity.py)
+CHAT_ACTIVITY_WINDOW = float(os.environ.get('CHAT_ACTIVITY_WINDOW', '0.5'))
+
+# Write-behind persistence for WebSocket chat messages (chat/persistence.py).
+# FLUSH_INTERVAL and MAX_PENDING bound how much unwritten data a crash can lose;
+# past MAX_PENDING senders get an error. Failed flushes are retried with backoff
+# up to MAX_BACKOFF seconds. Rows the database rejects go to DEAD_LETTER_FILE
+# (`manage.py replay_dead_letters`). Message ids embed a worker id that must be
+# unique across every process.
+CHAT_WRITE_BEHIND = {
+    'ENABLED': os.environ.get('CHAT_WRITE_BEHIND', 'False') == 'True',
+    'FLUSH_INTERVAL': float(os.environ.get('CHAT_WRITE_BEHIND_FLUSH_INTERVAL', '0.05')),
+    'MAX_BATCH_SIZE': int(os.environ.get('CHAT_WRITE_BEHIND_MAX_BATCH_SIZE', '200')),
+    'MAX_PENDING': int(os.environ.get('CHAT_WRITE_BEHIND_MAX_PENDING', '5000')),
+    'WORKER_ID': int(os.environ['CHAT_WORKER_ID']) if os.environ.get('CHAT_WORKER_ID') else None,
+    # Without CHAT_WORKER_ID each process claims a free worker id in Redis
+    'WORKER_ID_BACKEND': 'chat.persistence.RedisWorkerIdClaim',
+    'MAX_BACKOFF': float(os.environ.get('CHAT_WRITE_BEHIND_MAX_BACKOFF', '5')),
+    'DEAD_LETTER_FILE': os.environ.get('CHAT_WRITE_BEHIND_DEAD_LETTER_FILE')
+    or str(BASE_DIR / 'logs' / 'write_behind_dead_letters.jsonl'),
+}
+
+if DEBUG and not os.environ.get('REDIS_URL'):
+    CHAT_WRITE_BEHIND['WORKER_ID_BACKEND'] = 'chat.persistence.ProcessWorkerId'
+
+# Archival of old messages into compressed segments (chat/archive.py, run by
+# `manage.py archive_messages`). AFTER_DAYS is the default age threshold and
+# ROOMS overrides it per room name; None keeps a room's messages hot.
+CHAT_ARCHIVE = {
+    'AFTER_DAYS': int(os.environ.get('CHAT_ARCHIVE_AFTER_DAYS', '90')),
+    'ROOMS': {},
+    'SEGMENT_SIZE': int(os.environ.get('CHAT_ARCHIVE_SEGMENT_SIZE', '1000')),
+}
+
+# Log of message edits and deletes behind the room changes endpoint
+# (chat/changes.py). `manage.py archive_messages` deletes changes older than
+# RETENTION_DAYS; PAGE_SIZE caps the changes returned per request. Changes
+# younger than COMMIT_MARGIN seconds wait for the next request, so one that
+# commits late is never skipped.
+CHAT_CHANGES = {
+    'RETENTION_DAYS': int(os.environ.get('CHAT_CHANGES_RETENTION_DAYS', '30')),
+    'PAGE_SIZE': 500,
+    'COMMIT_MARGIN': int(os.environ.get('CHAT_CHANGES_COMMIT_MARGIN', '5')),
+}
+
+# In-process metrics served at /metrics/ in the Prometheus text format
+# (ChatApp/metrics.py) to staff sessions and to requests with TOKEN as a Bearer
+# token. Without a TOKEN only staff can read them unless DEBUG is on. With
+# several worker processes, point MULTIPROCESS_DIR at a directory they share;
+# each writes its snapshot there every WRITE_INTERVAL seconds and a scrape of
+# any worker returns the sum over all of them.
+METRICS = {
+    'ENABLED': os.environ.get('METRICS_ENABLED', 'True') == 'True',
+    'TOKEN': os.environ.get('METRICS_TOKEN') or None,
+    'MULTIPROCESS_DIR': os.environ.get('METRICS_MULTIPROCESS_DIR') or None,
+    'WRITE_INTERVAL': float(os.environ.get('METRICS_WRITE_INTERVAL', '5')),
+}
+
+# Sampled SQL profiling of HTTP requests and consumer database calls
+# (ChatApp/profiling.py). Profiled units slower than SLOW_REQUEST_MS are logged
+# with their SLOWEST statements; the TOP_N offenders over a rolling WINDOW of
+# seconds are served at /metrics/queries/.
+DB_PROFILER = {
+    'ENABLED': os.environ.get('DB_PROFILER', 'False') == 'True',
+    'SAMPLE_RATE': float(os.environ.get('DB_PROFILER_SAMPLE_RATE', '0.01')),
+    'SLOW_REQUEST_MS': float(os.environ.get('DB_PROFILER_SLOW_REQUEST_MS', '500')),
+    'SLOWEST': 5,
+    'TOP_N': 20,
+    'WINDOW': int(os.environ.get('DB_PROFILER_WINDOW', '300')),
+}
+
 EMAIL_BACKEND = 'django.core.mail.backends.smtp.EmailBackend'
 EMAIL_HOST = 'smtp.gmail.com'
 EMAIL_PORT = 587
@@ -141,6 +273,18 @@ LOGS_DIR = BASE_DIR / 'logs'
 LOGS_DIR.mkdir(exist_ok=True)
 
 # Logging Configuration
+# Sampling rates for high-volume log events (see ChatApp.log.log_event);
+# warnings and errors are always kept
+LOG_EVENT_SAMPLING = {
+    'ws_connect': float(os.environ.get('LOG_SAMPLE_WS_CONNECT', '1.0')),
+    'ws_disconnect': float(os.environ.get('LOG_SAMPLE_WS_DISCONNECT', '1.0')),
+    'chat_message': float(os.environ.get('LOG_SAMPLE_CHAT_MESSAGE', '0.01')),
+    'call_signal': float(os.environ.get('LOG_SAMPLE_CALL_SIGNAL', '0.01')),
+}
+
+# Starts the 'queue' handler's listener thread on its target handlers
+LOGGING_CONFIG = 'ChatApp.log.configure_logging'
+
 LOGGING = {
     'version': 1,
     'disable_existing_loggers': False,
@@ -149,6 +293,15 @@ LOGGING = {
             'format': '[{levelname}] {asctime} {module} {message}',
             'style': '{',
         },
+        'json': {
+            '()': 'ChatApp.log.JSONFormatter',
+        },
+    },
+    'filters': {
+        'sampling': {
+            '()': 'ChatApp.log.EventSamplingFilter',
+            'rates': LOG_EVENT_SAMPLING,
+        },
     },
     'handlers': {
         'console': {
@@ -158,26 +311,45 @@ LOGGING = {
         'file': {
             'class': 'logging.FileHandler',
             'filename': LOGS_DIR / 'django.log',
-            'formatter': 'verbose',
+            'formatter': 'json',
+            'delay': True,
+        },
+        # Everything goes through 'queue'; a background thread writes to the
+        # console and file handlers so logging never blocks the event loop
+        'queue': {
+            '()': 'ChatApp.log.QueueLogHandler',
+            'handlers': ['console', 'file'] if not DEBUG else ['console'],
+            'maxsize': int(os.environ.get('LOG_QUEUE_SIZE', '10000')),
+            'filters': ['sampling'],
         },
     },
     'root': {
-        'handlers': ['console'],
+        'handlers': ['queue'],
         'level': os.environ.get('LOG_LEVEL', 'INFO'),
     },
     'loggers': {
+        'ChatApp': {
+            'handlers': ['queue'],
+            'level': 'INFO',
+            'propagate': False,
+        },
         'django': {
-            'handlers': ['console', 'file'] if not DEBUG else ['console'],
+            'handlers': ['queue'],
             'level': os.environ.get('DJANGO_LOG_LEVEL', 'INFO'),
             'propagate': False,
         },
         'chat': {
-            'handlers': ['console', 'file'] if not DEBUG else ['console'],
+            'handlers': ['queue'],
+            'level': 'DEBUG' if DEBUG else 'INFO',
+            'propagate': False,
+        },
+        'calls': {
+            'handlers': ['queue'],
             'level': 'DEBUG' if DEBUG else 'INFO',
             'propagate': False,
         },
         'payments': {
-            'handlers': ['console', 'file'] if not DEBUG else ['console'],
+            'handlers': ['queue'],
             'level': 'DEBUG' if DEBUG else 'INFO',
             'propagate': False,
         },
@@ -0,0 +1,337 @@
+"""
+Query-count and latency regression suite for the REST API.
+
+Every GET route is called against a seeded database and compared with
+api_baseline.json next to this file. Query counts are always checked: an
+endpoint may not run more queries than its baseline. Latency depends on the
+machine, so it is only measured when API_BENCH is set:
+
+    API_BENCH=record python manage.py test ChatApp    # rewrite the baseline
+    API_BENCH=compare python manage.py test ChatApp   # fail on slower endpoints
+
+API_BENCH_ROUNDS (default 30) sets the requests per endpoint and
+API_BENCH_TOLERANCE (default 0.25) how much slower than the baseline an
+endpoint's p50 and p95 may get.
+"""
+import asyncio
+import json
+import os
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from pathlib import Path
+from unittest import skipUnless
+from django.contrib.auth import get_user_model
+from django.db import connection
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework import status
+from rest_framework.test import APITestCase
+from rest_framework_simplejwt.tokens import AccessToken
+from calls.models import Call
+from chat.models import ChatRoom, Message, ReadCursor
+from chat.management.commands.chat_bench import latency_summary
+from . import metrics, profiling
+from payments.models import MessageUsage, SubscriptionPlan, UserSubscription
+
+User = get_user_model()
+
+BASELINE_PATH = Path(__file__).with_name('api_baseline.json')
+BENCH_MODE = os.environ.get('API_BENCH')
+ROUNDS = int(os.environ.get('API_BENCH_ROUNDS', '30'))
+TOLERANCE = float(os.environ.get('API_BENCH_TOLERANCE', '0.25'))
+# Absolute slack, so sub-millisecond timer noise is not reported as a regression
+SLACK_MS = 2.0
+
+ENDPOINTS = {
+    'rooms': '/api/chat/rooms/',
+    'room_detail': '/api/chat/rooms/{room_id}/',
+    'my_rooms': '/api/chat/rooms/my_rooms/',
+    'rooms_online': '/api/chat/rooms/online/?rooms={room_name}&users={other_id}',
+    'room_read_cursors': '/api/chat/rooms/{room_id}/read_cursors/',
+    'messages': '/api/chat/messages/?limit=50',
+    'messages_by_room': '/api/chat/messages/?room={room_name}&limit=50',
+    'room_messages': '/api/chat/messages/room/{room_name}/?limit=50',
+    'my_messages': '/api/chat/messages/my_messages/?limit=50',
+    'message_detail': '/api/chat/messages/{message_id}/',
+    'message_search': '/api/chat/messages/search/?q=topic*&limit=50',
+    'call_history': '/api/calls/history/',
+    'call_detail': '/api/calls/{call_id}/',
+    'plans': '/api/payments/plans/',
+    'my_subscription': '/api/payments/my-subscription/',
+    'users_me': '/api/users/me/',
+}
+
+
+def load_baseline():
+    if not BASELINE_PATH.exists():
+        return {}
+    return json.loads(BASELINE_PATH.read_text())
+
+
+class APIBenchmarkTestCase(APITestCase):
+    """Seeds enough rows that an N+1 query shows up as dozens of extra queries"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(email='bench@example.com', password='testpass123',
+                                            first_name='Bench', last_name='User', is_verified=True)
+        others = User.objects.bulk_create([
+            User(email=f'bench{i}@example.com', first_name='User', last_name=str(i), password='!')
+            for i in range(200)
+        ])
+        cls.other = others[0]
+
+        rooms = ChatRoom.objects.bulk_create([
+            ChatRoom(name=f'bench-{i}', display_name=f'Bench {i}', created_by=others[i])
+            for i in range(50)
+        ])
+        Participant = ChatRoom.participants.through
+        Participant.objects.bulk_create([
+            Participant(chatroom=room, customuser=user)
+            for i, room in enumerate(rooms)
+            for user in [cls.user, *others[i:i + 20]]
+        ])
+        cls.room = rooms[0]
+
+        start = timezone.now() - timedelta(days=3)
+        Message.objects.bulk_create([
+            Message(user=cls.user if i % 7 == 0 else others[i % 200], room=rooms[i % 50],
+                    room_name=rooms[i % 50].name, content=f'message {i} about topic{i % 13}',
+                    timestamp=start + timedelta(seconds=i * 20))
+            for i in range(5000)
+        ])
+        cls.message = Message.objects.filter(room=cls.room).order_by('-timestamp').first()
+        ReadCursor.objects.bulk_create([
+            ReadCursor(room=cls.room, user=user, last_read_message_id=cls.message.id)
+            for user in others[:20]
+        ])
+
+        Call.objects.bulk_create([
+            Call(caller=cls.user if i % 2 else others[i % 200], receiver=others[i % 200] if i % 2 else cls.user,
+                 status='ended', duration=i)
+            for i in range(300)
+        ])
+        cls.call = Call.objects.filter(caller=cls.user).first()
+
+        plans = [
+            SubscriptionPlan.objects.create(name=name, plan_type=plan_type, price=price,
+                                            duration_days=days, message_limit=limit)
+            for name, plan_type, price, days, limit in [
+                ('Basic Plan', 'basic', 0, 0, 10), ('Pro - Daily', 'pro', 1, 1, None),
+                ('Pro - Weekly', 'pro', 7, 7, None), ('Pro - Monthly', 'pro', 30, 30, None),
+            ]
+        ]
+        UserSubscription.objects.create(user=cls.user, plan=plans[3])
+        MessageUsage.objects.create(user=cls.user, daily_count=3)
+
+    def setUp(self):
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {AccessToken.for_user(self.user)}')
+
+    def url(self, name):
+        return ENDPOINTS[name].format(
+            room_id=self.room.id, room_name=self.room.name, other_id=self.other.id,
+            message_id=self.message.id, call_id=self.call.id,
+        )
+
+    def get(self, name):
+        response = self.client.get(self.url(name))
+        self.assertEqual(response.status_code, status.HTTP_200_OK, name)
+        return response
+
+    def count_queries(self, name):
+        with CaptureQueriesContext(connection) as queries:
+            self.get(name)
+        return len(queries)
+
+    def time_requests(self, name):
+        self.get(name)
+        samples = []
+        for _ in range(ROUNDS):
+            start = time.perf_counter()
+            self.get(name)
+            samples.append(time.perf_counter() - start)
+        return latency_summary(samples)
+
+    def test_query_counts(self):
+        baseline = load_baseline()
+        for name in ENDPOINTS:
+            with self.subTest(endpoint=name):
+                self.assertIn(name, baseline, f'No baseline for {name}; run with API_BENCH=record')
+                queries = self.count_queries(name)
+                self.assertLessEqual(queries, baseline[name]['queries'],
+                                     f'{name} ran {queries} queries, baseline is {baseline[name]["queries"]}')
+
+    @skipUnless(BENCH_MODE in ('record', 'compare'), 'set API_BENCH=record or API_BENCH=compare')
+    def test_latency(self):
+        results = {
+            name: dict(queries=self.count_queries(name), **self.time_requests(name))
+            for name in ENDPOINTS
+        }
+        if BENCH_MODE == 'record':
+            BASELINE_PATH.write_text(json.dumps(results, indent=2, sort_keys=True) + '\n')
+            return
+
+        baseline = load_baseline()
+        regressions = []
+        for name, result in results.items():
+            for field in ('p50_ms', 'p95_ms'):
+                allowed = baseline[name][field] * (1 + TOLERANCE) + SLACK_MS
+                if result[field] > allowed:
+                    regressions.append(f'{name} {field} {result[field]} > {allowed:.3f}')
+        self.assertFalse(regressions, '\n'.join(regressions))
+
+
+class MetricsTestCase(TestCase):
+    def test_counter_sums_every_thread(self):
+        registry = metrics.Registry()
+        counter = registry.counter('jobs_total', 'Jobs', ['kind'])
+
+        def work():
+            child = counter.labels(kind='a')
+            for _ in range(1000):
+                child.inc()
+
+        threads = [threading.Thread(target=work) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        counter.labels(kind='b').inc(2)
+
+        text = metrics.exposition(registry.snapshot())
+        self.assertIn('# TYPE jobs_total counter', text)
+        self.assertIn('jobs_total{kind="a"} 4000', text)
+        self.assertIn('jobs_total{kind="b"} 2', text)
+
+    def test_histogram_buckets_are_cumulative(self):
+        registry = metrics.Registry()
+        histogram = registry.histogram('wait_seconds', 'Wait', buckets=(0.1, 1))
+        for value in (0.05, 0.1, 0.5, 3):
+            histogram.observe(value)
+
+        text = metrics.exposition(registry.snapshot())
+        self.assertIn('wait_seconds_bucket{le="0.1"} 2', text)
+        self.assertIn('wait_seconds_bucket{le="1"} 3', text)
+        self.assertIn('wait_seconds_bucket{le="+Inf"} 4', text)
+        self.assertIn('wait_seconds_sum 3.65', text)
+        self.assertIn('wait_seconds_count 4', text)
+
+    def test_gauge_and_callback(self):
+        registry = metrics.Registry()
+        gauge = registry.gauge('open', 'Open')
+        gauge.inc(3)
+        gauge.dec()
+        registry.callback('depth', 'Depth', 'gauge', lambda: 7)
+
+        text = metrics.exposition(registry.snapshot())
+        self.assertIn('open 2', text)
+        self.assertIn('depth 7', text)
+        with self.assertRaises(ValueError):
+            registry.counter('open', 'Open')
+
+    def test_multiprocess_snapshots_are_summed(self):
+        registry = metrics.Registry()
+        registry.counter('jobs_total', 'Jobs', ['kind']).labels('a').inc(5)
+        other = metrics.Registry()
+        other.counter('jobs_total', 'Jobs', ['kind']).labels('a').inc(2)
+        other.counter('jobs_total', 'Jobs', ['kind']).labels('b').inc()
+
+        with tempfile.TemporaryDirectory() as directory:
+            stale = Path(directory) / '1.json'
+            stale.write_text(json.dumps(other.snapshot()))
+            (Path(directory) / '2.json').write_text(json.dumps(other.snapshot()))
+            os.utime(stale, (0, 0))
+            merged = metrics.collect_multiprocess(registry, directory, interval=5)
+            self.assertFalse(stale.exists())
+
+        text = metrics.exposition(merged)
+        self.assertIn('jobs_total{kind="a"} 7', text)
+        self.assertIn('jobs_total{kind="b"} 1', text)
+
+    @override_settings(DEBUG=True)
+    def test_endpoint(self):
+        self.client.get('/metrics/', secure=True)
+        response = self.client.get('/metrics/', secure=True)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/plain; version=0.0.4'))
+        text = response.content.decode()
+        self.assertIn('http_requests_total{route="metrics/",method="GET",status="200"}', text)
+        self.assertIn('# TYPE ws_connections gauge', text)
+
+    @override_settings(METRICS={'TOKEN': 'secret'})
+    def test_endpoint_token(self):
+        self.assertEqual(self.client.get('/metrics/', secure=True).status_code, 403)
+        response = self.client.get('/metrics/', secure=True, headers={'Authorization': 'Bearer secret'})
+        self.assertEqual(response.status_code, 200)
+
+    def test_endpoint_is_closed_without_token_outside_debug(self):
+        self.assertEqual(self.client.get('/metrics/', secure=True).status_code, 403)
+        self.client.force_login(get_user_model().objects.create_user(
+            email='ops@example.com', password='pass1234', is_staff=True
+        ))
+        self.assertEqual(self.client.get('/metrics/', secure=True).status_code, 200)
+
+    def test_gauge_set_is_not_undone_by_other_threads(self):
+        gauge = metrics.Registry().gauge('depth', 'Depth')
+        thread = threading.Thread(target=gauge.inc, args=(5,))
+        thread.start()
+        thread.join()
+        gauge.set(2)
+        gauge.inc()
+        self.assertEqual(gauge.samples()[0][1], [3])
+
+
+@override_settings(DB_PROFILER={'ENABLED': True, 'SAMPLE_RATE': 1, 'SLOW_REQUEST_MS': 0})
+class QueryProfilerTestCase(TransactionTestCase):
+    def setUp(self):
+        profiling._profiler = None
+        self.user = User.objects.create_user(email='profiled@example.com', password='testpass123',
+                                             first_name='Pro', last_name='Filed', is_verified=True)
+
+    def tearDown(self):
+        profiling._profiler = None
+
+    def test_profile_groups_statements(self):
+        profile = profiling.QueryProfile('block', slowest=2)
+        with connection.execute_wrapper(profile):
+            for size in (1, 2, 3):
+                list(User.objects.filter(id__in=range(size)))
+            User.objects.count()
+
+        self.assertEqual(profile.count, 4)
+        self.assertEqual(len(profile.statements), 2)
+        self.assertEqual(len(profile.slowest()), 2)
+        origins = {entry[3] for entry in profile.statements.values()}
+        self.assertTrue(all(origin.startswith('ChatApp/tests.py:') for origin in origins), origins)
+
+    @override_settings(DEBUG=True)
+    def test_middleware_logs_and_ranks_requests(self):
+        headers = {'Authorization': f'Bearer {AccessToken.for_user(self.user)}'}
+        with self.assertLogs('ChatApp.profiling', 'WARNING') as logs:
+            response = self.client.get('/api/users/me/', secure=True, headers=headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('Slow GET api/users/me/$', logs.output[0])
+
+        top = self.client.get('/metrics/queries/', secure=True).json()
+        request = next(entry for entry in top['requests'] if entry['name'] == 'GET api/users/me/$')
+        self.assertEqual(request['samples'], 1)
+        self.assertGreater(request['queries_per_request'], 0)
+        self.assertTrue(top['statements'])
+
+    def test_consumer_calls_are_profiled(self):
+        @metrics.database_sync_to_async
+        def load_emails():
+            return list(User.objects.values_list('email', flat=True))
+
+        with self.assertLogs('ChatApp.profiling', 'WARNING'):
+            self.assertEqual(asyncio.run(load_emails()), ['profiled@example.com'])
+        names = [entry['name'] for entry in profiling.get_query_profiler().stats.top()['requests']]
+        self.assertIn('db QueryProfilerTestCase.test_consumer_calls_are_profiled.<locals>.load_emails', names)
+
+    @override_settings(DB_PROFILER={'ENABLED': False})
+    def test_disabled(self):
+        self.assertIsNone(profiling.get_query_profiler())
+        self.assertEqual(self.client.get('/metrics/queries/', secure=True).status_code, 404)
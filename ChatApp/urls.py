@@ -1,6 +1,8 @@
 from django.contrib import admin
 from rest_framework_simplejwt.views import TokenObtainPairView, TokenRefreshView
 from django.urls import path, include
+from .metrics import metrics_view
+from .profiling import query_profile_view
 
 urlpatterns = [
     path('admin/', admin.site.urls),
@@ -11,4 +13,6 @@ urlpatterns = [
     path('api/calls/', include('calls.urls')),
     path('api/token/', TokenObtainPairView.as_view(), name='token_obtain_pair_view'),
     path('api/token/refresh/', TokenRefreshView.as_view(), name='token_refresh_view'),
+    path('metrics/', metrics_view, name='metrics'),
+    path('metrics/queries/', query_profile_view, name='query-profile'),
 ]
\ No newline at end of file
@@ -1,11 +1,26 @@
-import json
+import logging
 from channels.generic.websocket import AsyncWebsocketConsumer
-from channels.db import database_sync_to_async
+from ChatApp.metrics import database_sync_to_async
 from django.utils import timezone
 from .models import Call
 from users.models import CustomUser as User
+from chat.codec import CodecMixin, group_event
+from chat.presence import CALLS_KEY, get_presence
+from ChatApp import metrics
+from ChatApp.log import log_event
 
-class CallConsumer(AsyncWebsocketConsumer):
+logger = logging.getLogger(__name__)
+
+# WebRTC signaling relays are sent many times per call and are logged sampled
+SIGNAL_TYPES = ('ice_candidate', 'offer', 'answer')
+FRAME_TYPES = ('call_initiate', 'call_answer', 'call_reject', 'call_end') + SIGNAL_TYPES
+
+CONNECTIONS = metrics.gauge('ws_connections', 'Open WebSocket connections', ['consumer']).labels('call')
+FRAMES = metrics.counter('call_frames_received_total', 'Call socket frames received by type', ['type'])
+GROUP_SEND_SECONDS = metrics.histogram('channel_layer_group_send_seconds', 'Latency of channel layer group_send',
+                                       ['consumer']).labels('call')
+
+class CallConsumer(CodecMixin, AsyncWebsocketConsumer):
     async def connect(self):
         self.user = self.scope['user']
         self.room_group_name = None
@@ -22,28 +37,44 @@ class CallConsumer(AsyncWebsocketConsumer):
             self.channel_name
         )
         
-        await self.accept()
+        await self.accept_negotiated()
+        CONNECTIONS.inc()
+        try:
+            await get_presence().join(CALLS_KEY, self.user.id, self.channel_name)
+        except Exception as e:
+            logger.error(f"Presence join failed for user {self.user_id}: {e}")
         
     async def disconnect(self, close_code):
         if self.room_group_name:
+            CONNECTIONS.dec()
             await self.channel_layer.group_discard(
                 self.room_group_name,
                 self.channel_name
             )
+            try:
+                await get_presence().leave(CALLS_KEY, self.user.id, self.channel_name)
+            except Exception as e:
+                logger.error(f"Presence leave failed for user {self.user_id}: {e}")
         
-    async def receive(self, text_data):
-        if not text_data:
+    async def receive(self, text_data=None, bytes_data=None):
+        if not text_data and not bytes_data:
             return
         try:
-            data = json.loads(text_data)
-        except json.JSONDecodeError:
-            await self.send(text_data=json.dumps({
+            data = self.decode_frame(text_data, bytes_data)
+        except ValueError:
+            await self.send_frame({
                 "type": "error",
-                "message": "Invalid JSON"
-            }))
+                "message": "Invalid MessagePack" if self.binary else "Invalid JSON"
+            })
+            return
+        if not isinstance(data, dict):
             return
         
         message_type = data.get('type')
+        # Unknown types are counted together so clients cannot create label values
+        FRAMES.labels(message_type if message_type in FRAME_TYPES else 'other').inc()
+        log_event(logger, 'call_signal' if message_type in SIGNAL_TYPES else 'call_event',
+                  type=message_type, user_id=self.user_id)
         
         if message_type == 'call_initiate':
             await self.initiate_call(data)
@@ -65,29 +96,26 @@ class CallConsumer(AsyncWebsocketConsumer):
         receiver = await self.get_user(receiver_id)
         
         if not receiver:
-            await self.send(text_data=json.dumps({
+            await self.send_frame({
                 'type': 'error',
                 'message': 'User not found'
-            }))
+            })
             return
             
-        call = await self.create_call(self.user, receiver)
-        
-        await self.channel_layer.group_send(
-            f'user_{receiver_id}',
-            {
-                'type': 'incoming_call',
-                'call_id': str(call.id),
-                'caller': {
-                    'id': str(self.user.id),
-                    'email': self.user.email,
-                    'first_name': self.user.first_name,
-                    'last_name': self.user.last_name,
-                }
+        call = await self.create_call(self.user.id, receiver.id)
+        
+        await self.send_to_user(receiver_id, {
+            'type': 'incoming_call',
+            'call_id': str(call.id),
+            'caller': {
+                'id': str(self.user.id),
+                'email': self.user.email,
+                'first_name': self.user.first_name,
+                'last_name': self.user.last_name,
             }
-        )
+        })
         
-        await self.send(text_data=json.dumps({
+        await self.send_frame({
             'type': 'call_initiated',
             'call_id': str(call.id),
             'receiver': {
@@ -96,7 +124,7 @@ class CallConsumer(AsyncWebsocketConsumer):
                 'first_name': receiver.first_name,
                 'last_name': receiver.last_name,
             }
-        }))
+        })
         
     async def answer_call(self, data):
         call_id = data.get('call_id')
@@ -104,13 +132,10 @@ class CallConsumer(AsyncWebsocketConsumer):
         
         if call:
             caller_id = await self.get_caller_id(call_id)
-            await self.channel_layer.group_send(
-                f'user_{caller_id}',
-                {
-                    'type': 'call_answered',
-                    'call_id': str(call.id)
-                }
-            )
+            await self.send_to_user(caller_id, {
+                'type': 'call_answered',
+                'call_id': str(call.id)
+            })
             
     async def reject_call(self, data):
         call_id = data.get('call_id')
@@ -118,13 +143,10 @@ class CallConsumer(AsyncWebsocketConsumer):
         
         if call:
             caller_id = await self.get_caller_id(call_id)
-            await self.channel_layer.group_send(
-                f'user_{caller_id}',
-                {
-                    'type': 'call_rejected',
-                    'call_id': str(call.id)
-                }
-            )
+            await self.send_to_user(caller_id, {
+                'type': 'call_rejected',
+                'call_id': str(call.id)
+            })
             
     async def end_call(self, data):
         call_id = data.get('call_id')
@@ -134,77 +156,73 @@ class CallConsumer(AsyncWebsocketConsumer):
             caller_id, receiver_id = call_info
             other_user_id = str(receiver_id if str(caller_id) == self.user_id else caller_id)
             
-            await self.channel_layer.group_send(
-                f'user_{other_user_id}',
-                {
-                    'type': 'call_ended',
-                    'call_id': str(call_id)
-                }
-            )
+            await self.send_to_user(other_user_id, {
+                'type': 'call_ended',
+                'call_id': str(call_id)
+            })
             
     async def forward_ice_candidate(self, data):
         target_id = data.get('target_id')
         candidate = data.get('candidate')
         
-        await self.channel_layer.group_send(
-            f'user_{target_id}',
-            {
-                'type': 'ice_candidate',
-                'candidate': candidate,
-                'from_user': self.user_id
-            }
-        )
+        await self.send_to_user(target_id, {
+            'type': 'ice_candidate',
+            'candidate': candidate,
+            'from_user': self.user_id
+        })
         
     async def forward_offer(self, data):
         target_id = data.get('target_id')
         offer = data.get('offer')
         call_id = data.get('call_id')
         
-        await self.channel_layer.group_send(
-            f'user_{target_id}',
-            {
-                'type': 'offer',
-                'offer': offer,
-                'call_id': call_id,
-                'from_user': self.user_id
-            }
-        )
+        await self.send_to_user(target_id, {
+            'type': 'offer',
+            'offer': offer,
+            'call_id': call_id,
+            'from_user': self.user_id
+        })
         
     async def forward_answer(self, data):
         target_id = data.get('target_id')
         answer = data.get('answer')
         call_id = data.get('call_id')
         
-        await self.channel_layer.group_send(
-            f'user_{target_id}',
-            {
-                'type': 'answer',
-                'answer': answer,
-                'call_id': call_id,
-                'from_user': self.user_id
-            }
-        )
+        await self.send_to_user(target_id, {
+            'type': 'answer',
+            'answer': answer,
+            'call_id': call_id,
+            'from_user': self.user_id
+        })
         
+    async def send_to_user(self, user_id, payload):
+        """Deliver payload to every socket of user_id; each receiving process encodes it once per format"""
+        with GROUP_SEND_SECONDS.time():
+            await self.channel_layer.group_send(
+                f'user_{user_id}',
+                group_event(payload)
+            )
+
     async def incoming_call(self, event):
-        await self.send(text_data=json.dumps(event))
+        await self.send_encoded(event)
         
     async def call_answered(self, event):
-        await self.send(text_data=json.dumps(event))
+        await self.send_encoded(event)
         
     async def call_rejected(self, event):
-        await self.send(text_data=json.dumps(event))
+        await self.send_encoded(event)
         
     async def call_ended(self, event):
-        await self.send(text_data=json.dumps(event))
+        await self.send_encoded(event)
         
     async def ice_candidate(self, event):
-        await self.send(text_data=json.dumps(event))
+        await self.send_encoded(event)
         
     async def offer(self, event):
-        await self.send(text_data=json.dumps(event))
+        await self.send_encoded(event)
         
     async def answer(self, event):
-        await self.send(text_data=json.dumps(event))
+        await self.send_encoded(event)
         
     @database_sync_to_async
     def get_user(self, user_id):
@@ -214,8 +232,8 @@ class CallConsumer(AsyncWebsocketConsumer):
             return None
             
     @database_sync_to_async
-    def create_call(self, caller, receiver):
-        return Call.objects.create(caller=caller, receiver=receiver, status='initiated')
+    def create_call(self, caller_id, receiver_id):
+        return Call.objects.create(caller_id=caller_id, receiver_id=receiver_id, status='initiated')
         
     @database_sync_to_async
     def update_call_status(self, call_id, status):
@@ -1,3 +1,4 @@
+from django.db.models import Q
 from rest_framework import generics, status
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
@@ -10,13 +11,10 @@ class CallHistoryView(generics.ListAPIView):
     permission_classes = [IsAuthenticated]
     
     def get_queryset(self):
-        return Call.objects.filter(
-            caller=self.request.user
-        ) | Call.objects.filter(
-            receiver=self.request.user
-        )
+        user = self.request.user
+        return Call.objects.filter(Q(caller=user) | Q(receiver=user)).select_related('caller', 'receiver')
 
 class CallDetailView(generics.RetrieveAPIView):
     serializer_class = CallSerializer
     permission_classes = [IsAuthenticated]
-    queryset = Call.objects.all()
+    queryset = Call.objects.select_related('caller', 'receiver')
@@ -0,0 +1,112 @@
+import asyncio
+import logging
+from ChatApp.metrics import database_sync_to_async
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db import connection
+from django.utils import timezone
+from .codec import group_event
+from .models import ReadCursor
+
+logger = logging.getLogger(__name__)
+
+
+def save_read_cursors(cursors):
+    """
+    Upsert {(room_id, user_id): message_id}. The conflict update only applies
+    when it moves the stored cursor forward, so a worker that flushes an older
+    cursor after another worker saved a newer one never moves it backwards.
+    """
+    table = connection.ops.quote_name(ReadCursor._meta.db_table)
+    now = connection.ops.adapt_datetimefield_value(timezone.now())
+    with connection.cursor() as cursor:
+        cursor.executemany(
+            f'INSERT INTO {table} (room_id, user_id, last_read_message_id, updated_at) VALUES (%s, %s, %s, %s) '
+            f'ON CONFLICT (room_id, user_id) DO UPDATE SET '
+            f'last_read_message_id = excluded.last_read_message_id, updated_at = excluded.updated_at '
+            f'WHERE {table}.last_read_message_id < excluded.last_read_message_id',
+            [(room_id, user_id, message_id, now) for (room_id, user_id), message_id in cursors.items()],
+        )
+
+
+class RoomActivity:
+    """
+    Coalesces typing and read_up_to events from this process's sockets.
+
+    Events are collected per room and, at most once every `window` seconds,
+    each room with news gets a single room_activity frame listing who is
+    typing and the new read cursors. Read cursors keep only the highest message
+    id per user and room and are written with one upsert per window. The
+    consumer caps ids at the newest message of the room before queueing them.
+    """
+
+    def __init__(self, window=0.5):
+        self.window = window
+        self._typing = {}
+        self._reads = {}
+        self._cursors = {}
+        self._task = None
+
+    @property
+    def pending(self):
+        return bool(self._typing or self._reads)
+
+    def typing(self, room_name, user_id):
+        self._typing.setdefault(room_name, set()).add(user_id)
+        self._ensure_flusher()
+
+    def read_up_to(self, room_name, room_id, user_id, message_id):
+        reads = self._reads.setdefault(room_name, {})
+        if message_id > reads.get(user_id, 0):
+            reads[user_id] = message_id
+        key = (room_id, user_id)
+        if message_id > self._cursors.get(key, 0):
+            self._cursors[key] = message_id
+        self._ensure_flusher()
+
+    async def flush(self):
+        typing, self._typing = self._typing, {}
+        reads, self._reads = self._reads, {}
+        cursors, self._cursors = self._cursors, {}
+
+        layer = get_channel_layer()
+        for room_name in typing.keys() | reads.keys():
+            await layer.group_send(f'chat_{room_name}', group_event({
+                'type': 'room_activity',
+                'room': room_name,
+                'typing': sorted(typing.get(room_name, ())),
+                'read': [
+                    {'user_id': user_id, 'message_id': message_id}
+                    for user_id, message_id in reads.get(room_name, {}).items()
+                ],
+            }))
+
+        if cursors:
+            try:
+                await database_sync_to_async(save_read_cursors)(cursors)
+            except Exception as e:
+                # Dropped rather than re-queued: a bad cursor would fail every later flush.
+                # Clients send read_up_to again as they read on.
+                logger.error(f"Saving {len(cursors)} read cursors failed, dropped them: {e}")
+
+    def _ensure_flusher(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._run())
+
+    async def _run(self):
+        while self.pending or self._cursors:
+            await asyncio.sleep(self.window)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Room activity flush failed: {e}")
+
+
+_activity = None
+
+
+def get_room_activity():
+    global _activity
+    if _activity is None:
+        _activity = RoomActivity(window=getattr(settings, 'CHAT_ACTIVITY_WINDOW', 0.5))
+    return _activity
@@ -1,5 +1,6 @@
 from django.contrib import admin
-from .models import Message, ChatRoom
+from .models import Message, ChatRoom, MessageArchiveSegment
+from .search import get_search_backend
 
 @admin.register(ChatRoom)
 class ChatRoomAdmin(admin.ModelAdmin):
@@ -7,8 +8,28 @@ class ChatRoomAdmin(admin.ModelAdmin):
     list_filter = ('is_private', 'created_at')
     search_fields = ('name', 'display_name')
 
+    def get_queryset(self, request):
+        return super().get_queryset(request).with_stats()
+
 @admin.register(Message)
 class MessageAdmin(admin.ModelAdmin):
     list_display = ('user', 'room_name', 'content', 'timestamp', 'is_edited')
     list_filter = ('timestamp', 'is_edited')
-    search_fields = ('content', 'user__email')
\ No newline at end of file
+    search_fields = ('content', 'user__email')
+
+    def get_search_results(self, request, queryset, search_term):
+        # Content search goes through the full-text index instead of LIKE '%term%'
+        if not search_term:
+            return queryset, False
+        if '@' in search_term:
+            return queryset.filter(user__email__iexact=search_term.strip()), False
+        return get_search_backend().filter_queryset(queryset, search_term), False
+
+@admin.register(MessageArchiveSegment)
+class MessageArchiveSegmentAdmin(admin.ModelAdmin):
+    list_display = ('room_name', 'first_timestamp', 'last_timestamp', 'message_count', 'created_at')
+    search_fields = ('room_name',)
+    exclude = ('data',)
+
+    def has_change_permission(self, request, obj=None):
+        return False
@@ -0,0 +1,171 @@
+"""
+Archival of old messages into compressed cold segments.
+
+Messages older than a room's threshold are moved out of chat_message into
+MessageArchiveSegment rows, SEGMENT_SIZE messages at a time, so the hot table
+and its indexes only cover recent history. Segments are never rewritten.
+Cursor pagination over a room falls through to the segments once it pages past
+the oldest hot message (see pagination.py). Archived messages can no longer be
+edited, deleted or found by search.
+"""
+import logging
+import zlib
+from datetime import datetime, timedelta
+from functools import lru_cache
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+from . import codec
+from .models import Message, MessageArchiveSegment
+from .serializers import FlatMessageListSerializer
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_DEFAULTS = {
+    'AFTER_DAYS': 90,
+    'ROOMS': {},
+    'SEGMENT_SIZE': 1000,
+}
+
+# Archived rows have the shape of the flat message list rows
+FIELDS = FlatMessageListSerializer.fields
+DATETIME_FIELDS = ('timestamp', 'edited_at')
+
+
+def get_archive_config():
+    config = dict(ARCHIVE_DEFAULTS)
+    config.update(getattr(settings, 'CHAT_ARCHIVE', {}))
+    return config
+
+
+def encode_segment(rows):
+    lines = []
+    for row in rows:
+        row = dict(row)
+        for field in DATETIME_FIELDS:
+            if row[field] is not None:
+                row[field] = row[field].isoformat()
+        lines.append(codec.dumps(row))
+    return zlib.compress('\n'.join(lines).encode(), 6)
+
+
+def decode_segment(data):
+    rows = []
+    for line in zlib.decompress(data).decode().split('\n'):
+        row = codec.loads(line)
+        for field in DATETIME_FIELDS:
+            if row[field] is not None:
+                row[field] = datetime.fromisoformat(row[field])
+        rows.append(row)
+    return rows
+
+
+@lru_cache(maxsize=64)
+def load_segment(segment_id):
+    """Decoded rows of a segment, oldest first; safe to cache because segments never change"""
+    data = MessageArchiveSegment.objects.values_list('data', flat=True).get(id=segment_id)
+    return decode_segment(bytes(data))
+
+
+def archive_room(room_name, before, segment_size=1000):
+    """Move the messages of a room older than `before` into segments; return how many moved"""
+    moved = 0
+    while True:
+        with transaction.atomic():
+            rows = list(
+                Message.objects.filter(room_name=room_name, timestamp__lt=before)
+                .order_by('timestamp', 'id')
+                .values(*FIELDS)[:segment_size]
+            )
+            if not rows:
+                return moved
+            MessageArchiveSegment.objects.create(
+                room_id=next((row['room_id'] for row in rows if row['room_id'] is not None), None),
+                room_name=room_name,
+                first_timestamp=rows[0]['timestamp'],
+                first_id=rows[0]['id'],
+                last_timestamp=rows[-1]['timestamp'],
+                last_id=rows[-1]['id'],
+                message_count=len(rows),
+                data=encode_segment(rows),
+            )
+            Message.objects.filter(id__in=[row['id'] for row in rows]).delete()
+        moved += len(rows)
+        if len(rows) < segment_size:
+            return moved
+
+
+def archive_messages(now=None):
+    """Archive every room past its threshold (CHAT_ARCHIVE); return {room_name: moved}"""
+    config = get_archive_config()
+    now = now or timezone.now()
+    thresholds = [days for days in [config['AFTER_DAYS'], *config['ROOMS'].values()] if days is not None]
+    if not thresholds:
+        return {}
+
+    candidates = (
+        Message.objects.filter(timestamp__lt=now - timedelta(days=min(thresholds)))
+        .order_by().values_list('room_name', flat=True).distinct()
+    )
+    moved = {}
+    for room_name in list(candidates):
+        days = config['ROOMS'].get(room_name, config['AFTER_DAYS'])
+        if days is None:
+            continue
+        count = archive_room(room_name, now - timedelta(days=days), config['SEGMENT_SIZE'])
+        if count:
+            moved[room_name] = count
+            logger.info(f"Archived {count} messages of room {room_name}")
+    return moved
+
+
+def archived_before(room_name, key=None, limit=50):
+    """Up to `limit` archived rows of a room older than the (timestamp, id) key, newest first"""
+    segments = MessageArchiveSegment.objects.filter(room_name=room_name)
+    if key is not None:
+        timestamp, pk = key
+        segments = segments.filter(Q(first_timestamp__lt=timestamp) | Q(first_id__lt=pk),
+                                   first_timestamp__lte=timestamp)
+    segment_ids = list(segments.order_by('-first_timestamp', '-first_id').values_list('id', flat=True)[:limit])
+
+    rows = []
+    for segment_id in segment_ids:
+        for row in reversed(load_segment(segment_id)):
+            if key is None or (row['timestamp'], row['id']) < key:
+                rows.append(row)
+                if len(rows) == limit:
+                    return rows
+    return rows
+
+
+def archived_after(room_name, key, limit=50):
+    """Up to `limit` archived rows of a room newer than the (timestamp, id) key, oldest first"""
+    timestamp, pk = key
+    segment_ids = list(
+        MessageArchiveSegment.objects.filter(
+            Q(last_timestamp__gt=timestamp) | Q(last_id__gt=pk),
+            room_name=room_name, last_timestamp__gte=timestamp,
+        ).order_by('last_timestamp', 'last_id').values_list('id', flat=True)[:limit]
+    )
+
+    rows = []
+    for segment_id in segment_ids:
+        for row in load_segment(segment_id):
+            if (row['timestamp'], row['id']) > key:
+                rows.append(row)
+                if len(rows) == limit:
+                    return rows
+    return rows
+
+
+def archived_key(room_name, message_id):
+    """The (timestamp, id) key of an archived message, or None; relies on ids growing with time"""
+    segment_ids = MessageArchiveSegment.objects.filter(
+        room_name=room_name, first_id__lte=message_id, last_id__gte=message_id,
+    ).values_list('id', flat=True)
+    for segment_id in segment_ids:
+        for row in load_segment(segment_id):
+            if row['id'] == message_id:
+                return row['timestamp'], row['id']
+    return None
@@ -0,0 +1,173 @@
+"""
+Edits and deletes of messages as a per-room change log.
+
+Every edit or delete bumps the message's version and appends a MessageChange.
+The change is broadcast to the room's sockets as a message_updated or
+message_deleted frame. A client that was offline fetches the changes after the
+last one it applied from the changes endpoint. Frames carry the message
+version, so applying one twice or out of order is harmless: a client skips
+any change whose version is not above what it already has. A message that
+has never carried a version is at version 1.
+"""
+import logging
+from datetime import timedelta
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+from .codec import group_event
+from .models import Message, MessageChange
+from .serializers import format_datetime
+
+logger = logging.getLogger(__name__)
+
+CHANGES_DEFAULTS = {
+    'RETENTION_DAYS': 30,
+    'PAGE_SIZE': 500,
+    'COMMIT_MARGIN': 5,
+}
+
+
+def get_changes_config():
+    config = dict(CHANGES_DEFAULTS)
+    config.update(getattr(settings, 'CHAT_CHANGES', {}))
+    return config
+
+
+def change_frame(change):
+    """The wire form of a change, shared by the live frames and the changes endpoint"""
+    frame = {
+        'type': change.kind,
+        'change': change.id,
+        'id': change.message_id,
+        'room': change.room_name,
+        'version': change.version,
+    }
+    if change.kind == MessageChange.UPDATED:
+        frame['content'] = change.content
+        frame['edited_at'] = format_datetime(change.edited_at)
+    return frame
+
+
+def edit_message(message, content):
+    """Save new content as the next version of the message and log the change"""
+    with transaction.atomic():
+        message.content = content
+        message.is_edited = True
+        message.edited_at = timezone.now()
+        message.version = F('version') + 1
+        message.save(update_fields=['content', 'is_edited', 'edited_at', 'version'])
+        message.refresh_from_db(fields=['version'])
+        change = MessageChange.objects.create(
+            room_name=message.room_name, message_id=message.id, version=message.version,
+            kind=MessageChange.UPDATED, content=content, edited_at=message.edited_at,
+        )
+    publish_change(change)
+    return change
+
+
+def delete_message(message):
+    """Delete the message and log the delete as its final version"""
+    with transaction.atomic():
+        version = Message.objects.filter(id=message.id).values_list('version', flat=True).get()
+        change = MessageChange.objects.create(
+            room_name=message.room_name, message_id=message.id, version=version + 1,
+            kind=MessageChange.DELETED,
+        )
+        message.delete()
+    publish_change(change)
+    return change
+
+
+def publish_change(change):
+    """Broadcast a change to the sockets of its room; they also apply it to their history buffers"""
+    frame = change_frame(change)
+    try:
+        async_to_sync(get_channel_layer().group_send)(
+            f'chat_{change.room_name}', group_event(frame)
+        )
+    except Exception as e:
+        logger.error(f"Failed to publish {change.kind} for message {change.message_id}: {e}")
+
+
+def publish_message(message):
+    """
+    Broadcast a message created outside a socket (the REST API) as the same
+    chat_message frame ChatConsumer sends; the room's sockets also add it to
+    their history buffers.
+    """
+    frame = {
+        'type': 'chat_message',
+        'message': message.content,
+        'username': message.user.email,
+        'user_id': message.user_id,
+        'timestamp': message.timestamp.isoformat(),
+        'message_id': message.id,
+    }
+    try:
+        async_to_sync(get_channel_layer().group_send)(f'chat_{message.room_name}', group_event(frame))
+    except Exception as e:
+        logger.error(f"Failed to publish message {message.id}: {e}")
+
+
+def changes_since(room_name, since, limit=500):
+    """
+    (frames, latest, more) for the changes of a room after change id `since`.
+    Several changes of one message in the page collapse into the newest. Once
+    the client is caught up, `latest` is the newest committed change of any
+    room, so a quiet room's cursor does not fall behind what pruning keeps. A
+    `since` taken from a live frame can be ahead of it; `latest` then moves the
+    client back, and changes it already applied come again and are skipped by
+    their version.
+    """
+    latest = committed_change_id()
+    changes = list(
+        MessageChange.objects.filter(room_name=room_name, id__gt=since, id__lte=latest).order_by('id')[:limit + 1]
+    )
+    more = len(changes) > limit
+    changes = changes[:limit]
+    newest = {}
+    for change in changes:
+        newest[change.message_id] = change
+    frames = [change_frame(change) for change in sorted(newest.values(), key=lambda change: change.id)]
+    return frames, changes[-1].id if more else latest, more
+
+
+def latest_change_id():
+    return MessageChange.objects.order_by('-id').values_list('id', flat=True).first() or 0
+
+
+def committed_change_id():
+    """
+    The change id below which no change can still commit. On PostgreSQL a
+    transaction can commit a lower id after a higher one is visible, so changes
+    newer than COMMIT_MARGIN seconds are left for the next request.
+    """
+    before = timezone.now() - timedelta(seconds=get_changes_config()['COMMIT_MARGIN'])
+    committed = MessageChange.objects.filter(created_at__lte=before).order_by('-id').values_list('id', flat=True).first()
+    if committed is None:
+        oldest = oldest_change_id()
+        return oldest - 1 if oldest is not None else 0
+    return committed
+
+
+def oldest_change_id():
+    return MessageChange.objects.order_by('id').values_list('id', flat=True).first()
+
+
+def prune_changes(now=None):
+    """
+    Delete changes older than RETENTION_DAYS; return how many. The newest is
+    always kept, so the oldest remaining id tells clients whether they missed
+    pruned changes.
+    """
+    days = get_changes_config()['RETENTION_DAYS']
+    if days is None:
+        return 0
+    now = now or timezone.now()
+    deleted, _ = MessageChange.objects.filter(
+        created_at__lt=now - timedelta(days=days), id__lt=latest_change_id()
+    ).delete()
+    return deleted
@@ -0,0 +1,147 @@
+"""
+Frame encoding for the chat and call WebSocket consumers.
+
+JSON frames use orjson when it is installed and the stdlib json module
+otherwise. Clients that offer the `chat.msgpack` subprotocol at connect get
+MessagePack encoded binary frames instead.
+"""
+import itertools
+import json
+import uuid
+from collections import OrderedDict
+import msgpack
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+JSON_SUBPROTOCOL = 'chat.json'
+MSGPACK_SUBPROTOCOL = 'chat.msgpack'
+
+if orjson is not None:
+    DecodeError = orjson.JSONDecodeError
+
+    def dumps(obj):
+        return orjson.dumps(obj).decode()
+
+    loads = orjson.loads
+else:
+    DecodeError = json.JSONDecodeError
+    dumps = json.dumps
+    loads = json.loads
+
+
+# Deeper frames are rejected; no signaling or chat payload nests this far
+MAX_DEPTH = 32
+
+
+def json_safe(value, depth=0):
+    """True if value has only JSON types: str keys, no bytes or extension types, 64-bit ints"""
+    if value is None or isinstance(value, (bool, float, str)):
+        return True
+    if isinstance(value, int):
+        return -2 ** 63 <= value < 2 ** 64
+    if depth >= MAX_DEPTH:
+        return False
+    if isinstance(value, (list, tuple)):
+        return all(json_safe(item, depth + 1) for item in value)
+    if isinstance(value, dict):
+        return all(isinstance(key, str) and json_safe(item, depth + 1) for key, item in value.items())
+    return False
+
+
+def packb(obj):
+    return msgpack.packb(obj, use_bin_type=True)
+
+
+def unpackb(data):
+    return msgpack.unpackb(data, raw=False)
+
+
+def group_event(payload):
+    """
+    Wrap payload for group_send. Only the frame travels through the channel
+    layer; each receiving process encodes it on first use per wire format and
+    its other sockets reuse that (see EncodedFrames).
+    """
+    return {'type': payload['type'], 'frame': payload, 'frame_id': f'{_PROCESS}:{next(_frame_ids)}'}
+
+
+_PROCESS = uuid.uuid4().hex[:12]
+_frame_ids = itertools.count()
+
+
+class EncodedFrames:
+    """The encoded forms of recently received group events, by frame id and wire format"""
+
+    def __init__(self, size=1024):
+        self.size = size
+        self._frames = OrderedDict()
+
+    def get(self, event, binary):
+        key = (event['frame_id'], binary)
+        encoded = self._frames.get(key)
+        if encoded is None:
+            encoded = packb(event['frame']) if binary else dumps(event['frame'])
+            self._frames[key] = encoded
+            if len(self._frames) > self.size:
+                self._frames.popitem(last=False)
+        return encoded
+
+
+encoded_frames = EncodedFrames()
+
+
+class CodecMixin:
+    """Negotiates the wire format in connect() and encodes frames to match"""
+    binary = False
+
+    def select_subprotocol(self):
+        offered = self.scope.get('subprotocols') or []
+        if MSGPACK_SUBPROTOCOL in offered:
+            self.binary = True
+            return MSGPACK_SUBPROTOCOL
+        if JSON_SUBPROTOCOL in offered:
+            return JSON_SUBPROTOCOL
+        # Set by JWTAuthMiddleware when the token was sent as a subprotocol
+        return self.scope.get('auth_subprotocol')
+
+    async def accept_negotiated(self):
+        await self.accept(subprotocol=self.select_subprotocol())
+
+    def decode_frame(self, text_data=None, bytes_data=None):
+        """Return the decoded frame; raises ValueError for malformed input"""
+        if bytes_data is not None and self.binary:
+            try:
+                data = unpackb(bytes_data)
+            except Exception as e:
+                raise ValueError(str(e))
+        else:
+            if text_data is None and bytes_data is not None:
+                text_data = bytes_data.decode('utf-8')
+            data = loads(text_data)
+        # Frames are relayed to sockets of both formats, so values only one side
+        # can encode (bytes, non-str keys, ints beyond 64 bits) are malformed
+        if not json_safe(data):
+            raise ValueError('Frame holds values JSON and MessagePack cannot both encode')
+        return data
+
+    def encode_payload(self, payload):
+        """Return send() kwargs for payload in this socket's format"""
+        if self.binary:
+            return {'bytes_data': packb(payload)}
+        return {'text_data': dumps(payload)}
+
+    def encoded_frame(self, event):
+        """Return send() kwargs for an event built with group_event"""
+        if self.binary:
+            return {'bytes_data': encoded_frames.get(event, True)}
+        return {'text_data': encoded_frames.get(event, False)}
+
+    async def send_frame(self, payload):
+        await self.send(**self.encode_payload(payload))
+
+    async def send_encoded(self, event):
+        """Forward a group event, encoded once per process and format (see group_event)"""
+        await self.send(**self.encoded_frame(event))
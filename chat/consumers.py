@@ -1,193 +1,391 @@
-import json
+import logging
+import urllib.parse
 from channels.generic.websocket import AsyncWebsocketConsumer
-from channels.db import database_sync_to_async
+from ChatApp.metrics import database_sync_to_async
 from django.contrib.auth.models import AnonymousUser
 from .models import Message
+from .persistence import WriteBehindFull, get_message_writer
+from .history import get_resync_config, get_room_history, history_item
+from .rooms import resolve_room_id
+from .codec import CodecMixin, group_event
+from .presence import get_presence, room_key
+from .activity import get_room_activity
+from .outbound import OutboundQueue, get_outbound_config
+from .ratelimit import get_rate_limiter
+from ChatApp import metrics
+from ChatApp.log import log_event
+
+logger = logging.getLogger(__name__)
+
+CONNECTIONS = metrics.gauge('ws_connections', 'Open WebSocket connections', ['consumer']).labels('chat')
+FRAMES = metrics.counter('ws_frames_received_total', 'Frames received from clients', ['consumer']).labels('chat')
+MESSAGES = metrics.counter('chat_messages_total', 'Chat messages broadcast to a room')
+RATE_LIMITED = metrics.counter('chat_rate_limited_total', 'Frames and messages refused by the rate limiter',
+                               ['bucket'])
+GROUP_SEND_SECONDS = metrics.histogram('channel_layer_group_send_seconds', 'Latency of channel layer group_send',
+                                       ['consumer']).labels('chat')
+
+class ChatConsumer(CodecMixin, AsyncWebsocketConsumer):
+    outbound = None
+    frame_bucket = None
+    plan_type = None
 
-class ChatConsumer(AsyncWebsocketConsumer):
     async def connect(self):
         self.room_name = self.scope['url_route']['kwargs']['room_name']
         self.room_group_name = f'chat_{self.room_name}'
         
         user = self.scope.get("user", AnonymousUser())
         
-        print(f"WebSocket connection attempt for room: {self.room_name}")
-        print(f"User: {user.email if hasattr(user, 'email') else 'Anonymous'}")
-        
-        if isinstance(user, AnonymousUser):
-            print("Anonymous user connecting - allowing for development")
+        self.room_id = None
+        if not isinstance(user, AnonymousUser):
+            self.room_id = await database_sync_to_async(resolve_room_id)(self.room_name)
+            self.plan_type = await self.get_plan_type(user)
+
+        limiter = get_rate_limiter()
+        if limiter is not None:
+            self.frame_bucket = limiter.connection_bucket(anonymous=isinstance(user, AnonymousUser))
         
         await self.channel_layer.group_add(self.room_group_name, self.channel_name)
-        await self.accept()
+        get_room_history().subscribe(self.room_name)
+        await self.accept_negotiated()
+        CONNECTIONS.inc()
+        config = get_outbound_config()
+        self.outbound = OutboundQueue(
+            self.send_now, self.encode_payload, self.close,
+            max_size=config['MAX_SIZE'], policy=config['POLICY'], send_timeout=config['SEND_TIMEOUT'],
+        )
         
-        print(f"Connection accepted for room: {self.room_name}")
+        log_event(logger, 'ws_connect', room=self.room_name,
+                  user_id=getattr(user, 'id', None), binary=self.binary)
         
-        await self.send(text_data=json.dumps({
+        await self.send_frame({
             'type': 'connection_established',
             'message': f'Welcome! You are now connected to room: {self.room_name}',
             'user': user.email if hasattr(user, 'email') else 'Anonymous',
             'room': self.room_name
-        }))
+        })
         
         if not isinstance(user, AnonymousUser):
-            await self.send_message_history()
+            since = self.resync_since()
+            if since is None:
+                await self.send_message_history()
+            else:
+                await self.send_missed_messages(since)
+            await self.join_presence(user)
 
     async def disconnect(self, close_code):
+        if self.outbound is not None:
+            self.outbound.close()
+            CONNECTIONS.dec()
         if hasattr(self, 'room_group_name'):
             await self.channel_layer.group_discard(self.room_group_name, self.channel_name)
+            get_room_history().unsubscribe(self.room_name)
+            user = self.scope.get("user", AnonymousUser())
+            if not isinstance(user, AnonymousUser):
+                try:
+                    await get_presence().leave(room_key(self.room_name), user.id, self.channel_name)
+                except Exception as e:
+                    logger.error(f"Presence leave failed for room {self.room_name}: {e}")
+            log_event(logger, 'ws_disconnect', room=self.room_name, code=close_code)
 
-    async def receive(self, text_data):
+    async def receive(self, text_data=None, bytes_data=None):
+        FRAMES.inc()
         try:
-            if not text_data or text_data.strip() == "":
-                await self.send(text_data=json.dumps({
-                    'type': 'error',
-                    'message': 'Empty message received'
-                }))
+            # Checked before parsing so a flooding socket costs as little as possible
+            if self.frame_bucket is not None and not self.frame_bucket.take():
+                RATE_LIMITED.labels('connection').inc()
+                await self.send_rate_limited(self.frame_bucket)
                 return
-            
-            if isinstance(text_data, bytes):
-                text_data = text_data.decode('utf-8')
-            
-            try:
-                data = json.loads(text_data)
-            except json.JSONDecodeError:
-                if text_data.strip().startswith('{') and text_data.strip().endswith('}'):
-                    await self.send(text_data=json.dumps({
+
+            if self.binary and bytes_data is not None:
+                try:
+                    data = self.decode_frame(bytes_data=bytes_data)
+                except ValueError:
+                    await self.send_frame({
                         'type': 'error',
-                        'message': 'Malformed JSON'
-                    }))
+                        'message': 'Malformed MessagePack'
+                    })
                     return
-                else:
-                    data = {'message': text_data.strip()}
-            
-            user = self.scope.get("user", AnonymousUser())
-            
-            print(f"Received message from user: {user.email if hasattr(user, 'email') else 'Anonymous'}")
-            
-            if not isinstance(user, AnonymousUser):
-                can_send = await self.check_message_limit(user)
-                if not can_send:
-                    await self.send(text_data=json.dumps({
+            else:
+                if text_data is None and bytes_data is not None:
+                    text_data = bytes_data.decode('utf-8')
+
+                if not text_data or text_data.strip() == "":
+                    await self.send_frame({
                         'type': 'error',
-                        'message': 'Message limit reached. Please upgrade to Pro plan for unlimited messages.',
-                        'error_code': 'MESSAGE_LIMIT_EXCEEDED'
-                    }))
+                        'message': 'Empty message received'
+                    })
                     return
+
+                try:
+                    data = self.decode_frame(text_data=text_data)
+                except ValueError:
+                    if text_data.strip().startswith('{') and text_data.strip().endswith('}'):
+                        await self.send_frame({
+                            'type': 'error',
+                            'message': 'Malformed JSON'
+                        })
+                        return
+                    else:
+                        data = {'message': text_data.strip()}
+            
+            user = self.scope.get("user", AnonymousUser())
             
             user_display = user.email if hasattr(user, 'email') else 'Anonymous'
+
+            if isinstance(data, dict) and data.get('type') in ('typing', 'read_up_to'):
+                await self.handle_activity(user, data)
+                return
             
             message = ""
             if isinstance(data, dict):
-                message = data.get('message', '').strip()
+                message = data.get('message', '')
+                if not isinstance(message, str):
+                    await self.send_frame({
+                        'type': 'error',
+                        'message': 'Message content must be a string'
+                    })
+                    return
+                message = message.strip()
             elif isinstance(data, str):
                 message = data.strip()
             else:
                 message = str(data).strip()
             
             if not message:
-                await self.send(text_data=json.dumps({
+                await self.send_frame({
                     'type': 'error',
                     'message': 'Message content cannot be empty'
-                }))
+                })
                 return
 
+            if not isinstance(user, AnonymousUser):
+                limiter = get_rate_limiter()
+                if limiter is not None:
+                    bucket = limiter.user_bucket(user.id, self.plan_type)
+                    if not bucket.take():
+                        RATE_LIMITED.labels('user').inc()
+                        await self.send_rate_limited(bucket)
+                        return
+
+                can_send = await self.consume_message_quota(user)
+                if not can_send:
+                    await self.send_frame({
+                        'type': 'error',
+                        'message': 'Message limit reached. Please upgrade to Pro plan for unlimited messages.',
+                        'error_code': 'MESSAGE_LIMIT_EXCEEDED'
+                    })
+                    return
+
             message_obj = None
             if not isinstance(user, AnonymousUser):
-                message_obj = await self.save_message(user, self.room_name, message)
-                await self.increment_message_usage(user)
-                print(f"Message saved with ID: {message_obj.id}")
-
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {
-                    'type': 'chat_message',
-                    'message': message,
-                    'username': user_display,
-                    'user_id': user.id if hasattr(user, 'id') else None,
-                    'timestamp': message_obj.timestamp.isoformat() if message_obj else None,
-                    'message_id': message_obj.id if message_obj else None
-                }
-            )
+                writer = get_message_writer()
+                try:
+                    if writer is not None:
+                        message_obj = await writer.submit(user, self.room_name, message, room_id=self.room_id)
+                    else:
+                        message_obj = await self.save_message(user, self.room_name, message, self.room_id)
+                except WriteBehindFull:
+                    await self.refund_message_quota(user)
+                    await self.send_frame({
+                        'type': 'error',
+                        'message': 'Server busy, message not sent. Please try again.',
+                        'error_code': 'SERVER_BUSY'
+                    })
+                    return
+                except Exception:
+                    await self.refund_message_quota(user)
+                    raise
+                get_room_history().append(self.room_name, history_item(
+                    message_obj.id, message, user_display, user.id, message_obj.timestamp.isoformat()
+                ))
+
+            frame = {
+                'type': 'chat_message',
+                'message': message,
+                'username': user_display,
+                'user_id': user.id if hasattr(user, 'id') else None,
+                'timestamp': message_obj.timestamp.isoformat() if message_obj else None,
+                'message_id': message_obj.id if message_obj else None
+            }
+            # Only the frame crosses the channel layer; each receiving process
+            # encodes it once per wire format for all of its sockets
+            with GROUP_SEND_SECONDS.time():
+                await self.channel_layer.group_send(
+                    self.room_group_name,
+                    group_event(frame)
+                )
+            MESSAGES.inc()
+            log_event(logger, 'chat_message', room=self.room_name,
+                      user_id=frame['user_id'], message_id=frame['message_id'])
             
         except Exception as e:
-            print(f"Error in receive method: {e}")
-            await self.send(text_data=json.dumps({
+            logger.exception(f"Error handling message in room {self.room_name}: {e}")
+            await self.send_frame({
                 'type': 'error',
                 'message': 'Server error occurred'
-            }))
+            })
 
     async def chat_message(self, event):
-        await self.send(text_data=json.dumps({
-            'type': 'chat_message',
-            'message': event['message'],
-            'username': event['username'],
-            'user_id': event['user_id'],
-            'timestamp': event['timestamp'],
-            'message_id': event['message_id']
-        }))
+        frame = event['frame']
+        if frame['message_id'] is not None:
+            get_room_history().append(self.room_name, history_item(
+                frame['message_id'], frame['message'], frame['username'],
+                frame['user_id'], frame['timestamp']
+            ))
+        await self.send_encoded(event)
 
     @database_sync_to_async
-    def save_message(self, user, room_name, message):
-        return Message.objects.create(user=user, room_name=room_name, content=message)
+    def save_message(self, user, room_name, message, room_id=None):
+        return Message.objects.create(user_id=user.pk, room_name=room_name, room_id=room_id, content=message)
 
-    @database_sync_to_async
-    def get_recent_messages(self, room_name, limit=20):
-        messages = Message.objects.filter(
-            room_name=room_name
-        ).select_related('user').order_by('-timestamp')[:limit]
-        return list(reversed(messages))
+    async def presence(self, event):
+        await self.send_encoded(event)
+
+    async def room_activity(self, event):
+        # A newer room_activity frame supersedes one the socket has not taken yet
+        await self.send(**self.encoded_frame(event), coalesce_key='room_activity')
+
+    async def send(self, text_data=None, bytes_data=None, close=False, coalesce_key=None):
+        """Queue a frame on the connection's bounded outbound queue"""
+        if self.outbound is None or close:
+            await self.send_now(text_data=text_data, bytes_data=bytes_data, close=close)
+        else:
+            self.outbound.put({'text_data': text_data, 'bytes_data': bytes_data}, key=coalesce_key)
+
+    async def send_now(self, text_data=None, bytes_data=None, close=False):
+        await super().send(text_data=text_data, bytes_data=bytes_data, close=close)
+
+    async def handle_activity(self, user, data):
+        """Queue a typing or read_up_to event; RoomActivity broadcasts them coalesced"""
+        if isinstance(user, AnonymousUser):
+            return
+        if data['type'] == 'typing':
+            get_room_activity().typing(self.room_name, user.id)
+            return
+        message_id = data.get('message_id')
+        if not isinstance(message_id, int) or isinstance(message_id, bool) or message_id <= 0:
+            await self.send_frame({
+                'type': 'error',
+                'message': 'read_up_to needs a positive integer message_id'
+            })
+            return
+        # Clients cannot mark messages read that the room does not have yet
+        history = await get_room_history().get(self.room_name)
+        message_id = min(message_id, history.newest_id())
+        if message_id > 0:
+            get_room_activity().read_up_to(self.room_name, self.room_id, user.id, message_id)
+
+    async def join_presence(self, user):
+        """Register this socket as online and send who else is, once; diffs follow as presence events"""
+        try:
+            presence = get_presence()
+            await presence.join(room_key(self.room_name), user.id, self.channel_name)
+            await self.send_frame({
+                'type': 'presence_state',
+                'room': self.room_name,
+                'online': await presence.aonline(room_key(self.room_name)),
+            })
+        except Exception as e:
+            logger.error(f"Presence join failed for room {self.room_name}: {e}")
+
+    async def message_updated(self, event):
+        get_room_history().apply_change(self.room_name, event['frame'])
+        await self.send_encoded(event)
+
+    message_deleted = message_updated
 
     async def send_message_history(self):
         try:
-            recent_messages = await self.get_recent_messages(self.room_name)
-            
-            if recent_messages:
-                await self.send(text_data=json.dumps({
-                    'type': 'message_history',
-                    'messages': [
-                        {
-                            'id': msg.id,
-                            'message': msg.content,
-                            'username': msg.user.email,
-                            'user_id': msg.user.id,
-                            'timestamp': msg.timestamp.isoformat()
-                        } for msg in recent_messages
-                    ]
-                }))
+            frame = await get_room_history().get_frame(self.room_name, self.binary)
+            if frame:
+                if self.binary:
+                    await self.send(bytes_data=frame)
+                else:
+                    await self.send(text_data=frame)
         except Exception:
             return
 
-    @database_sync_to_async
-    def check_message_limit(self, user):
-        """Check if user can send a message based on their subscription"""
+    def resync_since(self):
+        """The last message id a reconnecting client saw (?since=<id>), or None"""
+        query = urllib.parse.parse_qs(self.scope.get('query_string', b'').decode())
+        try:
+            since = int(query['since'][0])
+        except (KeyError, ValueError):
+            return None
+        return since if since >= 0 else None
+
+    async def send_missed_messages(self, since):
+        """
+        Send exactly the messages after `since` as message_history frames of at
+        most CHUNK_SIZE messages, the last one with more=False. More than
+        MAX_MESSAGES missed gets a resync frame instead; the client then pages
+        through the REST room_messages endpoint. Live messages can overlap
+        the last chunk, so clients apply messages by id.
+        """
+        config = get_resync_config()
+        try:
+            messages = await get_room_history().missed(self.room_name, since, config['MAX_MESSAGES'])
+        except Exception as e:
+            logger.error(f"Resync failed for room {self.room_name}: {e}")
+            messages = None
+
+        if messages is None:
+            await self.send_frame({'type': 'resync', 'reason': 'gap_too_large', 'since': since})
+            return
+        size = config['CHUNK_SIZE']
+        for start in range(0, max(len(messages), 1), size):
+            await self.send_frame({
+                'type': 'message_history',
+                'since': since,
+                'messages': messages[start:start + size],
+                'more': start + size < len(messages),
+            })
+
+    async def send_rate_limited(self, bucket):
+        await self.send_frame({
+            'type': 'error',
+            'message': 'Too many messages. Please slow down.',
+            'error_code': 'RATE_LIMITED',
+            'retry_after': round(bucket.retry_after(), 2)
+        })
+
+    async def get_plan_type(self, user):
+        """The user's plan type for rate limiting, loaded once per connection"""
         try:
-            from payments.models import MessageUsage
-            message_usage, created = MessageUsage.objects.get_or_create(user=user)
-            return message_usage.can_send_message()
+            from payments.quota import get_message_quota
+            return await get_message_quota().aget_plan(user.id)
         except Exception as e:
-            print(f"Error checking message limit: {e}")
+            logger.error(f"Error loading plan for user {user.id}: {e}")
+            return 'free'
+
+    async def consume_message_quota(self, user):
+        """Check the user's daily limit and count this message in one atomic step"""
+        try:
+            from payments.quota import get_message_quota
+            return await get_message_quota().aconsume(user)
+        except Exception as e:
+            logger.error(f"Error checking message limit for user {user.id}: {e}")
             return True
 
-    @database_sync_to_async
-    def increment_message_usage(self, user):
-        """Increment message usage count for the user"""
+    async def refund_message_quota(self, user):
+        """Give back the quota counted for a message that was not saved"""
         try:
-            from payments.models import MessageUsage
-            message_usage, created = MessageUsage.objects.get_or_create(user=user)
-            message_usage.increment_usage()
+            from payments.quota import get_message_quota
+            await get_message_quota().arefund(user)
         except Exception as e:
-            print(f"Error incrementing message usage: {e}")
+            logger.error(f"Error refunding message limit for user {user.id}: {e}")
 
     @database_sync_to_async
     def get_user_message_status(self, user):
         """Get user's message sending status and subscription info"""
         try:
             from payments.models import MessageUsage, UserSubscription
-            message_usage, created = MessageUsage.objects.get_or_create(user=user)
+            message_usage, created = MessageUsage.objects.get_or_create(user_id=user.pk)
             
             subscription_type = 'free'
             try:
-                subscription = UserSubscription.objects.get(user=user)
+                subscription = UserSubscription.objects.get(user_id=user.pk)
                 if subscription.is_active_subscription():
                     subscription_type = subscription.plan.plan_type
             except UserSubscription.DoesNotExist:
@@ -200,7 +398,7 @@ class ChatConsumer(AsyncWebsocketConsumer):
                 'remaining_messages': message_usage.get_remaining_messages(),
             }
         except Exception as e:
-            print(f"Error getting user message status: {e}")
+            logger.error(f"Error getting message status for user {user.id}: {e}")
             return {
                 'can_send_message': True,
                 'subscription_type': 'unknown'
@@ -0,0 +1,77 @@
+"""
+Streaming NDJSON export of a room's history.
+
+Rows are produced in chunks: archive segments one at a time, then the hot
+table through a database iterator, so memory use depends on the chunk size
+and not on the size of the room. Each line is one message in the flat list
+format, oldest first.
+"""
+import zlib
+from asgiref.sync import sync_to_async
+from django.db.models import Q
+from . import codec
+from .archive import FIELDS, archived_key, decode_segment
+from .models import Message, MessageArchiveSegment
+from .serializers import FlatMessageListSerializer
+
+
+def message_key(room_name, message_id):
+    """The (timestamp, id) key of a hot or archived message of a room, or None"""
+    row = Message.objects.filter(room_name=room_name, id=message_id).values_list('timestamp', 'id').first()
+    return row or archived_key(room_name, message_id)
+
+
+def room_row_chunks(room_name, after=None, chunk_size=2000):
+    """Yield lists of flat rows of a room newer than the (timestamp, id) key `after`"""
+    segments = MessageArchiveSegment.objects.filter(room_name=room_name)
+    if after is not None:
+        timestamp, pk = after
+        segments = segments.filter(Q(last_timestamp__gt=timestamp) | Q(last_id__gt=pk),
+                                   last_timestamp__gte=timestamp)
+    # Decoded directly rather than through load_segment, so an export does not
+    # evict the segments that paginated reads are using
+    for segment_id in list(segments.order_by('first_timestamp', 'first_id').values_list('id', flat=True)):
+        data = MessageArchiveSegment.objects.values_list('data', flat=True).get(id=segment_id)
+        rows = decode_segment(bytes(data))
+        if after is not None:
+            rows = [row for row in rows if (row['timestamp'], row['id']) > after]
+        if rows:
+            yield rows
+
+    messages = Message.objects.filter(room_name=room_name)
+    if after is not None:
+        timestamp, pk = after
+        messages = messages.filter(Q(timestamp__gt=timestamp) | Q(id__gt=pk), timestamp__gte=timestamp)
+    chunk = []
+    for row in messages.order_by('timestamp', 'id').values(*FIELDS).iterator(chunk_size=chunk_size):
+        chunk.append(row)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def ndjson_chunks(row_chunks, compress=False):
+    """Encode chunks of flat rows as NDJSON bytes, optionally as one gzip stream"""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None
+    for rows in row_chunks:
+        data = ''.join(codec.dumps(item) + '\n' for item in FlatMessageListSerializer(rows).data).encode()
+        if compressor is not None:
+            data = compressor.compress(data)
+        if data:
+            yield data
+    if compressor is not None:
+        yield compressor.flush()
+
+
+async def aiter_chunks(chunks):
+    """
+    Drive a synchronous chunk iterator from the event loop. Django buffers a
+    synchronous StreamingHttpResponse completely before sending it under ASGI.
+    """
+    while True:
+        chunk = await sync_to_async(next)(chunks, None)
+        if chunk is None:
+            return
+        yield chunk
@@ -0,0 +1,235 @@
+import asyncio
+from collections import deque, Counter
+from ChatApp import metrics
+from ChatApp.metrics import database_sync_to_async
+from django.conf import settings
+from django.db.models import Q
+from .models import Message, MessageArchiveSegment, MessageChange
+from . import codec
+
+RESYNC_DEFAULTS = {
+    'MAX_MESSAGES': 500,
+    'CHUNK_SIZE': 100,
+}
+
+RESYNCS = metrics.counter('chat_resync_total', 'Reconnects with ?since= by where the missed messages came from',
+                          ['source'])
+
+
+def get_resync_config():
+    config = dict(RESYNC_DEFAULTS)
+    config.update(getattr(settings, 'CHAT_RESYNC', {}))
+    return config
+
+
+def history_item(message_id, content, username, user_id, timestamp):
+    return {
+        'id': message_id,
+        'message': content,
+        'username': username,
+        'user_id': user_id,
+        'timestamp': timestamp,
+    }
+
+
+class RoomHistory:
+    """The last `size` messages of one room plus the encoded history frames"""
+
+    def __init__(self, size):
+        self.messages = deque(maxlen=size)
+        self._ids = set()
+        self._frames = {}
+
+    def append(self, item):
+        if item['id'] in self._ids:
+            return
+        if len(self.messages) == self.messages.maxlen:
+            self._ids.discard(self.messages[0]['id'])
+        self.messages.append(item)
+        self._ids.add(item['id'])
+        self._frames = {}
+
+    def after(self, message_id):
+        """The buffered messages newer than message_id, or None if it is not buffered"""
+        if message_id not in self._ids:
+            return None
+        items = list(self.messages)
+        index = next(i for i, item in enumerate(items) if item['id'] == message_id)
+        return items[index + 1:]
+
+    def newest_id(self):
+        return max(self._ids, default=0)
+
+    def apply_change(self, change):
+        """Apply a message_updated/message_deleted frame in place unless the buffer already has that version"""
+        if change['id'] not in self._ids:
+            return
+        for index, item in enumerate(self.messages):
+            if item['id'] == change['id']:
+                if item.get('version', 1) >= change['version']:
+                    return
+                if change['type'] == MessageChange.DELETED:
+                    del self.messages[index]
+                    self._ids.discard(change['id'])
+                else:
+                    self.messages[index] = dict(item, message=change['content'], version=change['version'])
+                self._frames = {}
+                return
+
+    def frame(self, binary=False):
+        if binary not in self._frames:
+            payload = {'type': 'message_history', 'messages': list(self.messages)}
+            self._frames[binary] = codec.packb(payload) if binary else codec.dumps(payload)
+        return self._frames[binary]
+
+
+class RoomHistoryCache:
+    """
+    Process-local ring buffers of recent messages, one per room that has a
+    connected socket in this process. A room is loaded from the database once,
+    on first use; after that it is kept current from the room's group messages,
+    so connects are served from memory. When the last local socket of a room
+    disconnects the buffer is dropped, because it would stop receiving updates.
+    """
+
+    def __init__(self, size=20):
+        self.size = size
+        self._rooms = {}
+        self._subscribers = Counter()
+        self._loading = {}
+        self._early = {}
+        self._generation = Counter()
+
+    def subscribe(self, room_name):
+        self._subscribers[room_name] += 1
+
+    def unsubscribe(self, room_name):
+        self._subscribers[room_name] -= 1
+        if self._subscribers[room_name] <= 0:
+            del self._subscribers[room_name]
+            self._rooms.pop(room_name, None)
+
+    def append(self, room_name, item):
+        history = self._rooms.get(room_name)
+        if history is not None:
+            history.append(item)
+        elif room_name in self._loading:
+            self._early.setdefault(room_name, []).append(item)
+
+    def apply_change(self, room_name, change):
+        history = self._rooms.get(room_name)
+        if history is not None:
+            history.apply_change(change)
+        elif room_name in self._loading:
+            # The rows being loaded may predate the change
+            self.invalidate(room_name)
+
+    def invalidate(self, room_name):
+        self._rooms.pop(room_name, None)
+        self._generation[room_name] += 1
+
+    async def get(self, room_name):
+        history = self._rooms.get(room_name)
+        if history is not None:
+            return history
+        loading = self._loading.get(room_name)
+        if loading is None:
+            loading = asyncio.ensure_future(self._warm(room_name))
+            self._loading[room_name] = loading
+        return await asyncio.shield(loading)
+
+    async def get_frame(self, room_name, binary=False):
+        """Return the encoded message_history frame, or None for an empty room"""
+        history = await self.get(room_name)
+        return history.frame(binary) if history.messages else None
+
+    async def missed(self, room_name, since, limit):
+        """
+        The messages of a room after message id `since`, oldest first, or None
+        when more than `limit` were missed (or some are archived). Served from
+        the buffer when `since` is still in it; otherwise one query, merged with
+        the buffer so messages still waiting in write-behind are included.
+        """
+        history = await self.get(room_name)
+        items = history.after(since)
+        if items is not None:
+            RESYNCS.labels('memory').inc()
+            return items
+        items = await database_sync_to_async(load_items_after)(room_name, since, limit)
+        if items is not None:
+            seen = {item['id'] for item in items}
+            items += [item for item in history.messages if item['id'] > since and item['id'] not in seen]
+            items.sort(key=lambda item: (item['timestamp'], item['id']))
+        if items is None or len(items) > limit:
+            RESYNCS.labels('gap').inc()
+            return None
+        RESYNCS.labels('database').inc()
+        return items
+
+    async def _warm(self, room_name):
+        generation = self._generation[room_name]
+        try:
+            items = await self.load_recent(room_name)
+            history = RoomHistory(self.size)
+            for item in items + self._early.pop(room_name, []):
+                history.append(item)
+            if self._subscribers[room_name] > 0 and generation == self._generation[room_name]:
+                self._rooms[room_name] = history
+            return history
+        finally:
+            self._loading.pop(room_name, None)
+            self._early.pop(room_name, None)
+
+    @database_sync_to_async
+    def load_recent(self, room_name):
+        return load_recent_items(room_name, self.size)
+
+
+def load_recent_items(room_name, limit):
+    rows = Message.objects.filter(room_name=room_name).order_by('-timestamp', '-id').values(
+        'id', 'content', 'user_id', 'user__email', 'timestamp'
+    )[:limit]
+    return [
+        history_item(
+            row['id'], row['content'], row['user__email'] or 'Anonymous',
+            row['user_id'], row['timestamp'].isoformat()
+        )
+        for row in reversed(list(rows))
+    ]
+
+
+def load_items_after(room_name, since, limit):
+    """Up to `limit` stored messages of a room with an id above `since`, or None if there are more"""
+    if MessageArchiveSegment.objects.filter(room_name=room_name, last_id__gt=since).exists():
+        return None
+    messages = Message.objects.filter(room_name=room_name)
+    timestamp = Message.objects.filter(id=since).values_list('timestamp', flat=True).first()
+    if timestamp is not None:
+        # Seek on (room_name, timestamp, id) instead of scanning the room for larger ids
+        messages = messages.filter(Q(timestamp__gt=timestamp) | Q(timestamp=timestamp, id__gt=since))
+    else:
+        messages = messages.filter(id__gt=since)
+    rows = list(
+        messages.order_by('timestamp', 'id').values(
+            'id', 'content', 'user_id', 'user__email', 'timestamp'
+        )[:limit + 1]
+    )
+    if len(rows) > limit:
+        return None
+    return [
+        history_item(
+            row['id'], row['content'], row['user__email'] or 'Anonymous',
+            row['user_id'], row['timestamp'].isoformat()
+        )
+        for row in rows
+    ]
+
+
+_room_history = None
+
+
+def get_room_history():
+    global _room_history
+    if _room_history is None:
+        _room_history = RoomHistoryCache(size=getattr(settings, 'CHAT_HISTORY_SIZE', 20))
+    return _room_history
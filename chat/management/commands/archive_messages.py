@@ -0,0 +1,34 @@
+import time
+from django.core.management.base import BaseCommand
+from django.db import connection
+from chat.archive import archive_messages
+from chat.changes import prune_changes
+
+
+class Command(BaseCommand):
+    help = ('Move messages older than their room threshold (CHAT_ARCHIVE) into compressed archive segments '
+            'and prune the message change log (CHAT_CHANGES)')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float, default=None,
+                            help='Keep running, archiving every INTERVAL seconds')
+        parser.add_argument('--vacuum', action='store_true',
+                            help='VACUUM an SQLite database afterwards so the file shrinks')
+
+    def handle(self, *args, **options):
+        while True:
+            moved = archive_messages()
+            for room_name, count in sorted(moved.items()):
+                self.stdout.write(f'{room_name}: archived {count} messages')
+            self.stdout.write(self.style.SUCCESS(f'Archived {sum(moved.values())} messages'))
+            pruned = prune_changes()
+            if pruned:
+                self.stdout.write(f'Pruned {pruned} message changes')
+
+            if options['vacuum'] and moved and connection.vendor == 'sqlite':
+                with connection.cursor() as cursor:
+                    cursor.execute('VACUUM')
+
+            if options['interval'] is None:
+                return
+            time.sleep(options['interval'])
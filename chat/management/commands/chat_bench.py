@@ -0,0 +1,146 @@
+import asyncio
+import json
+import statistics
+import time
+from channels.db import database_sync_to_async
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from rest_framework_simplejwt.tokens import AccessToken
+from chat.consumers import ChatConsumer
+from chat.codec import group_event
+from chat.middleware import JWTAuthMiddleware, user_snapshots
+from chat.models import ChatRoom
+from chat.routing import websocket_urlpatterns
+
+
+class BenchConsumer(ChatConsumer):
+    """ChatConsumer whose socket is a counter, so only handler CPU is measured"""
+
+    def __init__(self, room_name):
+        super().__init__()
+        self.room_name = room_name
+        self.frames = 0
+
+    async def send(self, text_data=None, bytes_data=None, close=False, coalesce_key=None):
+        self.frames += 1
+
+
+def legacy_chat_message_frame(event):
+    """The per-receiver encoding ChatConsumer.chat_message used to do"""
+    return json.dumps({
+        'type': 'chat_message',
+        'message': event['message'],
+        'username': event['username'],
+        'user_id': event['user_id'],
+        'timestamp': event['timestamp'],
+        'message_id': event['message_id']
+    })
+
+
+async def bench_fanout(room_sizes, rounds, message_size):
+    results = []
+    for room_size in room_sizes:
+        receivers = [BenchConsumer('bench') for _ in range(room_size)]
+        frame = {
+            'type': 'chat_message',
+            'message': 'x' * message_size,
+            'username': 'bench@example.com',
+            'user_id': 1,
+            'timestamp': '2025-01-01T00:00:00+00:00',
+            'message_id': None,
+        }
+
+        start = time.process_time()
+        for _ in range(rounds):
+            for receiver in receivers:
+                await receiver.send(text_data=legacy_chat_message_frame(frame))
+        legacy = (time.process_time() - start) / rounds
+
+        start = time.process_time()
+        for _ in range(rounds):
+            event = group_event(frame)
+            for receiver in receivers:
+                await receiver.chat_message(event)
+        serialize_once = (time.process_time() - start) / rounds
+
+        results.append({
+            'room_size': room_size,
+            'legacy_cpu_ms_per_broadcast': round(legacy * 1000, 4),
+            'serialize_once_cpu_ms_per_broadcast': round(serialize_once * 1000, 4),
+            'legacy_cpu_us_per_receiver': round(legacy * 1e6 / room_size, 4),
+            'serialize_once_cpu_us_per_receiver': round(serialize_once * 1e6 / room_size, 4),
+        })
+    return results
+
+
+def latency_summary(samples):
+    samples = sorted(samples)
+    return {
+        'mean_ms': round(statistics.mean(samples) * 1000, 3),
+        'p50_ms': round(samples[len(samples) // 2] * 1000, 3),
+        'p95_ms': round(samples[int(len(samples) * 0.95)] * 1000, 3),
+        'p99_ms': round(samples[int(len(samples) * 0.99)] * 1000, 3),
+        'max_ms': round(samples[-1] * 1000, 3),
+    }
+
+
+async def bench_handshake(rounds):
+    """Authenticated connects through JWTAuthMiddleware, with and without the user cache"""
+    user, created = await database_sync_to_async(get_user_model().objects.get_or_create)(
+        email='chat-bench@example.com'
+    )
+    token = str(AccessToken.for_user(user))
+    application = JWTAuthMiddleware(URLRouter(websocket_urlpatterns))
+
+    async def handshake():
+        socket = WebsocketCommunicator(application, f'/ws/chat/bench/?token={token}')
+        start = time.perf_counter()
+        await socket.connect()
+        await socket.receive_from()
+        elapsed = time.perf_counter() - start
+        await socket.disconnect()
+        return elapsed
+
+    await handshake()  # warm up the room id and history caches
+    results = []
+    try:
+        for mode in ('uncached', 'cached'):
+            samples = []
+            for _ in range(rounds):
+                if mode == 'uncached':
+                    user_snapshots.clear()
+                samples.append(await handshake())
+            results.append(dict(mode=mode, handshakes=rounds, **latency_summary(samples)))
+    finally:
+        await database_sync_to_async(ChatRoom.objects.filter(name='bench').delete)()
+        if created:
+            await database_sync_to_async(user.delete)()
+    return results
+
+
+class Command(BaseCommand):
+    help = 'Run chat micro-benchmarks and print the results as JSON'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--scenario', choices=['fanout', 'handshake'], default='fanout')
+        parser.add_argument('--room-sizes', default='10,100,1000,5000',
+                            help='Comma separated receiver counts for the fanout scenario')
+        parser.add_argument('--rounds', type=int, default=20,
+                            help='Broadcasts per room size, or handshakes per mode')
+        parser.add_argument('--message-size', type=int, default=200)
+        parser.add_argument('--output', help='Also write the JSON report to this file')
+
+    def handle(self, *args, **options):
+        if options['scenario'] == 'fanout':
+            room_sizes = [int(size) for size in options['room_sizes'].split(',')]
+            results = asyncio.run(bench_fanout(room_sizes, options['rounds'], options['message_size']))
+        elif options['scenario'] == 'handshake':
+            results = asyncio.run(bench_handshake(options['rounds']))
+
+        report = json.dumps({'scenario': options['scenario'], 'results': results}, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(report)
+        self.stdout.write(report)
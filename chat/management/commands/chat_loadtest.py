@@ -0,0 +1,386 @@
+import asyncio
+import itertools
+import json
+import subprocess
+import time
+from contextlib import contextmanager
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import override_settings
+from rest_framework_simplejwt.tokens import AccessToken
+from chat import ratelimit
+from chat.management.commands.chat_bench import latency_summary
+from chat.models import ChatRoom, Message
+from payments.models import SubscriptionPlan, UserSubscription
+
+EMAIL_PREFIX = 'loadtest-'
+ROOM_PREFIX = 'loadtest-'
+
+
+class InProcessSocket:
+    """A WebSocket to the ASGI application of this process (channels' WebsocketCommunicator)"""
+
+    def __init__(self, application, path):
+        self.socket = WebsocketCommunicator(application, path)
+
+    async def connect(self):
+        connected, _ = await self.socket.connect(timeout=30)
+        if not connected:
+            raise ConnectionError('Connection rejected')
+
+    async def send(self, payload):
+        await self.socket.send_to(text_data=json.dumps(payload))
+
+    async def receive(self):
+        return json.loads(await self.socket.receive_from(timeout=3600))
+
+    async def close(self):
+        await self.socket.disconnect()
+
+
+class LiveSocket:
+    """A real WebSocket to a running server, e.g. daphne on ws://127.0.0.1:8000"""
+
+    def __init__(self, base_url, path):
+        self.url = base_url.rstrip('/') + path
+        self.socket = None
+
+    async def connect(self):
+        from websockets.asyncio.client import connect
+        self.socket = await connect(self.url, max_size=None, open_timeout=30)
+
+    async def send(self, payload):
+        await self.socket.send(json.dumps(payload))
+
+    async def receive(self):
+        return json.loads(await self.socket.recv())
+
+    async def close(self):
+        await self.socket.close()
+
+
+class Probes:
+    """
+    Send times of probe frames and the latencies of their deliveries.
+
+    A probe is a chat message `probe:<n>` or an ice_candidate `{'probe': n}`;
+    every socket that receives one records now - send time, so the samples are
+    end-to-end fan-out latencies.
+    """
+
+    def __init__(self):
+        self._ids = itertools.count()
+        self.sent_at = {}
+        self.latencies = []
+        self.expected = 0
+        self.errors = 0
+        self._done = asyncio.Event()
+
+    def new(self, receivers):
+        probe_id = next(self._ids)
+        self.expected += receivers
+        self.sent_at[probe_id] = time.perf_counter()
+        return probe_id
+
+    def observe(self, frame):
+        probe_id = None
+        if frame.get('type') == 'chat_message' and str(frame.get('message', '')).startswith('probe:'):
+            probe_id = int(frame['message'][len('probe:'):])
+        elif frame.get('type') == 'ice_candidate' and isinstance(frame.get('candidate'), dict):
+            probe_id = frame['candidate'].get('probe')
+        elif frame.get('type') == 'error':
+            self.errors += 1
+        if probe_id in self.sent_at:
+            self.latencies.append(time.perf_counter() - self.sent_at[probe_id])
+            if len(self.latencies) >= self.expected:
+                self._done.set()
+
+    async def wait(self, timeout):
+        if len(self.latencies) < self.expected:
+            self._done.clear()
+            try:
+                await asyncio.wait_for(self._done.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+
+class Client:
+    """One simulated user: a socket and a task that reads every frame sent to it"""
+
+    def __init__(self, socket, probes):
+        self.socket = socket
+        self.probes = probes
+        self.frames = asyncio.Queue()
+        self._reader = None
+
+    async def connect(self, greeting=True):
+        """Connect and, for chat sockets, wait for connection_established; return the handshake time"""
+        start = time.perf_counter()
+        await self.socket.connect()
+        if greeting:
+            await self.socket.receive()
+        elapsed = time.perf_counter() - start
+        self._reader = asyncio.ensure_future(self._read())
+        return elapsed
+
+    async def _read(self):
+        try:
+            while True:
+                frame = await self.socket.receive()
+                self.probes.observe(frame)
+                await self.frames.put(frame)
+        except asyncio.CancelledError:
+            pass
+        except Exception:
+            pass
+
+    async def wait_for(self, frame_type, timeout=30):
+        while True:
+            frame = await asyncio.wait_for(self.frames.get(), timeout)
+            if frame.get('type') == frame_type:
+                return frame
+
+    async def close(self):
+        if self._reader is not None:
+            self._reader.cancel()
+        try:
+            await self.socket.close()
+        except Exception:
+            pass
+
+
+class LoadTest:
+    def __init__(self, users, url=None, timeout=60):
+        self.users = users
+        self.url = url
+        self.timeout = timeout
+        self.probes = Probes()
+        self._application = None
+
+    def socket(self, path, user):
+        path = f"{path}?token={user['token']}"
+        if self.url:
+            return LiveSocket(self.url, path)
+        if self._application is None:
+            from ChatApp.asgi import application
+            self._application = application
+        return InProcessSocket(self._application, path)
+
+    async def connect_all(self, paths):
+        """Connect one client per (path, user) concurrently; return clients and handshake times"""
+        clients = [Client(self.socket(path, user), self.probes) for path, user in paths]
+        # Call sockets send nothing until something happens
+        handshakes = await asyncio.gather(*(
+            client.connect(greeting=path.startswith('/ws/chat/')) for client, (path, _) in zip(clients, paths)
+        ))
+        return clients, handshakes
+
+    async def close_all(self, clients):
+        await asyncio.gather(*(client.close() for client in clients))
+
+    async def chat_rounds(self, rooms, senders_per_room, messages):
+        """Every sender sends `messages` probes into its room; return messages/sec"""
+        sends = []
+        for clients in rooms:
+            for sender in clients[:senders_per_room]:
+                sends.append((sender, len(clients)))
+        start = time.perf_counter()
+        for _ in range(messages):
+            for sender, receivers in sends:
+                probe_id = self.probes.new(receivers)
+                await sender.socket.send({'message': f'probe:{probe_id}'})
+        await self.probes.wait(self.timeout)
+        elapsed = time.perf_counter() - start
+        return len(sends) * messages, elapsed
+
+    def report(self, **fields):
+        report = dict(fields)
+        report['deliveries'] = len(self.probes.latencies)
+        report['expected_deliveries'] = self.probes.expected
+        report['errors'] = self.probes.errors
+        if self.probes.latencies:
+            report['fanout_latency'] = latency_summary(self.probes.latencies)
+        return report
+
+    async def connect_storm(self, clients, rooms):
+        paths = [(f'/ws/chat/{ROOM_PREFIX}{i % rooms}/', user) for i, user in zip(range(clients), self.users)]
+        start = time.perf_counter()
+        connected, handshakes = await self.connect_all(paths)
+        elapsed = time.perf_counter() - start
+        await self.close_all(connected)
+        return self.report(
+            clients=clients,
+            connects_per_sec=round(clients / elapsed, 2),
+            handshake_latency=latency_summary(handshakes),
+        )
+
+    async def hot_room(self, clients, senders, messages):
+        paths = [(f'/ws/chat/{ROOM_PREFIX}hot/', user) for user in self.users[:clients]]
+        connected, _ = await self.connect_all(paths)
+        try:
+            sent, elapsed = await self.chat_rounds([connected], senders, messages)
+        finally:
+            await self.close_all(connected)
+        return self.report(
+            clients=clients, senders=senders, messages=sent,
+            messages_per_sec=round(sent / elapsed, 2),
+            deliveries_per_sec=round(len(self.probes.latencies) / elapsed, 2),
+        )
+
+    async def cold_rooms(self, clients, rooms, messages):
+        paths = [(f'/ws/chat/{ROOM_PREFIX}cold-{i % rooms}/', user) for i, user in zip(range(clients), self.users)]
+        connected, _ = await self.connect_all(paths)
+        by_room = [connected[i::rooms] for i in range(rooms)]
+        try:
+            sent, elapsed = await self.chat_rounds(by_room, 1, messages)
+        finally:
+            await self.close_all(connected)
+        return self.report(
+            clients=clients, rooms=rooms, messages=sent,
+            messages_per_sec=round(sent / elapsed, 2),
+            deliveries_per_sec=round(len(self.probes.latencies) / elapsed, 2),
+        )
+
+    async def call_burst(self, clients, messages):
+        """Caller/callee pairs: a call_initiate, then a burst of ice_candidate relays per pair"""
+        pairs = clients // 2
+        connected, _ = await self.connect_all([('/ws/call/', user) for user in self.users[:pairs * 2]])
+        callers, callees = connected[:pairs], connected[pairs:]
+        try:
+            start = time.perf_counter()
+            for caller, callee_user in zip(callers, self.users[pairs:pairs * 2]):
+                await caller.socket.send({'type': 'call_initiate', 'receiver_id': callee_user['id']})
+            await asyncio.gather(*(callee.wait_for('incoming_call') for callee in callees))
+            setup = time.perf_counter() - start
+
+            start = time.perf_counter()
+            for _ in range(messages):
+                for caller, callee_user in zip(callers, self.users[pairs:pairs * 2]):
+                    probe_id = self.probes.new(1)
+                    await caller.socket.send({
+                        'type': 'ice_candidate', 'target_id': callee_user['id'], 'candidate': {'probe': probe_id},
+                    })
+            await self.probes.wait(self.timeout)
+            elapsed = time.perf_counter() - start
+        finally:
+            await self.close_all(connected)
+        return self.report(
+            clients=pairs * 2,
+            calls_per_sec=round(pairs / setup, 2),
+            messages=pairs * messages,
+            messages_per_sec=round(pairs * messages / elapsed, 2),
+        )
+
+
+def create_users(count):
+    """Load-test users with an unlimited plan, so the daily message quota never applies"""
+    plan, _ = SubscriptionPlan.objects.get_or_create(
+        name='Load test', plan_type='pro',
+        defaults={'price': 0, 'duration_days': 0, 'message_limit': None, 'is_active': False},
+    )
+    User = get_user_model()
+    users = []
+    for i in range(count):
+        user, created = User.objects.get_or_create(email=f'{EMAIL_PREFIX}{i}@example.com')
+        if created:
+            user.set_unusable_password()
+            user.save(update_fields=['password'])
+        UserSubscription.objects.get_or_create(user=user, defaults={'plan': plan})
+        users.append({'id': user.id, 'token': str(AccessToken.for_user(user))})
+    return users
+
+
+def cleanup():
+    Message.objects.filter(room_name__startswith=ROOM_PREFIX).delete()
+    ChatRoom.objects.filter(name__startswith=ROOM_PREFIX).delete()
+    get_user_model().objects.filter(email__startswith=EMAIL_PREFIX).delete()
+    SubscriptionPlan.objects.filter(name='Load test', is_active=False).delete()
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True,
+            cwd=settings.BASE_DIR,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+@contextmanager
+def without_rate_limits():
+    """The in-process server runs without socket rate limits, which would cap every sender"""
+    with override_settings(CHAT_RATE_LIMIT=dict(settings.CHAT_RATE_LIMIT, ENABLED=False)):
+        ratelimit._limiter = None
+        try:
+            yield
+        finally:
+            ratelimit._limiter = None
+
+
+class Command(BaseCommand):
+    help = 'Drive simulated WebSocket clients against the chat and call consumers and print a JSON report'
+
+    scenarios = ('connect_storm', 'hot_room', 'cold_rooms', 'call_burst')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--scenario', choices=self.scenarios + ('all',), default='all')
+        parser.add_argument('--clients', type=int, default=200)
+        parser.add_argument('--rooms', type=int, default=50,
+                            help='Rooms for connect_storm and cold_rooms')
+        parser.add_argument('--senders', type=int, default=5, help='Senders in hot_room')
+        parser.add_argument('--messages', type=int, default=20,
+                            help='Messages per sender (per caller in call_burst)')
+        parser.add_argument('--url', help='Target a running server, e.g. ws://127.0.0.1:8000, '
+                                          'instead of the application in this process')
+        parser.add_argument('--timeout', type=float, default=60,
+                            help='Seconds to wait for outstanding deliveries')
+        parser.add_argument('--keep-data', action='store_true',
+                            help='Keep the load-test users, rooms and messages')
+        parser.add_argument('--output', help='Also write the JSON report to this file')
+
+    def handle(self, *args, **options):
+        if options['clients'] < 2:
+            raise CommandError('--clients must be at least 2')
+        scenarios = self.scenarios if options['scenario'] == 'all' else (options['scenario'],)
+        users = create_users(options['clients'])
+        try:
+            if options['url']:
+                results = asyncio.run(self.run(scenarios, users, options))
+            else:
+                with without_rate_limits():
+                    results = asyncio.run(self.run(scenarios, users, options))
+        finally:
+            if not options['keep_data']:
+                cleanup()
+
+        report = json.dumps({
+            'revision': git_revision(),
+            'target': options['url'] or 'in-process',
+            'results': results,
+        }, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(report)
+        self.stdout.write(report)
+
+    async def run(self, scenarios, users, options):
+        results = {}
+        for scenario in scenarios:
+            test = LoadTest(users, url=options['url'], timeout=options['timeout'])
+            if scenario == 'connect_storm':
+                result = await test.connect_storm(options['clients'], options['rooms'])
+            elif scenario == 'hot_room':
+                result = await test.hot_room(options['clients'], min(options['senders'], options['clients']),
+                                             options['messages'])
+            elif scenario == 'cold_rooms':
+                rooms = max(1, min(options['rooms'], options['clients'] // 2))
+                result = await test.cold_rooms(options['clients'], rooms, options['messages'])
+            else:
+                result = await test.call_burst(options['clients'], options['messages'])
+            results[scenario] = result
+            # Let disconnect handlers and write-behind flushes settle between scenarios
+            await asyncio.sleep(0.5)
+        return results
@@ -0,0 +1,23 @@
+import os
+from django.core.management.base import BaseCommand, CommandError
+from chat.persistence import get_write_behind_config, replay_dead_letters
+
+
+class Command(BaseCommand):
+    help = ('Write the chat messages the database rejected during write-behind (CHAT_WRITE_BEHIND '
+            'DEAD_LETTER_FILE) again; rows that are still rejected stay in the file')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--file', default=None, help='Dead letter file (default: DEAD_LETTER_FILE)')
+
+    def handle(self, *args, **options):
+        path = options['file'] or get_write_behind_config()['DEAD_LETTER_FILE']
+        if not path:
+            raise CommandError('No dead letter file configured')
+        if not os.path.exists(path):
+            self.stdout.write('No dead letters')
+            return
+        written, kept = replay_dead_letters(path)
+        self.stdout.write(self.style.SUCCESS(f'Wrote {written} messages'))
+        if kept:
+            self.stdout.write(self.style.WARNING(f'{kept} messages are still rejected and stay in {path}'))
@@ -1,19 +1,125 @@
-from channels.db import database_sync_to_async
+import threading
+import time
+from collections import OrderedDict
+from ChatApp import metrics
+from ChatApp.metrics import database_sync_to_async
 from django.contrib.auth.models import AnonymousUser
 from rest_framework_simplejwt.exceptions import InvalidToken, TokenError
 from users.models import CustomUser as User
 import urllib.parse
 
-@database_sync_to_async
-def get_user_from_token(token_string):
+# Clients that cannot set the query string send the token as two subprotocols:
+# new WebSocket(url, ['access_token', jwt, ...])
+TOKEN_SUBPROTOCOL = 'access_token'
+
+AUTH_SECONDS = metrics.histogram('ws_auth_seconds', 'Time to authenticate a WebSocket handshake')
+AUTH_RESULTS = metrics.counter('ws_auth_total', 'WebSocket handshakes by authentication result', ['result'])
+
+
+class UserSnapshot:
+    """
+    The fields of a user that WebSocket consumers read, without a model instance.
+
+    Use `user_id=snapshot.id` rather than `user=snapshot` in ORM calls.
+    """
+    __slots__ = ('id', 'email', 'first_name', 'last_name', 'is_active', 'is_staff', 'is_verified')
+    is_authenticated = True
+    is_anonymous = False
+
+    FIELDS = __slots__
+
+    def __init__(self, **fields):
+        for name in self.FIELDS:
+            setattr(self, name, fields[name])
+
+    @property
+    def pk(self):
+        return self.id
+
+    def __str__(self):
+        return self.email
+
+
+class UserSnapshotCache:
+    """
+    Bounded LRU of user id -> UserSnapshot for this process.
+
+    Entries are dropped when the user is saved or deleted here (see signals.py);
+    `ttl` bounds how long a change made by another worker can go unnoticed.
+    """
+
+    def __init__(self, max_size=10000, ttl=60):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                return None
+            if entry[1] < time.monotonic():
+                del self._entries[user_id]
+                return None
+            self._entries.move_to_end(user_id)
+            return entry[0]
+
+    def set(self, user_id, snapshot):
+        with self._lock:
+            self._entries[user_id] = (snapshot, time.monotonic() + self.ttl)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+user_snapshots = UserSnapshotCache()
+
+
+def load_user_snapshot(user_id):
+    """Return the cached snapshot of an active user, or None"""
+    snapshot = user_snapshots.get(user_id)
+    if snapshot is None:
+        fields = User.objects.filter(id=user_id, is_active=True).values(*UserSnapshot.FIELDS).first()
+        if fields is None:
+            return None
+        snapshot = UserSnapshot(**fields)
+        user_snapshots.set(user_id, snapshot)
+    return snapshot
+
+
+async def get_user_from_token(token_string):
     try:
         from rest_framework_simplejwt.tokens import AccessToken
         access_token = AccessToken(token_string)
-        user_id = access_token['user_id']
-        return User.objects.get(id=user_id)
-    except (InvalidToken, TokenError, User.DoesNotExist):
+        user_id = int(access_token['user_id'])
+    except (InvalidToken, TokenError, KeyError, ValueError):
         return AnonymousUser()
 
+    # Signature and expiry are checked on every handshake; only the user row is cached
+    snapshot = user_snapshots.get(user_id)
+    if snapshot is None:
+        snapshot = await database_sync_to_async(load_user_snapshot)(user_id)
+    return snapshot or AnonymousUser()
+
+
+def split_token_subprotocol(subprotocols):
+    """Return (token, remaining subprotocols) for a handshake's offered subprotocols"""
+    if TOKEN_SUBPROTOCOL in subprotocols:
+        index = subprotocols.index(TOKEN_SUBPROTOCOL)
+        if index + 1 < len(subprotocols):
+            return subprotocols[index + 1], subprotocols[:index] + subprotocols[index + 2:]
+    return None, subprotocols
+
+
 class JWTAuthMiddleware:
     def __init__(self, inner):
         self.inner = inner
@@ -22,10 +128,20 @@ class JWTAuthMiddleware:
         query_string = scope.get('query_string', b'').decode()
         query_params = urllib.parse.parse_qs(query_string)
         token = query_params.get('token', [None])[0]
-        
+
+        header_token, subprotocols = split_token_subprotocol(list(scope.get('subprotocols') or []))
+        if header_token:
+            # The consumer must echo one offered subprotocol; CodecMixin falls
+            # back to this one when the client asked for no other
+            scope = dict(scope, subprotocols=subprotocols, auth_subprotocol=TOKEN_SUBPROTOCOL)
+            token = token or header_token
+
         if token:
-            scope['user'] = await get_user_from_token(token)
+            with AUTH_SECONDS.time():
+                scope['user'] = await get_user_from_token(token)
+            AUTH_RESULTS.labels('rejected' if scope['user'].is_anonymous else 'authenticated').inc()
         else:
             scope['user'] = AnonymousUser()
-        
-        return await self.inner(scope, receive, send)
\ No newline at end of file
+            AUTH_RESULTS.labels('no_token').inc()
+
+        return await self.inner(scope, receive, send)
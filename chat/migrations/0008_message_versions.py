@@ -0,0 +1,38 @@
+# Generated by Django 5.2.7 on 2026-10-18 06:46
+
+import django.utils.timezone
+from django.db import migrations, models
+
+# Adding the column rebuilds chat_message on SQLite, which drops the full-text
+# triggers of 0006; the post_migrate handler of the chat app restores them.
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0007_message_archive_segment'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='version',
+            field=models.PositiveIntegerField(default=1),
+        ),
+        migrations.CreateModel(
+            name='MessageChange',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('room_name', models.CharField(max_length=255)),
+                ('message_id', models.BigIntegerField()),
+                ('version', models.PositiveIntegerField()),
+                ('kind', models.CharField(choices=[('message_updated', 'Updated'), ('message_deleted', 'Deleted')], max_length=20)),
+                ('content', models.TextField(blank=True, null=True)),
+                ('edited_at', models.DateTimeField(blank=True, null=True)),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['room_name', 'id'], name='change_room_id_idx'), models.Index(fields=['created_at'], name='change_created_idx')],
+            },
+        ),
+    ]
@@ -1,7 +1,33 @@
 from django.db import models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+from django.utils import timezone
 from django.contrib.auth import get_user_model
 from users.models import CustomUser as User
 
+class ChatRoomQuerySet(models.QuerySet):
+    def with_stats(self):
+        """
+        Annotate participant count and last message with correlated subqueries,
+        so listing rooms takes one query however many rooms there are.
+        """
+        latest = Message.objects.filter(room=OuterRef('pk')).order_by('-timestamp', '-id')
+        participants = (
+            ChatRoom.participants.through.objects
+            .filter(chatroom=OuterRef('pk'))
+            .order_by()
+            .values('chatroom')
+            .annotate(total=Count('*'))
+            .values('total')
+        )
+        return self.select_related('created_by').annotate(
+            participants_total=Coalesce(Subquery(participants), 0),
+            last_message_content=Subquery(latest.values('content')[:1]),
+            last_message_timestamp=Subquery(latest.values('timestamp')[:1]),
+            last_message_user_email=Subquery(latest.values('user__email')[:1]),
+        )
+
+
 class ChatRoom(models.Model):
     name = models.CharField(max_length=255, unique=True)
     display_name = models.CharField(max_length=255, blank=True)
@@ -11,6 +37,8 @@ class ChatRoom(models.Model):
     is_private = models.BooleanField(default=False)
     participants = models.ManyToManyField(User, blank=True, related_name='chat_rooms')
 
+    objects = ChatRoomQuerySet.as_manager()
+
     def __str__(self):
         return self.display_name or self.name
 
@@ -20,6 +48,8 @@ class ChatRoom(models.Model):
 
     @property
     def participant_count(self):
+        if hasattr(self, 'participants_total'):
+            return self.participants_total
         return self.participants.count()
 
 class Message(models.Model):
@@ -27,24 +57,105 @@ class Message(models.Model):
     room_name = models.CharField(max_length=255)
     room = models.ForeignKey(ChatRoom, on_delete=models.CASCADE, null=True, blank=True, related_name='messages')
     content = models.TextField()
-    timestamp = models.DateTimeField(auto_now_add=True)
+    timestamp = models.DateTimeField(default=timezone.now, editable=False)
     edited_at = models.DateTimeField(null=True, blank=True)
     is_edited = models.BooleanField(default=False)
+    # Bumped on every edit and on delete; clients keep the highest version they applied
+    version = models.PositiveIntegerField(default=1)
 
     class Meta:
         ordering = ['timestamp']
+        indexes = [
+            models.Index(fields=['room_name', 'timestamp', 'id'], name='message_room_name_ts_idx'),
+            models.Index(fields=['room', 'timestamp', 'id'], name='message_room_ts_idx'),
+            models.Index(fields=['user', 'timestamp', 'id'], name='message_user_ts_idx'),
+            models.Index(fields=['timestamp', 'id'], name='message_ts_idx'),
+        ]
 
     def __str__(self):
         return f'[{self.timestamp}] {self.user}: {self.content}'
 
     def save(self, *args, **kwargs):
         if not self.pk:
-            pass
-        
-        if not self.room and self.room_name:
-            room, created = ChatRoom.objects.get_or_create(
-                name=self.room_name,
-                defaults={'display_name': self.room_name.title()}
-            )
-            self.room = room
-        super().save(*args, **kwargs)
\ No newline at end of file
+            from .persistence import write_behind_enabled, allocate_message_id
+            if write_behind_enabled():
+                # Keep ids from one sequence so write-behind rows never collide
+                self.pk = allocate_message_id()
+                kwargs['force_insert'] = True
+
+        if self.room_id is None and self.room_name:
+            from .rooms import resolve_room_id
+            self.room_id = resolve_room_id(self.room_name)
+        super().save(*args, **kwargs)
+
+class ReadCursor(models.Model):
+    """The newest message a user has read in a room (a high-water mark, one row per user and room)"""
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='read_cursors')
+    room = models.ForeignKey(ChatRoom, on_delete=models.CASCADE, related_name='read_cursors')
+    last_read_message_id = models.BigIntegerField()
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['room', 'user'], name='read_cursor_room_user_uniq'),
+        ]
+
+    def __str__(self):
+        return f'{self.user} read {self.room} up to {self.last_read_message_id}'
+
+
+class MessageArchiveSegment(models.Model):
+    """
+    An append-only block of archived messages of one room.
+
+    `data` holds the rows as zlib-compressed JSON lines, oldest first (see
+    chat/archive.py). The first/last keys are a sparse index over the segments
+    of a room, so a cursor read decompresses only the segments it pages into.
+    """
+    room = models.ForeignKey(ChatRoom, on_delete=models.CASCADE, null=True, blank=True, related_name='archive_segments')
+    room_name = models.CharField(max_length=255)
+    first_timestamp = models.DateTimeField()
+    first_id = models.BigIntegerField()
+    last_timestamp = models.DateTimeField()
+    last_id = models.BigIntegerField()
+    message_count = models.PositiveIntegerField()
+    data = models.BinaryField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['room_name', 'first_timestamp', 'first_id'], name='archive_room_first_idx'),
+            models.Index(fields=['room_name', 'last_timestamp', 'last_id'], name='archive_room_last_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.room_name}: {self.message_count} messages up to {self.last_timestamp}'
+
+
+class MessageChange(models.Model):
+    """
+    One edit or delete of a message, in the order they happened.
+
+    The id is the room's change sequence: clients remember the last change
+    they applied and ask for the ones after it (see chat/changes.py).
+    """
+    UPDATED = 'message_updated'
+    DELETED = 'message_deleted'
+    KIND_CHOICES = [(UPDATED, 'Updated'), (DELETED, 'Deleted')]
+
+    room_name = models.CharField(max_length=255)
+    message_id = models.BigIntegerField()
+    version = models.PositiveIntegerField()
+    kind = models.CharField(max_length=20, choices=KIND_CHOICES)
+    content = models.TextField(null=True, blank=True)
+    edited_at = models.DateTimeField(null=True, blank=True)
+    created_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['room_name', 'id'], name='change_room_id_idx'),
+            models.Index(fields=['created_at'], name='change_created_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.room_name}: {self.kind} {self.message_id} v{self.version}'
@@ -0,0 +1,211 @@
+"""
+Bounded per-connection outbound queues.
+
+Group events are handed to the socket's queue instead of being awaited on the
+socket, so a slow client only ever holds MAX_SIZE frames and never delays the
+channel layer or the other members of a room. A single task per connection
+drains the queue. On servers whose ASGI send() waits for the transport to
+drain (uvicorn), a stalled client fills its queue and the overflow policy
+applies, and a single send that takes longer than SEND_TIMEOUT closes the
+socket. Daphne hands every send straight to Twisted, which buffers it without
+backpressure, and the ASGI interface does not expose how much is still
+unflushed. Under daphne neither trigger fires, and the queue only bounds
+what the consumer itself holds.
+"""
+import asyncio
+import logging
+from collections import deque
+from django.conf import settings
+from ChatApp import metrics
+
+logger = logging.getLogger(__name__)
+
+OUTBOUND_DEFAULTS = {
+    'MAX_SIZE': 256,
+    'POLICY': 'coalesce',
+    # Seconds one send may wait on the transport before the socket counts as stalled
+    'SEND_TIMEOUT': 10,
+}
+
+DROP_OLDEST = 'drop_oldest'
+COALESCE = 'coalesce'
+DISCONNECT = 'disconnect'
+POLICIES = (DROP_OLDEST, COALESCE, DISCONNECT)
+
+# Close code sent with the resync hint under the disconnect policy
+SLOW_CONSUMER_CLOSE_CODE = 4008
+
+
+def get_outbound_config():
+    config = dict(OUTBOUND_DEFAULTS)
+    config.update(getattr(settings, 'CHAT_OUTBOUND', {}))
+    if config['POLICY'] not in POLICIES:
+        raise ValueError(f"CHAT_OUTBOUND['POLICY'] must be one of {POLICIES}")
+    return config
+
+
+class OutboundStats:
+    """Process-wide counters over every OutboundQueue"""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.queues = 0
+        self.depth = 0
+        self.max_depth = 0
+        self.sent = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.disconnected = 0
+
+    def snapshot(self):
+        return {
+            'queues': self.queues,
+            'depth': self.depth,
+            'max_depth': self.max_depth,
+            'sent': self.sent,
+            'dropped': self.dropped,
+            'coalesced': self.coalesced,
+            'disconnected': self.disconnected,
+        }
+
+
+outbound_stats = OutboundStats()
+
+for _name, _type, _help in [
+    ('queues', 'gauge', 'Open outbound queues'),
+    ('depth', 'gauge', 'Frames waiting in outbound queues'),
+    ('sent', 'counter', 'Frames written to sockets by outbound queues'),
+    ('dropped', 'counter', 'Frames dropped because an outbound queue was full'),
+    ('coalesced', 'counter', 'Queued frames replaced by a newer frame with the same key'),
+    ('disconnected', 'counter', 'Sockets closed because their outbound queue overflowed'),
+]:
+    metrics.registry.callback(f"chat_outbound_{_name}{'_total' if _type == 'counter' else ''}", _help, _type,
+                              lambda _name=_name: getattr(outbound_stats, _name))
+
+
+class OutboundQueue:
+    """
+    Frames waiting to be written to one socket.
+
+    `send(**frame)` writes a frame, `encode(payload)` turns a dict into frame
+    kwargs for the socket's protocol and `close(code)` closes the socket.
+    Frames put with a coalesce key replace a still-queued frame with the same
+    key under the coalesce policy. When the queue is full, drop_oldest and
+    coalesce discard the oldest frame and send a resync hint before the next
+    delivered frame; disconnect sends the hint and closes the socket. A send
+    that does not complete within send_timeout closes the socket under every
+    policy.
+    """
+
+    def __init__(self, send, encode, close, max_size=256, policy=COALESCE, send_timeout=10):
+        self._send = send
+        self._encode = encode
+        self._close = close
+        self.max_size = max_size
+        self.policy = policy
+        self.send_timeout = send_timeout
+        self._entries = deque()
+        self._keyed = {}
+        self._wakeup = asyncio.Event()
+        self._dropped_since_delivery = 0
+        self._closing = False
+        self.closed = False
+        self.dropped = 0
+        self._task = asyncio.ensure_future(self._drain())
+        outbound_stats.queues += 1
+
+    @property
+    def depth(self):
+        return len(self._entries)
+
+    def put(self, frame, key=None):
+        """Queue frame kwargs for the socket; never waits"""
+        if self.closed or self._closing:
+            return
+        if key is not None and self.policy == COALESCE:
+            entry = self._keyed.get(key)
+            if entry is not None:
+                entry[0] = frame
+                outbound_stats.coalesced += 1
+                return
+
+        if len(self._entries) >= self.max_size:
+            if self.policy == DISCONNECT:
+                self._overflow_disconnect()
+                return
+            self._pop()
+            self.dropped += 1
+            self._dropped_since_delivery += 1
+            outbound_stats.dropped += 1
+
+        entry = [frame, key]
+        self._entries.append(entry)
+        if key is not None and self.policy == COALESCE:
+            self._keyed[key] = entry
+        outbound_stats.depth += 1
+        outbound_stats.max_depth = max(outbound_stats.max_depth, len(self._entries))
+        self._wakeup.set()
+
+    def _pop(self):
+        entry = self._entries.popleft()
+        if entry[1] is not None and self._keyed.get(entry[1]) is entry:
+            del self._keyed[entry[1]]
+        outbound_stats.depth -= 1
+        return entry[0]
+
+    def _overflow_disconnect(self):
+        dropped = len(self._entries)
+        while self._entries:
+            self._pop()
+        self.dropped += dropped
+        outbound_stats.dropped += dropped
+        outbound_stats.disconnected += 1
+        self._closing = True
+        self._wakeup.set()
+
+    async def _drain(self):
+        try:
+            while not self.closed:
+                await self._wakeup.wait()
+                self._wakeup.clear()
+                while self._entries and not self._closing:
+                    if self._dropped_since_delivery:
+                        hint = {'type': 'resync', 'reason': 'slow_consumer',
+                                'dropped': self._dropped_since_delivery}
+                        self._dropped_since_delivery = 0
+                        await self._send_within_timeout(self._encode(hint))
+                    await self._send_within_timeout(self._pop())
+                    outbound_stats.sent += 1
+                if self._closing:
+                    await self._send_within_timeout(self._encode({'type': 'resync', 'reason': 'slow_consumer'}))
+                    await self._close(SLOW_CONSUMER_CLOSE_CODE)
+                    return
+        except asyncio.CancelledError:
+            pass
+        except asyncio.TimeoutError:
+            logger.warning(f"Closing socket stalled for more than {self.send_timeout}s on one frame")
+            outbound_stats.disconnected += 1
+            try:
+                await asyncio.wait_for(self._close(SLOW_CONSUMER_CLOSE_CODE), self.send_timeout)
+            except Exception:
+                pass
+        except Exception as e:
+            logger.error(f"Outbound queue stopped: {e}")
+        finally:
+            self.close()
+
+    async def _send_within_timeout(self, frame):
+        await asyncio.wait_for(self._send(**frame), self.send_timeout)
+
+    def close(self):
+        """Forget queued frames and stop the drain task"""
+        if self.closed:
+            return
+        self.closed = True
+        while self._entries:
+            self._pop()
+        outbound_stats.queues -= 1
+        if not self._task.done() and self._task is not asyncio.current_task():
+            self._task.cancel()
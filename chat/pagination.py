@@ -0,0 +1,142 @@
+import base64
+from datetime import datetime
+from django.db.models import Q
+from rest_framework.exceptions import ValidationError
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+from .archive import archived_after, archived_before
+
+
+class MessageCursorPagination(BasePagination):
+    """
+    Keyset pagination for messages on (timestamp, id).
+
+    `?before=<cursor>` returns the messages older than the cursor, `?after=<cursor>`
+    the newer ones and `?limit=` sets the page size. Each page is one indexed range
+    scan, so the cost does not depend on how far back the client has scrolled.
+    Pages keep the direction of the view's queryset ordering. The cursor condition
+    is written as `timestamp <= t AND (timestamp < t OR id < pk)` so the database
+    can seek straight to the cursor on a (..., timestamp, id) index.
+
+    When the view sets `archive_room`, pages continue into that room's archive
+    segments (chat/archive.py) once they run past the oldest hot message. This
+    needs `.values()` rows, which is what archived rows look like. Lists across
+    rooms stop at the hot messages; `archive_included` tells clients which kind
+    of list they got.
+    """
+    before_query_param = 'before'
+    after_query_param = 'after'
+    limit_query_param = 'limit'
+    default_limit = 50
+    max_limit = 200
+
+    @staticmethod
+    def encode_cursor(timestamp, pk):
+        raw = f'{timestamp.isoformat()}|{pk}'.encode()
+        return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+    @staticmethod
+    def decode_cursor(cursor):
+        try:
+            padded = cursor + '=' * (-len(cursor) % 4)
+            timestamp, pk = base64.urlsafe_b64decode(padded.encode()).decode().split('|')
+            return datetime.fromisoformat(timestamp), int(pk)
+        except (ValueError, UnicodeDecodeError):
+            raise ValidationError({'detail': 'Invalid cursor.'})
+
+    @staticmethod
+    def row_key(row):
+        if isinstance(row, dict):
+            return row['timestamp'], row['id']
+        return row.timestamp, row.pk
+
+    def get_limit(self, request):
+        try:
+            limit = int(request.query_params.get(self.limit_query_param, self.default_limit))
+        except ValueError:
+            raise ValidationError({'detail': 'Invalid limit.'})
+        return max(1, min(limit, self.max_limit))
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.limit = self.get_limit(request)
+        order_by = queryset.query.order_by
+        self.newest_first = bool(order_by) and str(order_by[0]).startswith('-')
+
+        archive_room = getattr(view, 'archive_room', None)
+        self.archive_included = archive_room is not None
+        before = request.query_params.get(self.before_query_param)
+        after = request.query_params.get(self.after_query_param)
+
+        if after:
+            timestamp, pk = self.decode_cursor(after)
+            # Archived messages are older than every hot one, so they come first
+            rows = archived_after(archive_room, (timestamp, pk), self.limit) if archive_room else []
+            if len(rows) < self.limit:
+                queryset = queryset.filter(
+                    Q(timestamp__gt=timestamp) | Q(id__gt=pk), timestamp__gte=timestamp
+                ).order_by('timestamp', 'id')
+                rows += list(queryset[:self.limit - len(rows)])
+            self.has_older = True
+        else:
+            key = None
+            if before:
+                key = self.decode_cursor(before)
+                timestamp, pk = key
+                queryset = queryset.filter(
+                    Q(timestamp__lt=timestamp) | Q(id__lt=pk), timestamp__lte=timestamp
+                )
+            queryset = queryset.order_by('-timestamp', '-id')
+            rows = list(queryset[:self.limit + 1])
+            if archive_room and len(rows) <= self.limit:
+                key = self.row_key(rows[-1]) if rows else key
+                rows += archived_before(archive_room, key, self.limit + 1 - len(rows))
+            self.has_older = len(rows) > self.limit
+            rows = rows[:self.limit]
+            rows.reverse()
+
+        self.before_cursor = self.encode_cursor(*self.row_key(rows[0])) if rows and self.has_older else None
+        if rows:
+            self.after_cursor = self.encode_cursor(*self.row_key(rows[-1]))
+        else:
+            self.after_cursor = after or before or None
+
+        if self.newest_first:
+            rows.reverse()
+        return rows
+
+    def get_link(self, param, cursor):
+        if cursor is None:
+            return None
+        url = self.request.build_absolute_uri()
+        other = self.after_query_param if param == self.before_query_param else self.before_query_param
+        url = remove_query_param(url, other)
+        return replace_query_param(url, param, cursor)
+
+    def get_paginated_response(self, data, sidecars=None):
+        return Response({
+            'older': self.get_link(self.before_query_param, self.before_cursor),
+            'newer': self.get_link(self.after_query_param, self.after_cursor),
+            'before': self.before_cursor,
+            'after': self.after_cursor,
+            'archive_included': self.archive_included,
+            'results': data,
+            **(sidecars or {}),
+        })
+
+    def get_paginated_response_schema(self, schema):
+        cursor = {'type': 'string', 'nullable': True}
+        link = {'type': 'string', 'nullable': True, 'format': 'uri'}
+        return {
+            'type': 'object',
+            'required': ['results'],
+            'properties': {
+                'older': link,
+                'newer': link,
+                'before': cursor,
+                'after': cursor,
+                'archive_included': {'type': 'boolean'},
+                'results': schema,
+            },
+        }
@@ -0,0 +1,352 @@
+import asyncio
+import atexit
+import logging
+import os
+import socket
+import threading
+import time
+from collections import deque
+from datetime import datetime
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import DataError, IntegrityError, transaction
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from ChatApp import metrics
+from ChatApp.metrics import database_sync_to_async
+from . import codec
+from .models import Message
+from .rooms import resolve_room_id
+
+logger = logging.getLogger(__name__)
+
+DEAD_LETTERS = metrics.counter('chat_write_behind_dead_letters_total',
+                               'Messages the database rejected, kept in DEAD_LETTER_FILE for replay')
+
+WRITE_BEHIND_DEFAULTS = {
+    'ENABLED': False,
+    'FLUSH_INTERVAL': 0.05,
+    'MAX_BATCH_SIZE': 200,
+    'MAX_PENDING': 5000,
+    'WORKER_ID': None,
+    # Where a process gets its worker id when WORKER_ID is not set
+    'WORKER_ID_BACKEND': 'chat.persistence.RedisWorkerIdClaim',
+    # Failed flushes are retried after FLUSH_INTERVAL, doubling up to MAX_BACKOFF seconds
+    'MAX_BACKOFF': 5,
+    # JSON lines of rejected messages; `manage.py replay_dead_letters` writes them again
+    'DEAD_LETTER_FILE': None,
+}
+
+
+class WriteBehindFull(Exception):
+    """Raised by submit() when MAX_PENDING messages are already waiting; the message was not queued"""
+
+
+def message_row(message):
+    return {
+        'id': message.id,
+        'user_id': message.user_id,
+        'room_id': message.room_id,
+        'room_name': message.room_name,
+        'content': message.content,
+        'timestamp': message.timestamp.isoformat(),
+    }
+
+
+def row_message(row):
+    return Message(**dict(row, timestamp=datetime.fromisoformat(row['timestamp'])))
+
+
+def get_write_behind_config():
+    config = dict(WRITE_BEHIND_DEFAULTS)
+    config.update(getattr(settings, 'CHAT_WRITE_BEHIND', {}))
+    return config
+
+
+def write_behind_enabled():
+    return bool(get_write_behind_config()['ENABLED'])
+
+
+class MessageIdGenerator:
+    """
+    Time-ordered 63-bit ids: 41 bits of milliseconds since EPOCH_MS,
+    10 bits of worker id and a 12 bit per-millisecond sequence.
+    """
+    EPOCH_MS = 1704067200000  # 2024-01-01T00:00:00Z
+
+    def __init__(self, worker_id):
+        self.worker_id = worker_id & 0x3FF
+        self._lock = threading.Lock()
+        self._last_ms = -1
+        self._sequence = 0
+
+    def next_id(self):
+        with self._lock:
+            now = int(time.time() * 1000)
+            if now < self._last_ms:
+                now = self._last_ms
+            if now == self._last_ms:
+                self._sequence = (self._sequence + 1) & 0xFFF
+                if self._sequence == 0:
+                    now = self._last_ms + 1
+            else:
+                self._sequence = 0
+            self._last_ms = now
+            return ((now - self.EPOCH_MS) << 22) | (self.worker_id << 12) | self._sequence
+
+
+class RedisWorkerIdClaim:
+    """
+    Claims a worker id no other live process holds, as a Redis key with a TTL
+    that a background thread keeps refreshing while the process runs.
+    """
+    KEY = 'chat:write_behind:worker:{}'
+    TTL = 60
+
+    def claim(self):
+        from ChatApp.redis_client import get_redis
+        owner = f'{socket.gethostname()}:{os.getpid()}'
+        try:
+            client = get_redis()
+            for worker_id in range(1024):
+                key = self.KEY.format(worker_id)
+                if client.set(key, owner, nx=True, ex=self.TTL):
+                    threading.Thread(target=self._refresh, args=(client, key, owner),
+                                     name='write-behind-worker-id', daemon=True).start()
+                    return worker_id
+        except Exception as e:
+            raise ImproperlyConfigured(f'Could not claim a write-behind worker id in Redis ({e}); '
+                                       'set CHAT_WORKER_ID') from e
+        raise ImproperlyConfigured('All 1024 write-behind worker ids are claimed; set CHAT_WORKER_ID')
+
+    def _refresh(self, client, key, owner):
+        while True:
+            time.sleep(self.TTL / 3)
+            try:
+                if client.get(key) == owner.encode():
+                    client.expire(key, self.TTL)
+                elif client.set(key, owner, nx=True, ex=self.TTL):
+                    logger.warning(f"Write-behind worker id {key} had expired and was claimed again")
+                else:
+                    logger.error(f"Write-behind worker id {key} was taken by another process; "
+                                 "message ids may collide")
+            except Exception as e:
+                logger.error(f"Refreshing write-behind worker id {key} failed: {e}")
+
+
+class ProcessWorkerId:
+    """The process id as worker id; only unique on a single host, for development"""
+
+    def claim(self):
+        return os.getpid()
+
+
+_id_generator = None
+
+
+def allocate_message_id():
+    """Allocate a message primary key without a database round-trip"""
+    global _id_generator
+    if _id_generator is None:
+        config = get_write_behind_config()
+        worker_id = config['WORKER_ID']
+        if worker_id is None:
+            worker_id = import_string(config['WORKER_ID_BACKEND'])().claim()
+        _id_generator = MessageIdGenerator(int(worker_id))
+    return _id_generator.next_id()
+
+
+class MessageWriteBehind:
+    """
+    Buffers chat messages in memory and writes them with bulk_create.
+
+    A message is written at most FLUSH_INTERVAL seconds after it was submitted,
+    or sooner once MAX_BATCH_SIZE messages are pending. Once MAX_PENDING
+    messages are waiting (for example because the database is down), submit()
+    refuses new ones with WriteBehindFull, so the amount of unwritten data
+    stays bounded and the sender learns the message was not sent.
+
+    A failed flush keeps its batch and is retried with exponential backoff up
+    to MAX_BACKOFF seconds, however long the database is unavailable. Only
+    rows the database itself rejects (IntegrityError, DataError) are taken out,
+    found by writing the batch row by row, and appended to DEAD_LETTER_FILE.
+    """
+
+    def __init__(self, flush_interval=0.05, max_batch_size=200, max_pending=5000, max_backoff=5,
+                 dead_letter_file=None):
+        self.flush_interval = flush_interval
+        self.max_batch_size = max_batch_size
+        self.max_pending = max_pending
+        self.max_backoff = max_backoff
+        self.dead_letter_file = dead_letter_file
+        # The most recent rejected messages of this process, for inspection
+        self.dead_letters = deque(maxlen=1000)
+        self._pending = []
+        self._flush_task = None
+        self._wakeup = None
+
+    @property
+    def pending_count(self):
+        return len(self._pending)
+
+    def build_message(self, user, room_name, content, room_id=None):
+        return Message(
+            id=allocate_message_id(),
+            user_id=user.pk,
+            room_name=room_name,
+            room_id=room_id,
+            content=content,
+            timestamp=timezone.now(),
+        )
+
+    async def submit(self, user, room_name, content, room_id=None):
+        """Queue a message for writing and return it with its id and timestamp set"""
+        if len(self._pending) >= self.max_pending:
+            raise WriteBehindFull(f'{len(self._pending)} messages are waiting to be written')
+        message = self.build_message(user, room_name, content, room_id=room_id)
+        self._pending.append(message)
+        self._ensure_flusher()
+        if len(self._pending) >= self.max_batch_size:
+            self._wakeup.set()
+        return message
+
+    async def flush(self):
+        """Write everything pending; on failure the batch stays queued and the error is raised"""
+        batch = self._take()
+        if not batch:
+            return 0
+        try:
+            await database_sync_to_async(self._write)(batch)
+        except Exception:
+            self._pending[:0] = batch
+            raise
+        return len(batch)
+
+    def flush_sync(self):
+        """Write everything still pending; used on interpreter shutdown"""
+        batch = self._take()
+        if batch:
+            try:
+                self._write(batch)
+            except Exception as e:
+                # Nothing will retry after shutdown; keep the messages for replay
+                self._dead_letter(batch, e)
+                raise
+        return len(batch)
+
+    def _take(self):
+        batch, self._pending = self._pending, []
+        return batch
+
+    def _write(self, batch):
+        for message in batch:
+            if message.room_id is None and message.room_name:
+                message.room_id = resolve_room_id(message.room_name)
+        try:
+            with transaction.atomic():
+                Message.objects.bulk_create(batch, batch_size=self.max_batch_size)
+        except (IntegrityError, DataError):
+            # Find the rows the database rejects and write the others
+            for message in batch:
+                try:
+                    with transaction.atomic():
+                        Message.objects.bulk_create([message])
+                except (IntegrityError, DataError) as e:
+                    self._dead_letter([message], e)
+
+    def _dead_letter(self, messages, error):
+        self.dead_letters.extend(messages)
+        DEAD_LETTERS.inc(len(messages))
+        logger.error(f"Write-behind could not write {len(messages)} messages "
+                     f"(ids {[message.id for message in messages][:10]}): {error}")
+        if self.dead_letter_file:
+            try:
+                with open(self.dead_letter_file, 'a') as f:
+                    f.writelines(codec.dumps(message_row(message)) + '\n' for message in messages)
+            except OSError as e:
+                logger.error(f"Could not save dead letters to {self.dead_letter_file}: {e}")
+
+    def _ensure_flusher(self):
+        if self._flush_task is None or self._flush_task.done():
+            self._wakeup = asyncio.Event()
+            self._flush_task = asyncio.ensure_future(self._run())
+
+    def backoff(self, failures):
+        """Seconds to wait before the next flush after `failures` failed ones in a row"""
+        return min(self.flush_interval * 2 ** failures, self.max_backoff)
+
+    async def _run(self):
+        failures = 0
+        while self._pending:
+            if failures:
+                # Full batches do not cut a backoff short
+                await asyncio.sleep(self.backoff(failures))
+            else:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+                except asyncio.TimeoutError:
+                    pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+                failures = 0
+            except Exception as e:
+                failures += 1
+                logger.error(f"Write-behind flush failed, {len(self._pending)} messages pending, "
+                             f"retrying in {self.backoff(failures):.2f}s: {e}")
+
+
+def replay_dead_letters(path):
+    """Write the messages saved in a dead letter file; keep the rows still rejected. Returns (written, kept)"""
+    # Move the file aside first so rows that workers append meanwhile are not lost
+    replaying = f'{path}.replaying'
+    os.replace(path, replaying)
+    with open(replaying) as f:
+        rows = [codec.loads(line) for line in f if line.strip()]
+    kept = []
+    for row in rows:
+        try:
+            with transaction.atomic():
+                Message.objects.bulk_create([row_message(row)])
+        except (IntegrityError, DataError) as e:
+            logger.warning(f"Dead letter {row['id']} is still rejected: {e}")
+            kept.append(row)
+    with open(path, 'a') as f:
+        f.writelines(codec.dumps(row) + '\n' for row in kept)
+    os.remove(replaying)
+    return len(rows) - len(kept), len(kept)
+
+
+_writer = None
+
+
+def get_message_writer():
+    """Return the process-wide write-behind writer, or None when it is disabled"""
+    global _writer
+    config = get_write_behind_config()
+    if not config['ENABLED']:
+        return None
+    if _writer is None:
+        _writer = MessageWriteBehind(
+            flush_interval=config['FLUSH_INTERVAL'],
+            max_batch_size=config['MAX_BATCH_SIZE'],
+            max_pending=config['MAX_PENDING'],
+            max_backoff=config['MAX_BACKOFF'],
+            dead_letter_file=config['DEAD_LETTER_FILE'],
+        )
+    return _writer
+
+
+metrics.registry.callback('chat_write_behind_pending', 'Messages accepted but not yet written to the database',
+                          'gauge', lambda: _writer.pending_count if _writer is not None else None)
+
+
+@atexit.register
+def _flush_on_exit():
+    if _writer is not None and _writer.pending_count:
+        try:
+            _writer.flush_sync()
+        except Exception as e:
+            logger.error(f"Write-behind flush on shutdown failed: {e}")
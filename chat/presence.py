@@ -0,0 +1,296 @@
+import asyncio
+import logging
+import threading
+import time
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.utils.module_loading import import_string
+from .codec import group_event
+
+logger = logging.getLogger(__name__)
+
+PRESENCE_DEFAULTS = {
+    'BACKEND': 'chat.presence.InMemoryPresenceStore',
+    'OPTIONS': {},
+    'HEARTBEAT_INTERVAL': 30,
+    'TTL': 90,
+}
+
+# Presence keys: one per chat room, plus one for sockets that can receive calls
+CALLS_KEY = 'calls'
+
+
+def room_key(room_name):
+    return f'room:{room_name}'
+
+
+class InMemoryPresenceStore:
+    """
+    Online users per key for a single process.
+
+    Each key maps user id -> expiry, and each (key, user) pair maps connection
+    -> expiry. A user stays online in a key while any connection is live.
+    """
+
+    def __init__(self):
+        self._users = {}
+        self._connections = {}
+        self._lock = threading.Lock()
+
+    def _join(self, key, user_id, connection, expires):
+        connections = self._connections.setdefault((key, user_id), {})
+        connections[connection] = expires
+        users = self._users.setdefault(key, {})
+        added = user_id not in users
+        users[user_id] = max(expires, users.get(user_id, 0))
+        return added
+
+    async def join(self, key, user_id, connection, expires):
+        """Add a connection; return True if the user was not online in key before"""
+        with self._lock:
+            return self._join(key, user_id, connection, expires)
+
+    async def leave(self, key, user_id, connection, now):
+        """Remove a connection; return True if it was the user's last one in key"""
+        with self._lock:
+            connections = self._connections.get((key, user_id), {})
+            connections.pop(connection, None)
+            for other in [c for c, expires in connections.items() if expires < now]:
+                del connections[other]
+            if connections:
+                return False
+            self._connections.pop((key, user_id), None)
+            return self._users.get(key, {}).pop(user_id, None) is not None
+
+    async def refresh(self, entries, expires):
+        """Extend (key, user_id, connection) entries; return the (key, user_id) pairs that came back"""
+        with self._lock:
+            return [(key, user_id) for key, user_id, connection in entries
+                    if self._join(key, user_id, connection, expires)]
+
+    async def sweep(self, keys, now):
+        """Drop users whose every connection expired; return {key: [user_id, ...]}"""
+        expired = {}
+        with self._lock:
+            for key in keys:
+                users = self._users.get(key, {})
+                gone = [user_id for user_id, expires in users.items() if expires < now]
+                for user_id in gone:
+                    del users[user_id]
+                    self._connections.pop((key, user_id), None)
+                if gone:
+                    expired[key] = gone
+        return expired
+
+    def online(self, keys, now):
+        with self._lock:
+            return {
+                key: sorted(u for u, expires in self._users.get(key, {}).items() if expires >= now)
+                for key in keys
+            }
+
+    async def aonline(self, keys, now):
+        return self.online(keys, now)
+
+
+class RedisPresenceStore:
+    """
+    Online users per key shared by every worker through Redis.
+
+    `{prefix}:{key}` is a sorted set of user id -> expiry and
+    `{prefix}:{key}:{user_id}` a sorted set of connection -> expiry.
+    """
+
+    JOIN = """
+        redis.call('ZADD', KEYS[2], ARGV[3], ARGV[2])
+        redis.call('EXPIRE', KEYS[2], ARGV[4])
+        local added = redis.call('ZADD', KEYS[1], ARGV[3], ARGV[1])
+        redis.call('EXPIRE', KEYS[1], ARGV[4])
+        return added
+    """
+
+    LEAVE = """
+        redis.call('ZREM', KEYS[2], ARGV[2])
+        redis.call('ZREMRANGEBYSCORE', KEYS[2], '-inf', '(' .. ARGV[3])
+        if redis.call('ZCARD', KEYS[2]) > 0 then return 0 end
+        redis.call('DEL', KEYS[2])
+        return redis.call('ZREM', KEYS[1], ARGV[1])
+    """
+
+    SWEEP = """
+        local gone = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', '(' .. ARGV[1])
+        if #gone > 0 then
+            redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', '(' .. ARGV[1])
+            for _, user_id in ipairs(gone) do
+                redis.call('DEL', KEYS[1] .. ':' .. user_id)
+            end
+        end
+        return gone
+    """
+
+    def __init__(self, prefix='presence'):
+        self.prefix = prefix
+        self._async_scripts = {}
+
+    @staticmethod
+    def _key_ttl(expires):
+        # Keys outlive their newest entry so idle rooms clean themselves up
+        return max(1, int((expires - time.time()) * 2))
+
+    def _key(self, key, user_id=None):
+        if user_id is None:
+            return f'{self.prefix}:{key}'
+        return f'{self.prefix}:{key}:{user_id}'
+
+    def _script(self, client, name):
+        scripts = self._async_scripts.setdefault(id(client), {})
+        if name not in scripts:
+            scripts[name] = client.register_script(getattr(self, name))
+        return scripts[name]
+
+    async def join(self, key, user_id, connection, expires):
+        from ChatApp.redis_client import get_async_redis
+        client = get_async_redis()
+        added = await self._script(client, 'JOIN')(
+            keys=[self._key(key), self._key(key, user_id)],
+            args=[user_id, connection, expires, self._key_ttl(expires)],
+        )
+        return bool(added)
+
+    async def leave(self, key, user_id, connection, now):
+        from ChatApp.redis_client import get_async_redis
+        client = get_async_redis()
+        removed = await self._script(client, 'LEAVE')(
+            keys=[self._key(key), self._key(key, user_id)],
+            args=[user_id, connection, now],
+        )
+        return bool(removed)
+
+    async def refresh(self, entries, expires):
+        from ChatApp.redis_client import get_async_redis
+        pipe = get_async_redis().pipeline(transaction=False)
+        key_ttl = self._key_ttl(expires)
+        for key, user_id, connection in entries:
+            pipe.zadd(self._key(key, user_id), {connection: expires})
+            pipe.expire(self._key(key, user_id), key_ttl)
+            pipe.zadd(self._key(key), {user_id: expires})
+            pipe.expire(self._key(key), key_ttl)
+        results = await pipe.execute()
+        return [(key, user_id) for (key, user_id, _), added in zip(entries, results[2::4]) if added]
+
+    async def sweep(self, keys, now):
+        from ChatApp.redis_client import get_async_redis
+        client = get_async_redis()
+        script = self._script(client, 'SWEEP')
+        expired = {}
+        for key in keys:
+            gone = await script(keys=[self._key(key)], args=[now])
+            if gone:
+                expired[key] = [int(user_id) for user_id in gone]
+        return expired
+
+    def online(self, keys, now):
+        from ChatApp.redis_client import get_redis
+        pipe = get_redis().pipeline(transaction=False)
+        for key in keys:
+            pipe.zrangebyscore(self._key(key), now, '+inf')
+        return {
+            key: sorted(int(user_id) for user_id in user_ids)
+            for key, user_ids in zip(keys, pipe.execute())
+        }
+
+    async def aonline(self, keys, now):
+        from ChatApp.redis_client import get_async_redis
+        pipe = get_async_redis().pipeline(transaction=False)
+        for key in keys:
+            pipe.zrangebyscore(self._key(key), now, '+inf')
+        return {
+            key: sorted(int(user_id) for user_id in user_ids)
+            for key, user_ids in zip(keys, await pipe.execute())
+        }
+
+
+class Presence:
+    """
+    Tracks which users have a live socket per room (and for calls) and pushes
+    joined/left diffs to the room's group.
+
+    Connections are added and removed by the consumers. One task per process
+    refreshes every local connection each HEARTBEAT_INTERVAL seconds; entries
+    not refreshed within TTL (e.g. from a worker that died) are swept as left.
+    """
+
+    def __init__(self, store, heartbeat_interval=30, ttl=90):
+        self.store = store
+        self.heartbeat_interval = heartbeat_interval
+        self.ttl = ttl
+        self._local = set()
+        self._task = None
+
+    @staticmethod
+    def group_for(key):
+        if key.startswith('room:'):
+            return f"chat_{key[len('room:'):]}"
+        return None
+
+    async def join(self, key, user_id, connection):
+        self._local.add((key, user_id, connection))
+        self._ensure_heartbeat()
+        if await self.store.join(key, user_id, connection, time.time() + self.ttl):
+            await self.publish(key, joined=[user_id])
+
+    async def leave(self, key, user_id, connection):
+        self._local.discard((key, user_id, connection))
+        if await self.store.leave(key, user_id, connection, time.time()):
+            await self.publish(key, left=[user_id])
+
+    def online(self, keys):
+        """Return {key: [user_id, ...]} with one store lookup per key"""
+        return self.store.online(list(keys), time.time())
+
+    async def aonline(self, key):
+        return (await self.store.aonline([key], time.time()))[key]
+
+    async def publish(self, key, joined=(), left=()):
+        group = self.group_for(key)
+        if group is None:
+            return
+        payload = {'type': 'presence', 'room': key[len('room:'):], 'joined': list(joined), 'left': list(left)}
+        await get_channel_layer().group_send(group, group_event(payload))
+
+    async def heartbeat(self):
+        entries = list(self._local)
+        if not entries:
+            return
+        now = time.time()
+        for key, user_id in await self.store.refresh(entries, now + self.ttl):
+            await self.publish(key, joined=[user_id])
+        expired = await self.store.sweep({key for key, _, _ in entries}, now)
+        for key, user_ids in expired.items():
+            await self.publish(key, left=user_ids)
+
+    def _ensure_heartbeat(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._run())
+
+    async def _run(self):
+        while self._local:
+            await asyncio.sleep(self.heartbeat_interval)
+            try:
+                await self.heartbeat()
+            except Exception as e:
+                logger.error(f"Presence heartbeat failed for {len(self._local)} connections: {e}")
+
+
+_presence = None
+
+
+def get_presence():
+    """Return the process-wide Presence configured by settings.CHAT_PRESENCE"""
+    global _presence
+    if _presence is None:
+        config = dict(PRESENCE_DEFAULTS)
+        config.update(getattr(settings, 'CHAT_PRESENCE', {}))
+        store = import_string(config['BACKEND'])(**config['OPTIONS'])
+        _presence = Presence(store, heartbeat_interval=config['HEARTBEAT_INTERVAL'], ttl=config['TTL'])
+    return _presence
@@ -0,0 +1,101 @@
+import threading
+import time
+from collections import OrderedDict
+from django.conf import settings
+
+RATE_LIMIT_DEFAULTS = {
+    'ENABLED': True,
+    # Every frame of an authenticated socket, checked before it is parsed
+    'CONNECTION': {'RATE': 10, 'BURST': 20},
+    # Every frame of an anonymous socket
+    'ANONYMOUS': {'RATE': 0.5, 'BURST': 3},
+    # Chat messages per user across the user's sockets, by subscription plan type
+    'PLANS': {
+        'free': {'RATE': 1, 'BURST': 5},
+        'basic': {'RATE': 2, 'BURST': 10},
+        'pro': {'RATE': 5, 'BURST': 20},
+    },
+    'MAX_USERS': 100000,
+}
+
+
+class TokenBucket:
+    """`rate` tokens per second up to `burst`; each allowed event takes one"""
+    __slots__ = ('rate', 'burst', 'tokens', 'updated')
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    def take(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    def retry_after(self):
+        """Seconds until the next token"""
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+
+class RateLimiter:
+    """
+    In-memory token buckets for chat sockets: one per connection, plus one per
+    user shared by that user's sockets in this process. Nothing here touches
+    the database or the network.
+    """
+
+    def __init__(self, connection, anonymous, plans, max_users=100000):
+        self.connection = connection
+        self.anonymous = anonymous
+        self.plans = plans
+        self.max_users = max_users
+        self._users = OrderedDict()
+        self._lock = threading.Lock()
+
+    def connection_bucket(self, anonymous=False):
+        limits = self.anonymous if anonymous else self.connection
+        return TokenBucket(limits['RATE'], limits['BURST'])
+
+    def user_bucket(self, user_id, plan_type):
+        limits = self.plans.get(plan_type) or self.plans['free']
+        with self._lock:
+            bucket = self._users.get(user_id)
+            if bucket is None:
+                bucket = self._users[user_id] = TokenBucket(limits['RATE'], limits['BURST'])
+                while len(self._users) > self.max_users:
+                    self._users.popitem(last=False)
+            else:
+                # Plan changes apply from the next message
+                bucket.rate, bucket.burst = limits['RATE'], limits['BURST']
+                self._users.move_to_end(user_id)
+            return bucket
+
+    def clear(self):
+        with self._lock:
+            self._users.clear()
+
+
+_limiter = None
+
+
+def get_rate_limiter():
+    """Return the process-wide RateLimiter, or None when rate limiting is disabled"""
+    global _limiter
+    config = dict(RATE_LIMIT_DEFAULTS)
+    config.update(getattr(settings, 'CHAT_RATE_LIMIT', {}))
+    if not config['ENABLED']:
+        return None
+    if _limiter is None:
+        _limiter = RateLimiter(
+            connection=config['CONNECTION'],
+            anonymous=config['ANONYMOUS'],
+            plans=config['PLANS'],
+            max_users=config['MAX_USERS'],
+        )
+    return _limiter
@@ -0,0 +1,63 @@
+import threading
+import time
+from collections import OrderedDict
+from .models import ChatRoom
+
+
+class RoomIdCache:
+    """
+    Bounded LRU of room name -> ChatRoom id for this process.
+
+    Entries are dropped when the room is saved or deleted here (see signals.py);
+    `ttl` bounds how long another worker's rename or delete can go unnoticed.
+    """
+
+    def __init__(self, max_size=10000, ttl=300):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, room_name):
+        with self._lock:
+            entry = self._entries.get(room_name)
+            if entry is None:
+                return None
+            if entry[1] < time.monotonic():
+                del self._entries[room_name]
+                return None
+            self._entries.move_to_end(room_name)
+            return entry[0]
+
+    def set(self, room_name, room_id):
+        with self._lock:
+            self._entries[room_name] = (room_id, time.monotonic() + self.ttl)
+            self._entries.move_to_end(room_name)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate_room(self, room_id, room_name=None):
+        with self._lock:
+            self._entries.pop(room_name, None)
+            for name in [name for name, entry in self._entries.items() if entry[0] == room_id]:
+                del self._entries[name]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+room_ids = RoomIdCache()
+
+
+def resolve_room_id(room_name):
+    """Return the id of the room called room_name, creating the room if needed"""
+    room_id = room_ids.get(room_name)
+    if room_id is None:
+        room, created = ChatRoom.objects.get_or_create(
+            name=room_name,
+            defaults={'display_name': room_name.title()}
+        )
+        room_id = room.id
+        room_ids.set(room_name, room_id)
+    return room_id
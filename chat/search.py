@@ -0,0 +1,215 @@
+"""
+Full-text message search.
+
+Each backend returns `(message_id, score, snippet)` tuples, best match first.
+Snippets are HTML-escaped, with matches wrapped in <mark></mark>. The index
+itself is maintained by the database (see migration 0006_message_search); on
+SQLite its triggers are checked after every migrate (install_sqlite_triggers).
+Private rooms are searched only by their participants.
+"""
+import html
+import re
+from django.db import connection
+from django.db.models.expressions import RawSQL
+from django.utils.text import Truncator
+from .models import ChatRoom, Message
+
+# Private-use characters mark matches until the snippet has been escaped
+MARK_START = '\ue000'
+MARK_END = '\ue001'
+SNIPPET_WORDS = 16
+
+_TERM = re.compile(r'\w+\*?', re.UNICODE)
+
+SQLITE_TRIGGERS = {
+    'chat_message_fts_ai':
+        "CREATE TRIGGER IF NOT EXISTS chat_message_fts_ai AFTER INSERT ON chat_message BEGIN "
+        "INSERT INTO chat_message_fts(rowid, content) VALUES (new.id, new.content); END",
+    'chat_message_fts_ad':
+        "CREATE TRIGGER IF NOT EXISTS chat_message_fts_ad AFTER DELETE ON chat_message BEGIN "
+        "INSERT INTO chat_message_fts(chat_message_fts, rowid, content) VALUES ('delete', old.id, old.content); END",
+    'chat_message_fts_au':
+        "CREATE TRIGGER IF NOT EXISTS chat_message_fts_au AFTER UPDATE OF content ON chat_message BEGIN "
+        "INSERT INTO chat_message_fts(chat_message_fts, rowid, content) VALUES ('delete', old.id, old.content); "
+        "INSERT INTO chat_message_fts(rowid, content) VALUES (new.id, new.content); END",
+}
+
+
+def install_sqlite_triggers(connection):
+    """
+    Create whichever FTS5 triggers are missing and reindex if any were; return
+    how many. SQLite drops them whenever Django rebuilds chat_message (altering
+    or removing a column), so this runs after every migrate.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT name FROM sqlite_master WHERE name = 'chat_message_fts' "
+            "OR (type = 'trigger' AND name LIKE 'chat_message_fts_%')"
+        )
+        names = {row[0] for row in cursor.fetchall()}
+        if 'chat_message_fts' not in names:
+            # Not migrated to 0006 yet, or back past it
+            return 0
+        missing = [sql for name, sql in SQLITE_TRIGGERS.items() if name not in names]
+        for sql in missing:
+            cursor.execute(sql)
+        if missing:
+            cursor.execute("INSERT INTO chat_message_fts(chat_message_fts) VALUES ('rebuild')")
+    return len(missing)
+
+
+def hidden_room_names(user_id):
+    """Names of the private rooms user_id does not take part in"""
+    return ChatRoom.objects.filter(is_private=True).exclude(participants=user_id).values('name')
+
+
+def render_snippet(raw):
+    """Escape a snippet and turn the match markers into <mark> tags"""
+    return html.escape(raw or '').replace(MARK_START, '<mark>').replace(MARK_END, '</mark>')
+
+
+def search_terms(query):
+    """Words of a user query; a trailing * asks for a prefix match"""
+    return _TERM.findall(query)
+
+
+class SearchBackend:
+    def search(self, query, room_name=None, user_id=None, since=None, until=None, limit=20, offset=0,
+               viewer_id=None):
+        """Matches visible to viewer_id; every match when it is None"""
+        raise NotImplementedError
+
+    def filter_queryset(self, queryset, query):
+        """Restrict a Message queryset to matches, unranked (used by the admin)"""
+        raise NotImplementedError
+
+    @staticmethod
+    def filters(room_name, user_id, since, until, viewer_id=None):
+        """SQL conditions on chat_message (aliased m) shared by the raw SQL backends"""
+        clauses, params = [], []
+        if viewer_id is not None:
+            hidden, hidden_params = hidden_room_names(viewer_id).query.sql_with_params()
+            clauses.append(f'm.room_name NOT IN ({hidden})')
+            params.extend(hidden_params)
+        if room_name:
+            clauses.append('m.room_name = %s')
+            params.append(room_name)
+        if user_id:
+            clauses.append('m.user_id = %s')
+            params.append(user_id)
+        if since:
+            clauses.append('m.timestamp >= %s')
+            params.append(connection.ops.adapt_datetimefield_value(since))
+        if until:
+            clauses.append('m.timestamp < %s')
+            params.append(connection.ops.adapt_datetimefield_value(until))
+        return ''.join(f' AND {clause}' for clause in clauses), params
+
+
+class SQLiteFTSBackend(SearchBackend):
+    """FTS5 MATCH ranked with bm25()"""
+
+    @staticmethod
+    def match_expression(query):
+        terms = []
+        for term in search_terms(query):
+            prefix = term.endswith('*')
+            term = term.rstrip('*')
+            terms.append(f'"{term}"*' if prefix else f'"{term}"')
+        return ' '.join(terms)
+
+    def search(self, query, room_name=None, user_id=None, since=None, until=None, limit=20, offset=0,
+               viewer_id=None):
+        match = self.match_expression(query)
+        if not match:
+            return []
+        where, params = self.filters(room_name, user_id, since, until, viewer_id)
+        sql = (
+            'SELECT m.id, -bm25(chat_message_fts), '
+            f"snippet(chat_message_fts, 0, %s, %s, '…', {SNIPPET_WORDS}) "
+            'FROM chat_message_fts JOIN chat_message m ON m.id = chat_message_fts.rowid '
+            f'WHERE chat_message_fts MATCH %s{where} '
+            'ORDER BY bm25(chat_message_fts) LIMIT %s OFFSET %s'
+        )
+        with connection.cursor() as cursor:
+            cursor.execute(sql, [MARK_START, MARK_END, match, *params, limit, offset])
+            return [(row[0], row[1], render_snippet(row[2])) for row in cursor.fetchall()]
+
+    def filter_queryset(self, queryset, query):
+        return queryset.filter(id__in=RawSQL(
+            'SELECT rowid FROM chat_message_fts WHERE chat_message_fts MATCH %s',
+            [self.match_expression(query) or '""'],
+        ))
+
+
+class PostgresSearchBackend(SearchBackend):
+    """search_vector @@ tsquery ranked with ts_rank_cd(); headlines only for the returned page"""
+
+    @staticmethod
+    def tsquery(query):
+        terms = []
+        for term in search_terms(query):
+            prefix = term.endswith('*')
+            term = term.rstrip('*').replace("'", "''")
+            terms.append(f"'{term}':*" if prefix else f"'{term}'")
+        return ' & '.join(terms)
+
+    def search(self, query, room_name=None, user_id=None, since=None, until=None, limit=20, offset=0,
+               viewer_id=None):
+        tsquery = self.tsquery(query)
+        if not tsquery:
+            return []
+        where, params = self.filters(room_name, user_id, since, until, viewer_id)
+        sql = (
+            'SELECT page.id, page.score, ts_headline(%s, page.content, to_tsquery(%s, %s), %s) '
+            'FROM ('
+            'SELECT m.id, m.content, ts_rank_cd(m.search_vector, q) AS score '
+            'FROM chat_message m, to_tsquery(%s, %s) q '
+            f'WHERE m.search_vector @@ q{where} '
+            'ORDER BY score DESC LIMIT %s OFFSET %s'
+            ') page ORDER BY page.score DESC'
+        )
+        options = f'StartSel={MARK_START}, StopSel={MARK_END}, MaxWords={SNIPPET_WORDS}, MinWords=5'
+        with connection.cursor() as cursor:
+            cursor.execute(sql, ['simple', 'simple', tsquery, options,
+                                 'simple', tsquery, *params, limit, offset])
+            return [(row[0], row[1], render_snippet(row[2])) for row in cursor.fetchall()]
+
+    def filter_queryset(self, queryset, query):
+        return queryset.filter(id__in=RawSQL(
+            "SELECT id FROM chat_message WHERE search_vector @@ to_tsquery('simple', %s)",
+            [self.tsquery(query) or "''"],
+        ))
+
+
+class ContainsSearchBackend(SearchBackend):
+    """Fallback for databases without a full-text index: unranked icontains"""
+
+    def search(self, query, room_name=None, user_id=None, since=None, until=None, limit=20, offset=0,
+               viewer_id=None):
+        queryset = self.filter_queryset(Message.objects.all(), query)
+        if viewer_id is not None:
+            queryset = queryset.exclude(room_name__in=hidden_room_names(viewer_id))
+        if room_name:
+            queryset = queryset.filter(room_name=room_name)
+        if user_id:
+            queryset = queryset.filter(user_id=user_id)
+        if since:
+            queryset = queryset.filter(timestamp__gte=since)
+        if until:
+            queryset = queryset.filter(timestamp__lt=until)
+        rows = queryset.order_by('-timestamp', '-id').values_list('id', 'content')[offset:offset + limit]
+        return [(pk, 0.0, html.escape(Truncator(content).words(SNIPPET_WORDS))) for pk, content in rows]
+
+    def filter_queryset(self, queryset, query):
+        for term in search_terms(query):
+            queryset = queryset.filter(content__icontains=term.rstrip('*'))
+        return queryset
+
+
+def get_search_backend():
+    if connection.vendor == 'sqlite':
+        return SQLiteFTSBackend()
+    if connection.vendor == 'postgresql':
+        return PostgresSearchBackend()
+    return ContainsSearchBackend()
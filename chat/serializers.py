@@ -1,5 +1,6 @@
 from rest_framework import serializers
 from .models import Message, ChatRoom
+from users.models import CustomUser
 from users.serializers import CustomUserSerializer
 
 class ChatRoomSerializer(serializers.ModelSerializer):
@@ -14,6 +15,15 @@ class ChatRoomSerializer(serializers.ModelSerializer):
         read_only_fields = ['id', 'created_at']
 
     def get_last_message(self, obj):
+        if hasattr(obj, 'last_message_timestamp'):
+            # Annotated by ChatRoom.objects.with_stats()
+            if obj.last_message_timestamp is None:
+                return None
+            return {
+                'content': obj.last_message_content,
+                'timestamp': obj.last_message_timestamp,
+                'user': obj.last_message_user_email or 'Anonymous'
+            }
         last_msg = obj.last_message
         if last_msg:
             return {
@@ -29,10 +39,59 @@ class MessageSerializer(serializers.ModelSerializer):
     
     class Meta:
         model = Message
-        fields = ['id', 'user', 'room_name', 'room', 'content', 'timestamp', 'edited_at', 'is_edited']
-        read_only_fields = ['id', 'timestamp', 'edited_at', 'is_edited']
+        fields = ['id', 'user', 'room_name', 'room', 'content', 'timestamp', 'edited_at', 'is_edited', 'version']
+        read_only_fields = ['id', 'timestamp', 'edited_at', 'is_edited', 'version']
 
 class MessageCreateSerializer(serializers.ModelSerializer):
     class Meta:
         model = Message
-        fields = ['room_name', 'content']
\ No newline at end of file
+        fields = ['room_name', 'content']
+
+def format_datetime(value):
+    """Same output as DRF's DateTimeField for an aware UTC datetime"""
+    if value is None:
+        return None
+    value = value.isoformat()
+    return value[:-6] + 'Z' if value.endswith('+00:00') else value
+
+
+class FlatMessageListSerializer:
+    """
+    Compact representation of a page of messages, built from `.values(*fields)`
+    rows. Messages reference their user and room by id; the `users` and `rooms`
+    maps are loaded once per page with one query each.
+    """
+    fields = ('id', 'user_id', 'room_id', 'room_name', 'content', 'timestamp', 'edited_at', 'is_edited', 'version')
+    user_fields = ('id', 'email', 'first_name', 'last_name', 'is_verified')
+    room_fields = ('id', 'name', 'display_name', 'is_private')
+
+    def __init__(self, rows):
+        self.rows = rows
+
+    @property
+    def data(self):
+        return [
+            {
+                'id': row['id'],
+                'user': row['user_id'],
+                'room': row['room_id'],
+                'room_name': row['room_name'],
+                'content': row['content'],
+                'timestamp': format_datetime(row['timestamp']),
+                'edited_at': format_datetime(row['edited_at']),
+                'is_edited': row['is_edited'],
+                # Segments archived before messages had versions lack the field
+                'version': row.get('version', 1),
+            }
+            for row in self.rows
+        ]
+
+    def sidecars(self):
+        user_ids = {row['user_id'] for row in self.rows if row['user_id'] is not None}
+        room_ids = {row['room_id'] for row in self.rows if row['room_id'] is not None}
+        users = CustomUser.objects.filter(id__in=user_ids).values(*self.user_fields) if user_ids else []
+        rooms = ChatRoom.objects.filter(id__in=room_ids).values(*self.room_fields) if room_ids else []
+        return {
+            'users': {str(user['id']): user for user in users},
+            'rooms': {str(room['id']): room for room in rooms},
+        }
@@ -0,0 +1,32 @@
+import logging
+from django.db import connections
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from .models import ChatRoom
+from .rooms import room_ids
+from .middleware import user_snapshots
+from .search import install_sqlite_triggers
+from users.models import CustomUser
+
+logger = logging.getLogger(__name__)
+
+
+@receiver(post_save, sender=ChatRoom)
+@receiver(post_delete, sender=ChatRoom)
+def invalidate_room_id(sender, instance, **kwargs):
+    room_ids.invalidate_room(instance.id, instance.name)
+
+
+@receiver(post_save, sender=CustomUser)
+@receiver(post_delete, sender=CustomUser)
+def invalidate_user_snapshot(sender, instance, **kwargs):
+    user_snapshots.invalidate(instance.pk)
+
+
+def install_search_triggers(sender, using, **kwargs):
+    """post_migrate: restore the full-text triggers a table rebuild dropped"""
+    connection = connections[using]
+    if connection.vendor == 'sqlite':
+        restored = install_sqlite_triggers(connection)
+        if restored:
+            logger.warning(f"Restored {restored} full-text search triggers and rebuilt the index")
@@ -1 +1,1433 @@
-from django.test import TestCase
+import asyncio
+import gzip
+import json
+import logging
+import os
+import shutil
+import tempfile
+from datetime import timedelta
+from io import StringIO
+from unittest import mock, skipUnless
+from asgiref.sync import sync_to_async
+from channels.routing import URLRouter
+from channels.layers import get_channel_layer
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
+from django.db import OperationalError, connection
+from django.test import AsyncClient, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.contrib.auth import get_user_model
+from django.utils import timezone
+from rest_framework import status
+from rest_framework.test import APIClient, APITestCase
+from rest_framework_simplejwt.tokens import AccessToken
+from .models import Message, MessageChange, ChatRoom, ReadCursor, MessageArchiveSegment
+from .activity import RoomActivity, save_read_cursors
+from .search import install_sqlite_triggers
+from .signals import install_search_triggers
+from .archive import archive_messages, load_segment
+from .changes import prune_changes
+from .outbound import OutboundQueue, outbound_stats
+from . import ratelimit
+from .ratelimit import TokenBucket
+from .persistence import (MessageIdGenerator, MessageWriteBehind, RedisWorkerIdClaim, WriteBehindFull,
+                          replay_dead_letters)
+from .history import RoomHistoryCache, get_room_history, history_item, load_recent_items
+from .pagination import MessageCursorPagination
+from .serializers import MessageSerializer
+from . import history as history_module
+from . import presence as presence_module
+from . import activity as activity_module
+from payments import quota as quota_module
+from .presence import CALLS_KEY, InMemoryPresenceStore, Presence, room_key
+from .rooms import RoomIdCache, room_ids, resolve_room_id
+from .routing import websocket_urlpatterns
+from .views import ChatRoomViewSet
+from . import codec
+from .middleware import JWTAuthMiddleware, UserSnapshot, get_user_from_token, load_user_snapshot, user_snapshots
+from ChatApp.log import QueueLogHandler, EventSamplingFilter, configure_logging, log_event, queue_log_handlers
+
+User = get_user_model()
+
+
+class MessageIdGeneratorTestCase(TestCase):
+    def test_ids_are_unique_and_increasing(self):
+        generator = MessageIdGenerator(worker_id=7)
+        ids = [generator.next_id() for _ in range(10000)]
+        self.assertEqual(ids, sorted(ids))
+        self.assertEqual(len(set(ids)), len(ids))
+
+    def test_ids_fit_in_bigint(self):
+        self.assertLess(MessageIdGenerator(worker_id=1023).next_id(), 2 ** 63)
+
+
+class MessageWriteBehindTestCase(TransactionTestCase):
+    def setUp(self):
+        room_ids.clear()
+        self.user = User.objects.create_user(email='writer@example.com', password='testpass123')
+
+    def test_submit_assigns_id_and_timestamp_before_write(self):
+        """Test that a submitted message is usable before it reaches the database"""
+        writer = MessageWriteBehind(flush_interval=60)
+
+        async def submit():
+            return await writer.submit(self.user, 'general', 'hello')
+
+        message = asyncio.run(submit())
+        self.assertIsNotNone(message.id)
+        self.assertIsNotNone(message.timestamp)
+        self.assertEqual(writer.pending_count, 1)
+        self.assertFalse(Message.objects.exists())
+
+        writer.flush_sync()
+        saved = Message.objects.get(id=message.id)
+        self.assertEqual(saved.timestamp, message.timestamp)
+        self.assertEqual(saved.room, ChatRoom.objects.get(name='general'))
+
+    def test_batch_written_after_flush_interval(self):
+        """Test that the flusher task writes the whole batch with one bulk insert"""
+        writer = MessageWriteBehind(flush_interval=0.01)
+
+        async def submit_and_wait():
+            for i in range(50):
+                await writer.submit(self.user, 'general', f'message {i}')
+            while writer.pending_count:
+                await asyncio.sleep(0.01)
+            await writer._flush_task
+
+        asyncio.run(submit_and_wait())
+        self.assertEqual(Message.objects.filter(room_name='general').count(), 50)
+
+    def test_full_queue_refuses_new_messages(self):
+        writer = MessageWriteBehind(flush_interval=60, max_pending=3)
+
+        async def submit():
+            for i in range(3):
+                await writer.submit(self.user, 'general', f'message {i}')
+            with self.assertRaises(WriteBehindFull):
+                await writer.submit(self.user, 'general', 'one too many')
+            writer._flush_task.cancel()
+
+        asyncio.run(submit())
+        self.assertEqual([m.content for m in writer._pending], ['message 0', 'message 1', 'message 2'])
+
+    def test_rejected_rows_are_dead_lettered_and_replayed(self):
+        """Test that a row the database rejects does not hold back the rest of its batch"""
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, 'dead_letters.jsonl')
+        writer = MessageWriteBehind(flush_interval=60, dead_letter_file=path)
+        existing = Message.objects.create(user=self.user, room_name='general', content='already saved')
+
+        async def submit():
+            first = await writer.submit(self.user, 'general', 'first')
+            duplicate = await writer.submit(self.user, 'general', 'duplicate id')
+            duplicate.id = existing.id
+            await writer.submit(self.user, 'general', 'last')
+            await writer.flush()
+            writer._flush_task.cancel()
+            return first
+
+        first = asyncio.run(submit())
+        self.assertEqual(writer.pending_count, 0)
+        self.assertEqual([m.content for m in writer.dead_letters], ['duplicate id'])
+        self.assertTrue(Message.objects.filter(id=first.id).exists())
+        self.assertEqual(Message.objects.filter(content='last').count(), 1)
+
+        self.assertEqual(replay_dead_letters(path), (0, 1))
+        Message.objects.filter(id=existing.id).delete()
+        self.assertEqual(replay_dead_letters(path), (1, 0))
+        self.assertEqual(Message.objects.get(id=existing.id).content, 'duplicate id')
+        shutil.rmtree(directory)
+
+    def test_outage_is_retried_with_backoff_until_written(self):
+        writer = MessageWriteBehind(flush_interval=0.001, max_backoff=0.01)
+        self.assertEqual([writer.backoff(n) for n in (1, 3, 10)], [0.002, 0.008, 0.01])
+        write = writer._write
+        attempts = []
+
+        def database_down(batch):
+            attempts.append(len(batch))
+            if len(attempts) <= 10:
+                raise OperationalError('database is down')
+            write(batch)
+
+        writer._write = database_down
+
+        async def submit():
+            message = await writer.submit(self.user, 'general', 'survives the outage')
+            await writer._flush_task
+            return message
+
+        message = asyncio.run(submit())
+        self.assertEqual(len(attempts), 11)
+        self.assertTrue(Message.objects.filter(id=message.id).exists())
+        self.assertEqual(len(writer.dead_letters), 0)
+
+    def test_worker_ids_are_claimed_uniquely(self):
+        keys = {}
+
+        class FakeRedis:
+            def set(self, key, value, nx=False, ex=None):
+                if nx and key in keys:
+                    return False
+                keys[key] = value
+                return True
+
+        with mock.patch('ChatApp.redis_client.get_redis', return_value=FakeRedis()), \
+                mock.patch.object(RedisWorkerIdClaim, '_refresh'):
+            claimed = [RedisWorkerIdClaim().claim() for _ in range(3)]
+        self.assertEqual(claimed, [0, 1, 2])
+
+        with mock.patch('ChatApp.redis_client.get_redis', side_effect=ConnectionError('no redis')):
+            with self.assertRaises(ImproperlyConfigured):
+                RedisWorkerIdClaim().claim()
+
+    @override_settings(CHAT_WRITE_BEHIND={'ENABLED': True, 'WORKER_ID': 1})
+    def test_save_uses_same_id_sequence(self):
+        message = Message.objects.create(user=self.user, room_name='general', content='hi')
+        self.assertGreater(message.id, 2 ** 32)
+
+
+class RoomHistoryCacheTestCase(TransactionTestCase):
+    def setUp(self):
+        room_ids.clear()
+        self.user = User.objects.create_user(email='history@example.com', password='testpass123')
+        for i in range(30):
+            Message.objects.create(user=self.user, room_name='general', content=f'message {i}')
+
+    def test_connect_storm_loads_room_once(self):
+        """Test that concurrent connects share one database load"""
+        cache = RoomHistoryCache(size=20)
+        cache.subscribe('general')
+
+        async def connect_many():
+            return await asyncio.gather(*[cache.get_frame('general') for _ in range(50)])
+
+        with mock.patch.object(RoomHistoryCache, 'load_recent', wraps=cache.load_recent) as load:
+            frames = asyncio.run(connect_many())
+            asyncio.run(connect_many())
+        self.assertEqual(load.call_count, 1)
+        messages = json.loads(frames[0])['messages']
+        self.assertEqual(len(messages), 20)
+        self.assertEqual(messages[-1]['message'], 'message 29')
+
+    def test_append_and_invalidate(self):
+        cache = RoomHistoryCache(size=20)
+        cache.subscribe('general')
+        asyncio.run(cache.get_frame('general'))
+
+        item = history_item(10 ** 12, 'live', 'history@example.com', self.user.id, '2025-01-01T00:00:00+00:00')
+        cache.append('general', item)
+        cache.append('general', item)
+        messages = json.loads(asyncio.run(cache.get_frame('general')))['messages']
+        self.assertEqual(messages[-1]['message'], 'live')
+        self.assertEqual(messages[-2]['message'], 'message 29')
+
+        cache.invalidate('general')
+        messages = json.loads(asyncio.run(cache.get_frame('general')))['messages']
+        self.assertEqual(messages[-1]['message'], 'message 29')
+
+    def test_room_dropped_after_last_unsubscribe(self):
+        cache = RoomHistoryCache(size=20)
+        cache.subscribe('general')
+        asyncio.run(cache.get_frame('general'))
+        cache.unsubscribe('general')
+        self.assertNotIn('general', cache._rooms)
+
+
+class MessageCursorPaginationTestCase(APITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(email='pager@example.com', password='testpass123')
+        room = ChatRoom.objects.create(name='general')
+        start = timezone.now() - timedelta(days=30)
+        Message.objects.bulk_create([
+            Message(user=cls.user, room=room, room_name='general', content=f'message {i}',
+                    timestamp=start + timedelta(seconds=i // 2))
+            for i in range(10000)
+        ])
+        small = ChatRoom.objects.create(name='small')
+        Message.objects.bulk_create([
+            Message(user=cls.user, room=small, room_name='small', content=f'message {i}',
+                    timestamp=start + timedelta(seconds=i // 2))
+            for i in range(120)
+        ])
+
+    def setUp(self):
+        self.client.force_authenticate(self.user)
+
+    def test_scrolling_visits_every_message_once(self):
+        seen = []
+        url = '/api/chat/messages/room/small/?limit=25'
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            seen = [m['id'] for m in response.data['results']] + seen
+            url = response.data['older']
+        self.assertEqual(len(seen), 120)
+        self.assertEqual(seen, sorted(seen))
+
+    def test_after_cursor_returns_newer_messages(self):
+        response = self.client.get('/api/chat/messages/?room=general&limit=5')
+        newest = response.data['results'][0]['id']
+        response = self.client.get('/api/chat/messages/?room=general&limit=5&before=' + response.data['before'])
+        self.assertTrue(all(m['id'] < newest - 4 for m in response.data['results']))
+
+        response = self.client.get('/api/chat/messages/?room=general&limit=50&after=' + response.data['after'])
+        self.assertEqual([m['id'] for m in response.data['results']], list(range(newest, newest - 5, -1)))
+
+    def test_invalid_cursor(self):
+        response = self.client.get('/api/chat/messages/?before=not-a-cursor')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def _vm_steps(self, url):
+        """Count SQLite virtual machine instructions executed while serving url"""
+        steps = [0]
+
+        def count():
+            steps[0] += 1
+
+        connection.ensure_connection()
+        connection.connection.set_progress_handler(count, 1)
+        try:
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get(url)
+        finally:
+            connection.connection.set_progress_handler(None, 1)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertFalse(any('OFFSET' in q['sql'] for q in queries.captured_queries))
+        return steps[0]
+
+    @skipUnless(connection.vendor == 'sqlite', 'counts SQLite VM steps')
+    def test_deep_page_costs_the_same_as_first_page(self):
+        """Test that page 10,000 executes no more work than page 1"""
+        rows = Message.objects.filter(room_name='general').order_by('timestamp', 'id')
+        # Deep, but not the last hot page, which also looks at the room's archive segments
+        oldest = rows[2]
+        cursor = MessageCursorPagination.encode_cursor(oldest.timestamp, oldest.id)
+
+        first_page = self._vm_steps('/api/chat/messages/room/general/?limit=1')
+        deep_page = self._vm_steps(f'/api/chat/messages/room/general/?limit=1&before={cursor}')
+        self.assertLessEqual(deep_page, first_page * 1.5)
+
+
+@skipUnless(connection.vendor == 'sqlite', 'parses SQLite EXPLAIN QUERY PLAN output')
+class MessageQueryPlanTestCase(APITestCase):
+    """Every hot message query must be served by an index, without a sort step"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.users = [
+            User.objects.create_user(email=f'plan{i}@example.com', password='testpass123')
+            for i in range(5)
+        ]
+        cls.rooms = [ChatRoom.objects.create(name=f'room{i}') for i in range(5)]
+        start = timezone.now() - timedelta(days=7)
+        Message.objects.bulk_create([
+            Message(user=cls.users[i % 5], room=cls.rooms[i % 5], room_name=f'room{i % 5}',
+                    content=f'message {i}', timestamp=start + timedelta(seconds=i))
+            for i in range(2000)
+        ])
+
+    def setUp(self):
+        self.client.force_authenticate(self.users[0])
+
+    def assertIndexedPlans(self, queries):
+        message_queries = [q['sql'] for q in queries if '"chat_message"' in q['sql']]
+        self.assertTrue(message_queries)
+        for sql in message_queries:
+            with connection.cursor() as cursor:
+                cursor.execute('EXPLAIN QUERY PLAN ' + sql)
+                plan = [row[-1] for row in cursor.fetchall()]
+            for step in plan:
+                self.assertNotIn('TEMP B-TREE', step, f'{sql}\n{plan}')
+                if step.startswith('SCAN chat_message'):
+                    self.assertIn('INDEX', step, f'{sql}\n{plan}')
+
+    def assertEndpointIndexed(self, url):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIndexedPlans(queries.captured_queries)
+        return response
+
+    def test_history_on_connect(self):
+        with CaptureQueriesContext(connection) as queries:
+            load_recent_items('room1', 20)
+        self.assertIndexedPlans(queries.captured_queries)
+
+    def test_room_listing(self):
+        response = self.assertEndpointIndexed('/api/chat/messages/room/room1/?limit=20')
+        self.assertEndpointIndexed(f"/api/chat/messages/room/room1/?limit=20&before={response.data['before']}")
+        self.assertEndpointIndexed(f"/api/chat/messages/room/room1/?limit=20&after={response.data['before']}")
+
+    def test_message_list(self):
+        self.assertEndpointIndexed('/api/chat/messages/?limit=20')
+        self.assertEndpointIndexed('/api/chat/messages/?room=room2&limit=20')
+
+    def test_my_messages(self):
+        response = self.assertEndpointIndexed('/api/chat/messages/my_messages/?limit=20')
+        self.assertEndpointIndexed(f"/api/chat/messages/my_messages/?limit=20&before={response.data['before']}")
+
+    def test_last_message(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.assertIsNotNone(self.rooms[3].last_message)
+        self.assertIndexedPlans(queries.captured_queries)
+
+
+class RoomIdCacheTestCase(TestCase):
+    def setUp(self):
+        room_ids.clear()
+        self.user = User.objects.create_user(email='rooms@example.com', password='testpass123')
+
+    def test_message_save_is_one_insert(self):
+        Message.objects.create(user=self.user, room_name='general', content='first')
+        with self.assertNumQueries(1):
+            Message.objects.create(user=self.user, room_name='general', content='second')
+
+    def test_rename_and_delete_invalidate(self):
+        room_id = resolve_room_id('general')
+        room = ChatRoom.objects.get(id=room_id)
+        room.name = 'renamed'
+        room.save()
+        self.assertIsNone(room_ids.get('general'))
+        self.assertNotEqual(resolve_room_id('general'), room_id)
+
+        ChatRoom.objects.filter(name='general').get().delete()
+        self.assertIsNone(room_ids.get('general'))
+
+    def test_cache_is_bounded(self):
+        cache = RoomIdCache(max_size=2)
+        for i in range(3):
+            cache.set(f'room{i}', i)
+        self.assertIsNone(cache.get('room0'))
+        self.assertEqual(cache.get('room2'), 2)
+
+
+@override_settings(CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}})
+class ChatConsumerBroadcastTestCase(TransactionTestCase):
+    def test_receivers_get_identical_frame(self):
+        async def scenario():
+            application = URLRouter(websocket_urlpatterns)
+            sockets = [WebsocketCommunicator(application, '/ws/chat/lobby/') for _ in range(3)]
+            for socket in sockets:
+                connected, _ = await socket.connect()
+                self.assertTrue(connected)
+                await socket.receive_json_from()
+
+            await sockets[0].send_to(text_data=json.dumps({'message': 'hello'}))
+            frames = [await socket.receive_from() for socket in sockets]
+            for socket in sockets:
+                await socket.disconnect()
+            return frames
+
+        frames = asyncio.run(scenario())
+        self.assertEqual(len(set(frames)), 1)
+        frame = json.loads(frames[0])
+        self.assertEqual(frame['type'], 'chat_message')
+        self.assertEqual(frame['message'], 'hello')
+        self.assertNotIn('text', frame)
+
+    def test_msgpack_subprotocol_mixes_with_json_clients(self):
+        async def scenario():
+            application = URLRouter(websocket_urlpatterns)
+            binary = WebsocketCommunicator(application, '/ws/chat/lobby/', subprotocols=['chat.msgpack'])
+            text = WebsocketCommunicator(application, '/ws/chat/lobby/')
+            connected, subprotocol = await binary.connect()
+            self.assertTrue(connected)
+            self.assertEqual(subprotocol, 'chat.msgpack')
+            welcome = codec.unpackb((await binary.receive_output())['bytes'])
+            await text.connect()
+            await text.receive_from()
+
+            await binary.send_to(bytes_data=codec.packb({'message': 'hi'}))
+            binary_frame = (await binary.receive_output())['bytes']
+            text_frame = await text.receive_from()
+            await binary.disconnect()
+            await text.disconnect()
+            return welcome, binary_frame, text_frame
+
+        welcome, binary_frame, text_frame = asyncio.run(scenario())
+        self.assertEqual(welcome['type'], 'connection_established')
+        self.assertEqual(codec.unpackb(binary_frame), json.loads(text_frame))
+        self.assertEqual(json.loads(text_frame)['message'], 'hi')
+
+    def test_group_event_is_encoded_once_per_format(self):
+        event = codec.group_event({'type': 'chat_message', 'message': 'hi'})
+        self.assertEqual(set(event), {'type', 'frame', 'frame_id'})
+        frames = codec.EncodedFrames(size=2)
+        with mock.patch.object(codec, 'dumps', wraps=codec.dumps) as dumps:
+            text = frames.get(event, False)
+            self.assertIs(frames.get(event, False), text)
+        self.assertEqual(dumps.call_count, 1)
+        self.assertEqual(codec.unpackb(frames.get(event, True)), json.loads(text))
+
+    def test_msgpack_only_values_are_rejected(self):
+        async def scenario():
+            binary = WebsocketCommunicator(URLRouter(websocket_urlpatterns), '/ws/chat/lobby/',
+                                           subprotocols=['chat.msgpack'])
+            await binary.connect()
+            await binary.receive_output()
+            errors = []
+            for frame in ({'message': b'raw bytes'}, {'message': 'hi', 'extra': {1: 'x'}}, {'message': 7}):
+                await binary.send_to(bytes_data=codec.packb(frame))
+                errors.append(codec.unpackb((await binary.receive_output())['bytes']))
+            await binary.disconnect()
+            return errors
+
+        errors = asyncio.run(scenario())
+        self.assertEqual([error['type'] for error in errors], ['error'] * 3)
+        self.assertEqual(errors[0]['message'], 'Malformed MessagePack')
+        self.assertEqual(errors[2]['message'], 'Message content must be a string')
+        self.assertFalse(codec.json_safe({'nested': [b'x']}))
+        self.assertTrue(codec.json_safe({'sdp': 'v=0', 'candidates': [{'index': 0, 'ok': True, 'rtt': 1.5}]}))
+
+    def test_text_frames_with_ints_msgpack_cannot_encode_are_rejected(self):
+        async def scenario():
+            communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), '/ws/chat/lobby/')
+            await communicator.connect()
+            await communicator.receive_json_from()
+            await communicator.send_to(text_data=json.dumps({'message': 'hi', 'n': 2 ** 70}))
+            error = await communicator.receive_json_from()
+            await communicator.disconnect()
+            return error
+
+        # The stdlib parser keeps big ints exact, which packb cannot encode
+        with mock.patch.object(codec, 'loads', json.loads):
+            error = asyncio.run(scenario())
+        self.assertEqual(error['message'], 'Malformed JSON')
+
+
+class StructuredLoggingTestCase(TestCase):
+    def setUp(self):
+        self.records = []
+        self.target = logging.Handler()
+        self.target.emit = self.records.append
+        self.target.set_name('test_target')
+        self.logger = logging.getLogger('chat.tests.structured')
+        self.logger.propagate = False
+        self.logger.setLevel(logging.INFO)
+
+    def tearDown(self):
+        for handler in list(self.logger.handlers):
+            self.logger.removeHandler(handler)
+            if isinstance(handler, QueueLogHandler):
+                handler.close()
+
+    def test_records_are_written_by_the_listener_thread(self):
+        handler = QueueLogHandler(handlers=['test_target'])
+        handler.start([self.target])
+        self.logger.addHandler(handler)
+        log_event(self.logger, 'chat_message', room='lobby', message_id=7)
+        handler.stop()
+        self.assertEqual(len(self.records), 1)
+        record = self.records[0]
+        self.assertEqual(record.getMessage(), 'chat_message room=lobby message_id=7')
+        self.assertEqual(record.fields, {'room': 'lobby', 'message_id': 7})
+        self.assertEqual(record.funcName, 'test_records_are_written_by_the_listener_thread')
+
+    def test_full_queue_drops_instead_of_blocking(self):
+        handler = QueueLogHandler(handlers=['test_target'], maxsize=1)
+        self.logger.addHandler(handler)
+        for _ in range(3):
+            self.logger.info('burst')
+        self.assertEqual(handler.dropped, 2)
+        self.assertIn(handler, queue_log_handlers())
+
+    def test_configure_logging_starts_the_listener_on_named_handlers(self):
+        self.addCleanup(configure_logging, settings.LOGGING)
+        configure_logging({
+            'version': 1,
+            'disable_existing_loggers': False,
+            'handlers': {
+                'a_queue': {'()': 'ChatApp.log.QueueLogHandler', 'handlers': ['target']},
+                'target': {'()': lambda: self.target},
+            },
+            'loggers': {'chat.tests.structured': {'handlers': ['a_queue'], 'propagate': False}},
+        })
+        handler = self.logger.handlers[0]
+        self.logger.info('configured')
+        handler.stop()
+        self.assertEqual([r.getMessage() for r in self.records], ['configured'])
+
+    def test_sampling_applies_to_listed_events_below_warning(self):
+        sampler = EventSamplingFilter({'chat_message': 0.0})
+        self.target.addFilter(sampler)
+        self.logger.addHandler(self.target)
+        log_event(self.logger, 'chat_message', room='lobby')
+        log_event(self.logger, 'chat_message', level=logging.ERROR, room='lobby')
+        log_event(self.logger, 'ws_connect', room='lobby')
+        self.assertEqual([r.levelno for r in self.records], [logging.ERROR, logging.INFO])
+        self.assertEqual(self.records[1].event, 'ws_connect')
+
+
+@override_settings(CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}})
+class JWTAuthMiddlewareTestCase(TransactionTestCase):
+    def setUp(self):
+        room_ids.clear()
+        user_snapshots.clear()
+        self.user = get_user_model().objects.create_user(email='ws@example.com', password='pass1234')
+        self.token = str(AccessToken.for_user(self.user))
+
+    def test_snapshot_is_cached_until_the_user_changes(self):
+        with self.assertNumQueries(1):
+            snapshot = load_user_snapshot(self.user.id)
+        with self.assertNumQueries(0):
+            self.assertIs(load_user_snapshot(self.user.id), snapshot)
+        self.assertIsInstance(asyncio.run(get_user_from_token(self.token)), UserSnapshot)
+
+        self.user.is_active = False
+        self.user.save()
+        self.assertIsNone(load_user_snapshot(self.user.id))
+        self.assertTrue(asyncio.run(get_user_from_token(self.token)).is_anonymous)
+
+    def test_invalid_token_is_anonymous(self):
+        self.assertTrue(asyncio.run(get_user_from_token('not-a-token')).is_anonymous)
+
+    def test_token_from_subprotocol_header(self):
+        async def handshake(subprotocols):
+            application = JWTAuthMiddleware(URLRouter(websocket_urlpatterns))
+            socket = WebsocketCommunicator(application, '/ws/chat/lobby/', subprotocols=subprotocols)
+            connected, subprotocol = await socket.connect()
+            self.assertTrue(connected)
+            output = await socket.receive_output()
+            await socket.disconnect()
+            welcome = codec.unpackb(output['bytes']) if 'bytes' in output else json.loads(output['text'])
+            return subprotocol, welcome['user']
+
+        self.assertEqual(
+            asyncio.run(handshake(['access_token', self.token])),
+            ('access_token', 'ws@example.com')
+        )
+        self.assertEqual(
+            asyncio.run(handshake(['access_token', self.token, 'chat.msgpack'])),
+            ('chat.msgpack', 'ws@example.com')
+        )
+
+
+class ChatRoomListQueryTestCase(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(email='rooms@example.com', password='testpass123')
+        self.client.force_authenticate(self.user)
+
+    def make_rooms(self, count):
+        for i in range(count):
+            room = ChatRoom.objects.create(name=f'room{ChatRoom.objects.count()}', created_by=self.user)
+            room.participants.add(self.user)
+            Message.objects.create(user=self.user, room=room, room_name=room.name, content=f'last in {room.name}')
+
+    def test_listing_rooms_takes_constant_queries(self):
+        self.make_rooms(3)
+        with CaptureQueriesContext(connection) as few:
+            self.client.get('/api/chat/rooms/')
+        self.make_rooms(30)
+        with CaptureQueriesContext(connection) as many:
+            response = self.client.get('/api/chat/rooms/my_rooms/')
+        self.assertEqual(len(response.data), 33)
+        self.assertEqual(len(many), len(few))
+        self.assertLessEqual(len(many), 2)
+
+    def test_annotated_stats_match_the_properties(self):
+        self.make_rooms(1)
+        empty = ChatRoom.objects.create(name='empty')
+        Message.objects.create(user=None, room=ChatRoom.objects.get(name='room0'), room_name='room0', content='anon')
+
+        response = self.client.get('/api/chat/rooms/')
+        rooms = {room['name']: room for room in response.data}
+        self.assertEqual(rooms['room0']['participant_count'], 1)
+        self.assertEqual(rooms['room0']['last_message']['content'], 'anon')
+        self.assertEqual(rooms['room0']['last_message']['user'], 'Anonymous')
+        self.assertEqual(rooms['empty']['participant_count'], empty.participant_count)
+        self.assertIsNone(rooms['empty']['last_message'])
+
+
+class FlatMessageListTestCase(APITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.users = [User.objects.create_user(email=f'flat{i}@example.com', password='testpass123') for i in range(3)]
+        rooms = [ChatRoom.objects.create(name=f'flat{i}') for i in range(2)]
+        Message.objects.bulk_create([
+            Message(user=cls.users[i % 3], room=rooms[i % 2], room_name=rooms[i % 2].name, content=f'm{i}')
+            for i in range(60)
+        ])
+
+    def setUp(self):
+        self.client.force_authenticate(self.users[0])
+
+    def test_page_references_users_and_rooms_by_id(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/api/chat/messages/?limit=60')
+        self.assertEqual(len(queries), 3)
+        self.assertEqual(len(response.data['results']), 60)
+        self.assertEqual(set(response.data['users']), {str(user.id) for user in self.users})
+        self.assertEqual(len(response.data['rooms']), 2)
+
+        first = response.data['results'][0]
+        self.assertEqual(response.data['users'][str(first['user'])]['email'], Message.objects.get(id=first['id']).user.email)
+        expected = MessageSerializer(Message.objects.get(id=first['id'])).data
+        for field in ('id', 'room_name', 'content', 'timestamp', 'edited_at', 'is_edited'):
+            self.assertEqual(first[field], expected[field])
+
+
+
+@skipUnless(connection.vendor == 'sqlite', 'FTS5 index')
+class MessageSearchTestCase(APITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.users = [User.objects.create_user(email=f'search{i}@example.com', password='testpass123') for i in range(2)]
+        cls.rooms = [ChatRoom.objects.create(name=f'search{i}') for i in range(2)]
+        cls.start = timezone.now() - timedelta(days=2)
+        Message.objects.bulk_create([
+            Message(user=cls.users[0], room=cls.rooms[0], room_name='search0',
+                    content='deploy the <b>rocket</b> rocket today', timestamp=cls.start),
+            Message(user=cls.users[1], room=cls.rooms[0], room_name='search0',
+                    content='a rocket was mentioned once among many other words here', timestamp=cls.start + timedelta(days=1)),
+            Message(user=cls.users[1], room=cls.rooms[1], room_name='search1',
+                    content='rockets in another room', timestamp=cls.start + timedelta(days=1)),
+            Message(user=cls.users[0], room=cls.rooms[1], room_name='search1',
+                    content='nothing relevant', timestamp=cls.start),
+        ])
+
+    def setUp(self):
+        self.client.force_authenticate(self.users[0])
+
+    def search(self, query, **params):
+        response = self.client.get('/api/chat/messages/search/', {'q': query, **params})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response.data
+
+    def test_ranked_results_with_escaped_snippets(self):
+        data = self.search('rocket')
+        self.assertEqual([r['content'][:6] for r in data['results']], ['deploy', 'a rock'])
+        self.assertGreater(data['results'][0]['score'], data['results'][1]['score'])
+        self.assertIn('&lt;b&gt;<mark>rocket</mark>&lt;/b&gt;', data['results'][0]['snippet'])
+        self.assertEqual(data['users'][str(self.users[0].id)]['email'], 'search0@example.com')
+        self.assertEqual(len(self.search('rocket*')['results']), 3)
+
+    def test_filters(self):
+        self.assertEqual(len(self.search('rocket*', room='search1')['results']), 1)
+        self.assertEqual(len(self.search('rocket*', user=self.users[1].id)['results']), 2)
+        since = (self.start + timedelta(hours=12)).isoformat()
+        self.assertEqual(len(self.search('rocket*', since=since)['results']), 2)
+        self.assertEqual(len(self.search('rocket*', until=since)['results']), 1)
+        self.assertEqual(self.client.get('/api/chat/messages/search/?q=').status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.client.get('/api/chat/messages/search/?q=x&since=soon').status_code,
+                         status.HTTP_400_BAD_REQUEST)
+
+    def test_index_follows_writes(self):
+        message = Message.objects.create(user=self.users[0], room=self.rooms[0], room_name='search0', content='zebra')
+        self.assertEqual([r['id'] for r in self.search('zebra')['results']], [message.id])
+        Message.objects.filter(id=message.id).update(content='giraffe')
+        self.assertEqual(self.search('zebra')['results'], [])
+        self.assertEqual(len(self.search('giraffe')['results']), 1)
+        message.delete()
+        self.assertEqual(self.search('giraffe')['results'], [])
+
+    def test_private_rooms_are_searched_by_participants_only(self):
+        self.rooms[1].is_private = True
+        self.rooms[1].save()
+        self.rooms[1].participants.add(self.users[1])
+        self.assertEqual([r['room_name'] for r in self.search('rocket*')['results']], ['search0', 'search0'])
+        self.client.force_authenticate(self.users[1])
+        self.assertEqual(len(self.search('rocket*')['results']), 3)
+
+    def test_dropped_triggers_are_restored_after_migrate(self):
+        with connection.cursor() as cursor:
+            cursor.execute('DROP TRIGGER chat_message_fts_ai')
+        Message.objects.create(user=self.users[0], room=self.rooms[0], room_name='search0', content='unindexed')
+        self.assertEqual(self.search('unindexed')['results'], [])
+        install_search_triggers(sender=None, using='default')
+        self.assertEqual(len(self.search('unindexed')['results']), 1)
+        self.assertEqual(install_sqlite_triggers(connection), 0)
+
+    def test_uses_fts_index(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.search('rocket', room='search0')
+        sql = next(q['sql'] for q in queries.captured_queries if 'MATCH' in q['sql'])
+        with connection.cursor() as cursor:
+            cursor.execute('EXPLAIN QUERY PLAN ' + sql)
+            plan = [row[-1] for row in cursor.fetchall()]
+        self.assertTrue(any('VIRTUAL TABLE INDEX' in step for step in plan), plan)
+        self.assertFalse(any(step.startswith('SCAN m') or step.startswith('SCAN chat_message ') for step in plan), plan)
+
+
+
+@override_settings(CHAT_ARCHIVE={'AFTER_DAYS': 30, 'ROOMS': {'keep': None}, 'SEGMENT_SIZE': 8})
+class MessageArchiveTestCase(APITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(email='archive@example.com', password='testpass123')
+        room = ChatRoom.objects.create(name='old')
+        now = timezone.now()
+        Message.objects.bulk_create([
+            Message(user=cls.user, room=room, room_name='old', content=f'old {i}',
+                    timestamp=now - timedelta(days=100 - i))
+            for i in range(30)
+        ] + [
+            Message(user=cls.user, room=room, room_name='old', content=f'new {i}',
+                    timestamp=now - timedelta(minutes=10 - i))
+            for i in range(10)
+        ] + [
+            Message(user=cls.user, room_name='keep', content='kept', timestamp=now - timedelta(days=100)),
+        ])
+        cls.keys = list(Message.objects.filter(room_name='old').order_by('timestamp', 'id').values_list('timestamp', 'id'))
+        cls.expected = [pk for _, pk in cls.keys]
+
+    def setUp(self):
+        load_segment.cache_clear()
+        self.client.force_authenticate(self.user)
+
+    def walk(self, url, param):
+        ids, cursor = [], None
+        while True:
+            response = self.client.get(url + (f'&{param}={cursor}' if cursor else ''))
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            page = [row['id'] for row in response.data['results']]
+            if param == 'before':
+                ids = page + ids
+            else:
+                ids += page
+            cursor = response.data[param]
+            if not page or cursor is None:
+                return ids
+
+    def test_archive_moves_old_messages_into_segments(self):
+        self.assertEqual(archive_messages(), {'old': 30})
+        self.assertEqual(Message.objects.filter(room_name='old').count(), 10)
+        self.assertTrue(Message.objects.filter(room_name='keep').exists())
+        self.assertEqual(
+            list(MessageArchiveSegment.objects.order_by('id').values_list('message_count', flat=True)),
+            [8, 8, 8, 6],
+        )
+        self.assertEqual(archive_messages(), {})
+
+    def test_cursor_pages_fall_through_to_archive(self):
+        archive_messages()
+        self.assertEqual(self.walk('/api/chat/messages/room/old/?limit=7', 'before'), self.expected)
+
+        response = self.client.get('/api/chat/messages/room/old/?limit=3&before=' + MessageCursorPagination.encode_cursor(*self.keys[5]))
+        self.assertEqual([row['id'] for row in response.data['results']], self.expected[2:5])
+        self.assertEqual(response.data['results'][0]['content'], 'old 2')
+        self.assertEqual(response.data['users'][str(self.user.id)]['email'], 'archive@example.com')
+
+        after = self.walk('/api/chat/messages/room/old/?limit=7&after=' + MessageCursorPagination.encode_cursor(*self.keys[0]), 'after')
+        self.assertEqual(after, self.expected[1:])
+
+        response = self.client.get('/api/chat/messages/?room=old&limit=15')
+        self.assertEqual([row['id'] for row in response.data['results']], self.expected[:-16:-1])
+        self.assertTrue(response.data['archive_included'])
+
+    def test_cross_room_lists_flag_that_the_archive_is_left_out(self):
+        archive_messages()
+        for url in ('/api/chat/messages/my_messages/?limit=100', '/api/chat/messages/?limit=100'):
+            response = self.client.get(url)
+            self.assertFalse(response.data['archive_included'])
+            self.assertEqual(len(response.data['results']), 11)
+
+    def test_search_flags_that_the_archive_is_left_out(self):
+        self.assertEqual(len(self.client.get('/api/chat/messages/search/?q=old&limit=100').data['results']), 30)
+        archive_messages()
+        response = self.client.get('/api/chat/messages/search/?q=old&limit=100')
+        self.assertEqual(response.data['results'], [])
+        self.assertFalse(response.data['archive_included'])
+
+
+
+@override_settings(CHAT_ARCHIVE={'AFTER_DAYS': 30, 'ROOMS': {}, 'SEGMENT_SIZE': 4})
+@mock.patch.object(ChatRoomViewSet, 'export_chunk_size', 4)
+class RoomExportTestCase(APITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(email='export@example.com', password='testpass123')
+        cls.room = ChatRoom.objects.create(name='export')
+        now = timezone.now()
+        Message.objects.bulk_create([
+            Message(user=cls.user, room=cls.room, room_name='export', content=f'message {i}',
+                    timestamp=now - (timedelta(days=100 - i) if i < 10 else timedelta(minutes=30 - i)))
+            for i in range(25)
+        ])
+        cls.expected = list(Message.objects.filter(room_name='export').order_by('timestamp', 'id').values_list('id', flat=True))
+        archive_messages()
+
+    def setUp(self):
+        load_segment.cache_clear()
+        self.client.force_authenticate(self.user)
+
+    def export(self, query=''):
+        response = self.client.get(f'/api/chat/rooms/{self.room.id}/export/{query}')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        chunks = list(response.streaming_content)
+        return response, chunks
+
+    def ids(self, chunks):
+        return [json.loads(line)['id'] for line in b''.join(chunks).decode().splitlines()]
+
+    def test_streams_archive_and_hot_messages_in_chunks(self):
+        self.assertEqual(MessageArchiveSegment.objects.count(), 3)
+        response, chunks = self.export()
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        self.assertEqual(self.ids(chunks), self.expected)
+        self.assertGreaterEqual(len(chunks), 7)
+        first = json.loads(chunks[0].splitlines()[0])
+        self.assertEqual((first['content'], first['room_name'], first['user']), ('message 0', 'export', self.user.id))
+
+    def test_gzip(self):
+        response, chunks = self.export('?gzip=1')
+        self.assertEqual(response['Content-Disposition'], 'attachment; filename="export.ndjson.gz"')
+        self.assertEqual(gzip.decompress(b''.join(chunks)), b''.join(self.export()[1]))
+
+    def test_resume_after_message(self):
+        self.assertEqual(self.ids(self.export(f'?after={self.expected[5]}')[1]), self.expected[6:])
+        self.assertEqual(self.ids(self.export(f'?after={self.expected[20]}')[1]), self.expected[21:])
+        response = self.client.get(f'/api/chat/rooms/{self.room.id}/export/?after=999999')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    async def test_asgi_streams_asynchronously(self):
+        response = await AsyncClient().get(
+            f'/api/chat/rooms/{self.room.id}/export/',
+            headers={'Authorization': f'Bearer {AccessToken.for_user(self.user)}'},
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response.is_async)
+        chunks = [chunk async for chunk in response.streaming_content]
+        self.assertEqual(self.ids(chunks), self.expected)
+
+
+
+class ChatLoadTestCommandTestCase(TransactionTestCase):
+    def setUp(self):
+        room_ids.clear()
+        user_snapshots.clear()
+        presence_module._presence = None
+
+    def test_every_scenario_delivers_all_probes(self):
+        out = StringIO()
+        call_command('chat_loadtest', clients=6, rooms=2, senders=2, messages=2, timeout=10, stdout=out)
+        results = json.loads(out.getvalue())['results']
+        self.assertEqual(set(results), {'connect_storm', 'hot_room', 'cold_rooms', 'call_burst'})
+        self.assertGreater(results['connect_storm']['connects_per_sec'], 0)
+        for scenario in ('hot_room', 'cold_rooms', 'call_burst'):
+            self.assertEqual(results[scenario]['errors'], 0, scenario)
+            self.assertEqual(results[scenario]['deliveries'], results[scenario]['expected_deliveries'], scenario)
+            self.assertIn('p99_ms', results[scenario]['fanout_latency'])
+        self.assertFalse(User.objects.filter(email__startswith='loadtest-').exists())
+
+
+class RecordingPresence(Presence):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.published = []
+
+    async def publish(self, key, joined=(), left=()):
+        self.published.append((key, list(joined), list(left)))
+
+
+class PresenceTestCase(TestCase):
+    def test_joined_and_left_once_per_user(self):
+        presence = RecordingPresence(InMemoryPresenceStore())
+
+        async def scenario():
+            await presence.join('room:a', 1, 'socket-1')
+            await presence.join('room:a', 1, 'socket-2')
+            await presence.join('room:a', 2, 'socket-3')
+            online = await presence.aonline('room:a')
+            await presence.leave('room:a', 1, 'socket-1')
+            await presence.leave('room:a', 1, 'socket-2')
+            return online
+
+        self.assertEqual(asyncio.run(scenario()), [1, 2])
+        self.assertEqual(presence.published, [
+            ('room:a', [1], []),
+            ('room:a', [2], []),
+            ('room:a', [], [1]),
+        ])
+        self.assertEqual(presence.online(['room:a', 'room:b']), {'room:a': [2], 'room:b': []})
+
+    def test_heartbeat_sweeps_connections_nobody_refreshed(self):
+        store = InMemoryPresenceStore()
+        presence = RecordingPresence(store, ttl=90)
+
+        async def scenario():
+            # A socket held by a worker that died: never refreshed, already expired
+            await store.join('room:a', 7, 'dead-socket', 0)
+            await presence.join('room:a', 1, 'socket-1')
+            await presence.heartbeat()
+
+        asyncio.run(scenario())
+        self.assertEqual(presence.published[-1], ('room:a', [], [7]))
+        self.assertEqual(presence.online(['room:a']), {'room:a': [1]})
+
+
+@override_settings(CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}})
+class PresenceConsumerTestCase(TransactionTestCase):
+    def setUp(self):
+        room_ids.clear()
+        user_snapshots.clear()
+        presence_module._presence = None
+        self.users = [
+            get_user_model().objects.create_user(email=f'online{i}@example.com', password='pass1234')
+            for i in range(2)
+        ]
+
+    def connect(self, user):
+        application = JWTAuthMiddleware(URLRouter(websocket_urlpatterns))
+        return WebsocketCommunicator(application, f'/ws/chat/lobby/?token={AccessToken.for_user(user)}')
+
+    async def receive_type(self, socket, frame_type):
+        while True:
+            frame = await socket.receive_json_from()
+            if frame['type'] == frame_type:
+                return frame
+
+    def test_sockets_receive_state_then_diffs(self):
+        first_id, second_id = self.users[0].id, self.users[1].id
+
+        async def scenario():
+            first = self.connect(self.users[0])
+            await first.connect()
+            state = await self.receive_type(first, 'presence_state')
+            await self.receive_type(first, 'presence')
+
+            second = self.connect(self.users[1])
+            await second.connect()
+            joined = await self.receive_type(first, 'presence')
+            await second.disconnect()
+            left = await self.receive_type(first, 'presence')
+            await first.disconnect()
+            return state, joined, left
+
+        state, joined, left = asyncio.run(scenario())
+        self.assertEqual(state['online'], [first_id])
+        self.assertEqual(joined['joined'], [second_id])
+        self.assertEqual(left['left'], [second_id])
+
+    def test_online_endpoint(self):
+        asyncio.run(presence_module.get_presence().join(room_key('lobby'), self.users[1].id, 'socket-1'))
+        asyncio.run(presence_module.get_presence().join(CALLS_KEY, self.users[1].id, 'socket-2'))
+        client = APIClient()
+        client.force_authenticate(self.users[0])
+        response = client.get(f'/api/chat/rooms/online/?rooms=lobby,empty&users={self.users[0].id},{self.users[1].id}')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data, {
+            'rooms': {'lobby': [self.users[1].id], 'empty': []},
+            'calls': [self.users[1].id],
+        })
+
+    def test_online_endpoint_hides_private_rooms_of_others(self):
+        secret = ChatRoom.objects.create(name='secret', is_private=True, created_by=self.users[1])
+        secret.participants.add(self.users[1])
+        asyncio.run(presence_module.get_presence().join(room_key('secret'), self.users[1].id, 'socket-1'))
+        client = APIClient()
+        client.force_authenticate(self.users[0])
+        response = client.get('/api/chat/rooms/online/?rooms=secret,lobby')
+        self.assertEqual(response.data, {'rooms': {'lobby': []}})
+        client.force_authenticate(self.users[1])
+        response = client.get('/api/chat/rooms/online/?rooms=secret')
+        self.assertEqual(response.data, {'rooms': {'secret': [self.users[1].id]}})
+
+
+class ReconnectResyncTestCase(TransactionTestCase):
+    def setUp(self):
+        room_ids.clear()
+        user_snapshots.clear()
+        presence_module._presence = None
+        history_module._room_history = None
+        self.user = User.objects.create_user(email='resync@example.com', password='pass1234')
+        self.messages = [
+            Message.objects.create(user=self.user, room_name='lobby', content=f'message {i}')
+            for i in range(30)
+        ]
+
+    def reconnect(self, since):
+        """The frames between connection_established and presence_state"""
+        async def scenario():
+            application = JWTAuthMiddleware(URLRouter(websocket_urlpatterns))
+            socket = WebsocketCommunicator(
+                application, f'/ws/chat/lobby/?token={AccessToken.for_user(self.user)}&since={since}'
+            )
+            await socket.connect()
+            frames = []
+            while True:
+                frame = await socket.receive_json_from()
+                if frame['type'] == 'presence_state':
+                    break
+                if frame['type'] != 'connection_established':
+                    frames.append(frame)
+            await socket.disconnect()
+            return frames
+
+        return asyncio.run(scenario())
+
+    def test_recent_gap_is_served_from_the_buffer(self):
+        frames = self.reconnect(self.messages[-5].id)
+        self.assertEqual(len(frames), 1)
+        self.assertEqual([m['message'] for m in frames[0]['messages']], [f'message {i}' for i in range(26, 30)])
+        self.assertFalse(frames[0]['more'])
+
+    def test_nothing_missed(self):
+        frames = self.reconnect(self.messages[-1].id)
+        self.assertEqual(frames, [{'type': 'message_history', 'since': self.messages[-1].id,
+                                   'messages': [], 'more': False}])
+
+    @override_settings(CHAT_RESYNC={'MAX_MESSAGES': 50, 'CHUNK_SIZE': 10})
+    def test_older_gap_is_loaded_in_chunks(self):
+        frames = self.reconnect(self.messages[2].id)
+        self.assertEqual([len(frame['messages']) for frame in frames], [10, 10, 7])
+        self.assertEqual([frame['more'] for frame in frames], [True, True, False])
+        ids = [m['id'] for frame in frames for m in frame['messages']]
+        self.assertEqual(ids, [message.id for message in self.messages[3:]])
+
+    @override_settings(CHAT_RESYNC={'MAX_MESSAGES': 10, 'CHUNK_SIZE': 10})
+    def test_large_gap_asks_for_rest(self):
+        frames = self.reconnect(self.messages[0].id)
+        self.assertEqual(frames, [{'type': 'resync', 'reason': 'gap_too_large', 'since': self.messages[0].id}])
+
+
+@override_settings(CHAT_CHANGES={'COMMIT_MARGIN': 0})
+class MessageChangeTestCase(TransactionTestCase):
+    def setUp(self):
+        room_ids.clear()
+        user_snapshots.clear()
+        presence_module._presence = None
+        history_module._room_history = None
+        quota_module._quota = None
+        self.user = User.objects.create_user(email='editor@example.com', password='pass1234')
+        self.message = Message.objects.create(user=self.user, room_name='lobby', content='first draft')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def changes(self, **params):
+        return self.client.get('/api/chat/messages/room/lobby/changes/', params)
+
+    def test_edits_and_deletes_reach_sockets_and_history(self):
+        url = f'/api/chat/messages/{self.message.id}/'
+
+        async def receive(socket, frame_type):
+            while True:
+                frame = await socket.receive_json_from()
+                if frame['type'] == frame_type:
+                    return frame
+
+        async def scenario():
+            application = JWTAuthMiddleware(URLRouter(websocket_urlpatterns))
+            socket = WebsocketCommunicator(application, f'/ws/chat/lobby/?token={AccessToken.for_user(self.user)}')
+            await socket.connect()
+            await receive(socket, 'presence_state')
+            response = await sync_to_async(self.client.patch)(url, {'content': 'second draft'}, format='json')
+            updated = await receive(socket, 'message_updated')
+            history = (await get_room_history().get('lobby')).frame()
+            await sync_to_async(self.client.delete)(url)
+            deleted = await receive(socket, 'message_deleted')
+            after_delete = (await get_room_history().get('lobby')).frame()
+            await socket.disconnect()
+            return response, updated, history, deleted, after_delete
+
+        response, updated, history, deleted, after_delete = asyncio.run(scenario())
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['version'], 2)
+        self.assertTrue(response.data['is_edited'])
+        self.assertEqual((updated['id'], updated['version'], updated['content']), (self.message.id, 2, 'second draft'))
+        self.assertEqual(json.loads(history)['messages'][-1]['message'], 'second draft')
+        self.assertEqual((deleted['id'], deleted['version']), (self.message.id, 3))
+        self.assertEqual(json.loads(after_delete)['messages'], [])
+
+    def test_rest_created_messages_reach_sockets_and_history(self):
+        async def scenario():
+            application = JWTAuthMiddleware(URLRouter(websocket_urlpatterns))
+            socket = WebsocketCommunicator(application, f'/ws/chat/lobby/?token={AccessToken.for_user(self.user)}')
+            await socket.connect()
+            while (await socket.receive_json_from())['type'] != 'presence_state':
+                pass
+            response = await sync_to_async(self.client.post)(
+                '/api/chat/messages/', {'room_name': 'lobby', 'content': 'from the api'}, format='json'
+            )
+            while True:
+                frame = await socket.receive_json_from()
+                if frame['type'] == 'chat_message':
+                    break
+            missed = await get_room_history().missed('lobby', self.message.id, 10)
+            await socket.disconnect()
+            return response, frame, missed
+
+        response, frame, missed = asyncio.run(scenario())
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        created = Message.objects.get(content='from the api')
+        self.assertEqual((frame['message_id'], frame['message'], frame['user_id']),
+                         (created.id, 'from the api', self.user.id))
+        self.assertEqual([item['id'] for item in missed], [created.id])
+
+    def test_stale_change_is_ignored_by_the_buffer(self):
+        history = history_module.RoomHistory(5)
+        history.append(history_item(1, 'v3', 'editor@example.com', self.user.id, '2025-01-01T00:00:00+00:00'))
+        history.apply_change({'type': 'message_updated', 'id': 1, 'version': 3, 'content': 'v3'})
+        history.apply_change({'type': 'message_updated', 'id': 1, 'version': 2, 'content': 'v2'})
+        self.assertEqual(history.messages[-1]['message'], 'v3')
+
+    def test_changes_endpoint(self):
+        start = self.changes().data['latest']
+        other = Message.objects.create(user=self.user, room_name='lobby', content='other')
+        for content in ('edit one', 'edit two'):
+            self.client.patch(f'/api/chat/messages/{self.message.id}/', {'content': content}, format='json')
+        self.client.delete(f'/api/chat/messages/{other.id}/')
+
+        response = self.changes(since=start)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        changes = response.data['changes']
+        self.assertEqual([(c['type'], c['id'], c['version']) for c in changes], [
+            ('message_updated', self.message.id, 3),
+            ('message_deleted', other.id, 2),
+        ])
+        self.assertEqual(changes[0]['content'], 'edit two')
+        self.assertFalse(response.data['more'])
+        self.assertEqual(self.changes(since=response.data['latest']).data['changes'], [])
+
+        # The edited content is what full-text search finds
+        found = self.client.get('/api/chat/messages/search/', {'q': 'two'}).data['results']
+        self.assertEqual([item['id'] for item in found], [self.message.id])
+
+    def test_recent_changes_wait_for_the_commit_margin(self):
+        self.client.patch(f'/api/chat/messages/{self.message.id}/', {'content': 'late'}, format='json')
+        change = MessageChange.objects.get()
+        start = change.id - 1
+        with override_settings(CHAT_CHANGES={'COMMIT_MARGIN': 60}):
+            response = self.changes(since=start)
+            self.assertEqual((response.data['changes'], response.data['latest']), ([], start))
+            # A cursor from the live frame moves back to the committed point
+            self.assertEqual(self.changes(since=change.id).data['latest'], start)
+        self.assertEqual(self.changes(since=change.id + 1).status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_pruned_changes_ask_for_reload(self):
+        for content in ('edit one', 'edit two', 'edit three'):
+            self.client.patch(f'/api/chat/messages/{self.message.id}/', {'content': content}, format='json')
+        start = MessageChange.objects.order_by('id').first().id - 1
+        self.assertEqual(prune_changes(timezone.now() + timedelta(days=365)), 2)
+        response = self.changes(since=start)
+        self.assertEqual(response.status_code, status.HTTP_410_GONE)
+        self.assertTrue(response.data['resync'])
+
+    def test_only_the_author_can_edit(self):
+        other = User.objects.create_user(email='other@example.com', password='pass1234')
+        self.client.force_authenticate(other)
+        response = self.client.patch(f'/api/chat/messages/{self.message.id}/', {'content': 'x'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+        self.assertFalse(MessageChange.objects.exists())
+
+
+@override_settings(CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}})
+class RoomActivityTestCase(TransactionTestCase):
+    def setUp(self):
+        self.users = [User.objects.create_user(email=f'typist{i}@example.com', password='pass1234') for i in range(3)]
+        self.room = ChatRoom.objects.create(name='typing')
+
+    def collect(self, *events):
+        activity = RoomActivity(window=60)
+
+        async def scenario():
+            layer = get_channel_layer()
+            channel = await layer.new_channel()
+            await layer.group_add('chat_typing', channel)
+            for event in events:
+                event(activity)
+            await activity.flush()
+            frames = []
+            while True:
+                try:
+                    frames.append(await asyncio.wait_for(layer.receive(channel), timeout=0.1))
+                except asyncio.TimeoutError:
+                    return frames
+
+        return asyncio.run(scenario())
+
+    def test_one_frame_per_window(self):
+        events = [lambda a, u=u: a.typing('typing', u.id) for u in self.users for _ in range(5)]
+        events += [lambda a, m=m: a.read_up_to('typing', self.room.id, self.users[0].id, m) for m in (5, 9, 7)]
+        frames = self.collect(*events)
+        self.assertEqual(len(frames), 1)
+        frame = frames[0]['frame']
+        self.assertEqual(frame['typing'], sorted(u.id for u in self.users))
+        self.assertEqual(frame['read'], [{'user_id': self.users[0].id, 'message_id': 9}])
+
+    def test_read_cursor_is_a_high_water_mark(self):
+        user = self.users[1]
+        self.collect(lambda a: a.read_up_to('typing', self.room.id, user.id, 40))
+        self.collect(lambda a: a.read_up_to('typing', self.room.id, user.id, 12))
+        self.assertEqual(ReadCursor.objects.get(room=self.room, user=user).last_read_message_id, 40)
+        self.collect(lambda a: a.read_up_to('typing', self.room.id, user.id, 41))
+        self.assertEqual(ReadCursor.objects.get().last_read_message_id, 41)
+
+    def test_stale_cursor_from_another_worker_does_not_move_back(self):
+        user = self.users[2]
+        save_read_cursors({(self.room.id, user.id): 50})
+        save_read_cursors({(self.room.id, user.id): 30})
+        self.assertEqual(ReadCursor.objects.get(room=self.room, user=user).last_read_message_id, 50)
+
+    def test_socket_cursor_is_capped_at_newest_message(self):
+        room_ids.clear()
+        history_module._room_history = None
+        activity_module._activity = None
+        user = self.users[0]
+        newest = Message.objects.create(user=user, room=self.room, room_name='typing', content='latest')
+
+        async def scenario():
+            application = JWTAuthMiddleware(URLRouter(websocket_urlpatterns))
+            socket = WebsocketCommunicator(application, f'/ws/chat/typing/?token={AccessToken.for_user(user)}')
+            await socket.connect()
+            await socket.send_json_to({'type': 'read_up_to', 'message_id': 2 ** 63 + 5})
+            await socket.send_json_to({'type': 'read_up_to', 'message_id': 2 ** 40})
+            while True:
+                frame = await socket.receive_json_from(timeout=2)
+                if frame['type'] == 'room_activity':
+                    break
+            await activity_module.get_room_activity()._task
+            await socket.disconnect()
+            return frame
+
+        frame = asyncio.run(scenario())
+        self.assertEqual(frame['read'], [{'user_id': user.id, 'message_id': newest.id}])
+        self.assertEqual(ReadCursor.objects.get(room=self.room, user=user).last_read_message_id, newest.id)
+
+
+class OutboundQueueTestCase(TestCase):
+    def setUp(self):
+        outbound_stats.reset()
+
+    def run_stalled(self, policy, key=None):
+        """Stall the socket on frame 0, queue frames 1-10, then let it drain"""
+        async def scenario():
+            gate = asyncio.Event()
+            delivered, closed = [], []
+
+            async def send(text_data=None, bytes_data=None):
+                await gate.wait()
+                delivered.append(json.loads(text_data) if text_data.startswith('{') else text_data)
+
+            async def close(code):
+                closed.append(code)
+
+            queue = OutboundQueue(send, lambda p: {'text_data': json.dumps(p)}, close, max_size=3, policy=policy)
+            queue.put({'text_data': '0'})
+            await asyncio.sleep(0.01)
+            for i in range(1, 11):
+                queue.put({'text_data': str(i)}, key=key)
+            gate.set()
+            await asyncio.sleep(0.01)
+            queue.close()
+            return delivered, closed
+
+        return asyncio.run(scenario())
+
+    def test_drop_oldest_keeps_newest_frames_and_hints_resync(self):
+        delivered, closed = self.run_stalled('drop_oldest')
+        self.assertEqual(delivered, ['0', {'type': 'resync', 'reason': 'slow_consumer', 'dropped': 7}, '8', '9', '10'])
+        self.assertEqual(outbound_stats.dropped, 7)
+        self.assertEqual(outbound_stats.max_depth, 3)
+        self.assertEqual(closed, [])
+
+    def test_coalesce_replaces_queued_frames_with_the_same_key(self):
+        delivered, closed = self.run_stalled('coalesce', key='room_activity')
+        self.assertEqual(delivered, ['0', '10'])
+        self.assertEqual(outbound_stats.coalesced, 9)
+        self.assertEqual(outbound_stats.dropped, 0)
+
+    def test_disconnect_closes_with_resync_hint(self):
+        delivered, closed = self.run_stalled('disconnect')
+        self.assertEqual(delivered, ['0', {'type': 'resync', 'reason': 'slow_consumer'}])
+        self.assertEqual(closed, [4008])
+        self.assertEqual(outbound_stats.snapshot()['disconnected'], 1)
+        self.assertEqual(outbound_stats.queues, 0)
+        self.assertEqual(outbound_stats.depth, 0)
+
+    def test_stalled_send_closes_the_socket(self):
+        async def scenario():
+            closed = []
+
+            async def send(text_data=None, bytes_data=None):
+                await asyncio.Event().wait()
+
+            async def close(code):
+                closed.append(code)
+
+            queue = OutboundQueue(send, lambda p: {'text_data': json.dumps(p)}, close, send_timeout=0.05)
+            queue.put({'text_data': '0'})
+            await asyncio.sleep(0.2)
+            return queue, closed
+
+        queue, closed = asyncio.run(scenario())
+        self.assertEqual(closed, [4008])
+        self.assertTrue(queue.closed)
+        self.assertEqual(outbound_stats.disconnected, 1)
+
+    def test_stats_endpoint_is_admin_only(self):
+        client = APIClient()
+        client.force_authenticate(User.objects.create_user(email='member@example.com', password='pass1234'))
+        self.assertEqual(client.get('/api/chat/stats/outbound/').status_code, status.HTTP_403_FORBIDDEN)
+        client.force_authenticate(User.objects.create_superuser(email='ops@example.com', password='pass1234'))
+        response = client.get('/api/chat/stats/outbound/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['dropped'], 0)
+
+
+@override_settings(
+    CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}},
+    CHAT_RATE_LIMIT={
+        'CONNECTION': {'RATE': 0.01, 'BURST': 20},
+        'ANONYMOUS': {'RATE': 0.01, 'BURST': 2},
+        'PLANS': {'free': {'RATE': 0.01, 'BURST': 3}},
+    },
+)
+class ChatRateLimitTestCase(TransactionTestCase):
+    def setUp(self):
+        room_ids.clear()
+        user_snapshots.clear()
+        ratelimit._limiter = None
+        quota_module._quota = None
+
+    def tearDown(self):
+        ratelimit._limiter = None
+
+    def flood(self, path, count):
+        async def scenario():
+            socket = WebsocketCommunicator(JWTAuthMiddleware(URLRouter(websocket_urlpatterns)), path)
+            await socket.connect()
+            for i in range(count):
+                await socket.send_to(text_data=json.dumps({'message': f'spam {i}'}))
+            frames = []
+            while not await socket.receive_nothing(timeout=0.2):
+                frames.append(await socket.receive_json_from())
+            await socket.disconnect()
+            return frames
+
+        return asyncio.run(scenario())
+
+    def test_token_bucket(self):
+        bucket = TokenBucket(rate=1, burst=2)
+        self.assertTrue(bucket.take())
+        self.assertTrue(bucket.take())
+        self.assertFalse(bucket.take())
+        self.assertGreater(bucket.retry_after(), 0)
+
+    def test_anonymous_socket_gets_strict_bucket(self):
+        frames = self.flood('/ws/chat/lobby/', 5)
+        errors = [f for f in frames if f.get('error_code') == 'RATE_LIMITED']
+        self.assertEqual(len([f for f in frames if f['type'] == 'chat_message']), 2)
+        self.assertEqual(len(errors), 3)
+
+    def test_user_bucket_stops_messages_before_the_quota(self):
+        user = User.objects.create_user(email='spammer@example.com', password='pass1234')
+        token = AccessToken.for_user(user)
+        with mock.patch('payments.quota.MessageQuota.aconsume', return_value=True) as aconsume:
+            frames = self.flood(f'/ws/chat/lobby/?token={token}', 6)
+        self.assertEqual(aconsume.call_count, 3)
+        self.assertEqual(len([f for f in frames if f.get('error_code') == 'RATE_LIMITED']), 3)
+        self.assertEqual(Message.objects.filter(room_name='lobby').count(), 3)
+
+    def test_quota_is_refunded_when_the_message_is_not_saved(self):
+        user = User.objects.create_user(email='unlucky@example.com', password='pass1234')
+        token = AccessToken.for_user(user)
+        with mock.patch('chat.consumers.ChatConsumer.save_message', side_effect=OperationalError('database down')), \
+                mock.patch('payments.quota.MessageQuota.arefund') as arefund:
+            frames = self.flood(f'/ws/chat/lobby/?token={token}', 1)
+        self.assertEqual(arefund.call_count, 1)
+        self.assertEqual([f['message'] for f in frames if f['type'] == 'error'], ['Server error occurred'])
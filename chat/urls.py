@@ -1,11 +1,12 @@
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
-from .views import MessageViewSet, ChatRoomViewSet
+from .views import MessageViewSet, ChatRoomViewSet, OutboundStatsView
 
 router = DefaultRouter()
 router.register(r'messages', MessageViewSet, basename='messages')
 router.register(r'rooms', ChatRoomViewSet, basename='rooms')
 
 urlpatterns = [
+    path('stats/outbound/', OutboundStatsView.as_view(), name='outbound-stats'),
     path('', include(router.urls)),
 ]
\ No newline at end of file
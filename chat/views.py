@@ -1,14 +1,29 @@
+import logging
 from rest_framework import viewsets, permissions, status
 from rest_framework.decorators import action
 from rest_framework.response import Response
+from rest_framework.views import APIView
+from django.core.handlers.asgi import ASGIRequest
 from django.db.models import Q
-from .models import Message, ChatRoom
-from .serializers import MessageSerializer, MessageCreateSerializer, ChatRoomSerializer
+from django.http import StreamingHttpResponse
+from django.utils.dateparse import parse_datetime
+from .models import Message, ChatRoom, ReadCursor
+from .serializers import MessageSerializer, MessageCreateSerializer, ChatRoomSerializer, FlatMessageListSerializer
+from .changes import (changes_since, committed_change_id, delete_message, edit_message, get_changes_config,
+                      latest_change_id, oldest_change_id, publish_message)
+from .pagination import MessageCursorPagination
+from .presence import CALLS_KEY, get_presence, room_key
+from .outbound import outbound_stats
+from .search import get_search_backend, hidden_room_names
+from .export import aiter_chunks, message_key, ndjson_chunks, room_row_chunks
+
+logger = logging.getLogger(__name__)
 
 class ChatRoomViewSet(viewsets.ModelViewSet):
-    queryset = ChatRoom.objects.all().order_by('-created_at')
+    queryset = ChatRoom.objects.with_stats().order_by('-created_at')
     serializer_class = ChatRoomSerializer
     permission_classes = [permissions.IsAuthenticated]
+    export_chunk_size = 2000
 
     def perform_create(self, serializer):
         serializer.save(created_by=self.request.user)
@@ -25,18 +40,83 @@ class ChatRoomViewSet(viewsets.ModelViewSet):
         room.participants.remove(request.user)
         return Response({'detail': f'Left room: {room.display_name}'})
 
+    @action(detail=True, methods=['get'])
+    def read_cursors(self, request, pk=None):
+        room = self.get_object()
+        cursors = ReadCursor.objects.filter(room=room).values('user_id', 'last_read_message_id', 'updated_at')
+        return Response(list(cursors))
+
+    @action(detail=True, methods=['get'])
+    def export(self, request, pk=None):
+        """
+        Stream the room's whole history, archive included, as NDJSON oldest first.
+        `?gzip=1` compresses the stream; `?after=<message id>` resumes after that message.
+        """
+        room = self.get_object()
+        if room.is_private and not room.participants.filter(id=request.user.id).exists():
+            return Response({'detail': 'Only participants can export a private room.'},
+                            status=status.HTTP_403_FORBIDDEN)
+
+        after = None
+        if request.query_params.get('after'):
+            try:
+                after = message_key(room.name, int(request.query_params['after']))
+            except ValueError:
+                after = None
+            if after is None:
+                return Response({'detail': 'after must be the id of a message in this room.'},
+                                status=status.HTTP_400_BAD_REQUEST)
+
+        compress = request.query_params.get('gzip') in ('1', 'true')
+        chunks = ndjson_chunks(room_row_chunks(room.name, after, self.export_chunk_size), compress=compress)
+        if isinstance(request._request, ASGIRequest):
+            chunks = aiter_chunks(chunks)
+        response = StreamingHttpResponse(
+            chunks, content_type='application/gzip' if compress else 'application/x-ndjson'
+        )
+        filename = f"{room.name}.ndjson{'.gz' if compress else ''}"
+        response['Content-Disposition'] = f'attachment; filename="{filename}"'
+        return response
+
+    @action(detail=False, methods=['get'])
+    def online(self, request):
+        """
+        Online user ids for `?rooms=a,b,...`, and which of `?users=1,2,...` can
+        currently receive calls. Private rooms the user is not in are omitted.
+        Costs one presence lookup per room.
+        """
+        room_names = [name for name in request.query_params.get('rooms', '').split(',') if name][:100]
+        # Private rooms the user is not in are left out, as if nobody were there
+        hidden = set(hidden_room_names(request.user.id).filter(name__in=room_names).values_list('name', flat=True))
+        room_names = [name for name in room_names if name not in hidden]
+        try:
+            user_ids = {int(i) for i in request.query_params.get('users', '').split(',') if i}
+        except ValueError:
+            return Response({'detail': 'users must be a comma separated list of ids.'},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        keys = [room_key(name) for name in room_names]
+        if user_ids:
+            keys.append(CALLS_KEY)
+        online = get_presence().online(keys) if keys else {}
+        data = {'rooms': {name: online[room_key(name)] for name in room_names}}
+        if user_ids:
+            data['calls'] = [user_id for user_id in online[CALLS_KEY] if user_id in user_ids]
+        return Response(data)
+
     @action(detail=False, methods=['get'])
     def my_rooms(self, request):
-        rooms = ChatRoom.objects.filter(participants=request.user).order_by('-created_at')
+        rooms = ChatRoom.objects.with_stats().filter(participants=request.user).order_by('-created_at')
         serializer = self.get_serializer(rooms, many=True)
         return Response(serializer.data)
 
 class MessageViewSet(viewsets.ModelViewSet):
     serializer_class = MessageSerializer
     permission_classes = [permissions.IsAuthenticated]
+    pagination_class = MessageCursorPagination
 
     def get_queryset(self):
-        queryset = Message.objects.all().order_by('-timestamp')
+        queryset = Message.objects.select_related('user', 'room__created_by').order_by('-timestamp')
         room_name = self.request.query_params.get('room', None)
         if room_name:
             queryset = queryset.filter(room_name=room_name)
@@ -48,17 +128,35 @@ class MessageViewSet(viewsets.ModelViewSet):
         return MessageSerializer
 
     def perform_create(self, serializer):
-        from payments.models import MessageUsage
+        from payments.quota import get_message_quota
         from rest_framework.exceptions import ValidationError, PermissionDenied
         
         user = self.request.user
-        message_usage, created = MessageUsage.objects.get_or_create(user=user)
-        
-        if not message_usage.can_send_message():
+        quota = get_message_quota()
+        if not quota.consume(user):
             raise PermissionDenied(detail="Message limit exceeded. Please upgrade to Pro plan.")
-            
-        serializer.save(user=user)
-        message_usage.increment_usage()
+
+        try:
+            message = serializer.save(user=user)
+        except Exception:
+            quota.refund(user)
+            raise
+        publish_message(message)
+
+    def list(self, request, *args, **kwargs):
+        room_name = request.query_params.get('room') or None
+        return self.list_messages(self.filter_queryset(self.get_queryset()), archive_room=room_name)
+
+    def list_messages(self, queryset, archive_room=None):
+        """
+        Return a page of messages in the flat format with users/rooms sidecar maps.
+        Pages of a single room continue into its archive segments; lists across
+        rooms only cover unarchived messages and say so with archive_included.
+        """
+        self.archive_room = archive_room
+        page = self.paginate_queryset(queryset.values(*FlatMessageListSerializer.fields))
+        serializer = FlatMessageListSerializer(page)
+        return self.paginator.get_paginated_response(serializer.data, sidecars=serializer.sidecars())
 
     def get_permissions(self):
         if self.action in ['update', 'partial_update', 'destroy']:
@@ -72,9 +170,11 @@ class MessageViewSet(viewsets.ModelViewSet):
                 {"detail": "You can only edit your own messages."}, 
                 status=status.HTTP_403_FORBIDDEN
             )
-        instance.is_edited = True
-        instance.save(update_fields=['is_edited'])
-        return super().update(request, *args, **kwargs)
+        serializer = self.get_serializer(instance, data=request.data, partial=kwargs.get('partial', False))
+        serializer.is_valid(raise_exception=True)
+        # Only the content is editable; the edit reaches the room's sockets as message_updated
+        edit_message(instance, serializer.validated_data.get('content', instance.content))
+        return Response(self.get_serializer(instance).data)
 
     def destroy(self, request, *args, **kwargs):
         instance = self.get_object()
@@ -83,26 +183,90 @@ class MessageViewSet(viewsets.ModelViewSet):
                 {"detail": "You can only delete your own messages."}, 
                 status=status.HTTP_403_FORBIDDEN
             )
-        return super().destroy(request, *args, **kwargs)
+        delete_message(instance)
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+    @action(detail=False, methods=['get'], url_path='room/(?P<room_name>[^/.]+)/changes')
+    def room_changes(self, request, room_name=None):
+        """
+        Edits and deletes in a room after change id `?since=`, oldest first, at
+        most one per message. Without `since` only the current change id is
+        returned, as the starting point for a client that just loaded the room.
+        """
+        if 'since' not in request.query_params:
+            return Response({'changes': [], 'latest': committed_change_id(), 'more': False})
+        try:
+            since = int(request.query_params['since'])
+        except ValueError:
+            return Response({'detail': 'since must be an integer.'}, status=status.HTTP_400_BAD_REQUEST)
+        if since > latest_change_id():
+            return Response({'detail': 'since is ahead of the newest change.'}, status=status.HTTP_400_BAD_REQUEST)
+        oldest = oldest_change_id()
+        if oldest is not None and since < oldest - 1:
+            return Response(
+                {'detail': 'Changes after this point were pruned; reload the room.', 'resync': True},
+                status=status.HTTP_410_GONE
+            )
+        changes, latest, more = changes_since(room_name, since, get_changes_config()['PAGE_SIZE'])
+        return Response({'changes': changes, 'latest': latest, 'more': more})
+
+    @action(detail=False, methods=['get'])
+    def search(self, request):
+        """
+        Ranked full-text search: `?q=` (words, `word*` for a prefix) with optional
+        `room`, `user` (id), `since`/`until` (ISO 8601), `limit` and `offset`.
+        Private rooms the user does not take part in are left out, as in `export`.
+        Archived messages leave the index, which archive_included states.
+        """
+        params = request.query_params
+        query = params.get('q', '').strip()
+        if not query:
+            return Response({'detail': 'q is required.'}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            user_id = int(params['user']) if params.get('user') else None
+            limit = max(1, min(int(params.get('limit', 20)), 100))
+            offset = max(0, int(params.get('offset', 0)))
+        except ValueError:
+            return Response({'detail': 'user, limit and offset must be integers.'},
+                            status=status.HTTP_400_BAD_REQUEST)
+        bounds = {}
+        for name in ('since', 'until'):
+            if params.get(name):
+                bounds[name] = parse_datetime(params[name])
+                if bounds[name] is None:
+                    return Response({'detail': f'{name} must be an ISO 8601 datetime.'},
+                                    status=status.HTTP_400_BAD_REQUEST)
+
+        hits = get_search_backend().search(
+            query, room_name=params.get('room') or None, user_id=user_id,
+            limit=limit, offset=offset, viewer_id=request.user.id, **bounds
+        )
+        rows = {row['id']: row for row in Message.objects.filter(
+            id__in=[hit[0] for hit in hits]
+        ).values(*FlatMessageListSerializer.fields)}
+        ranked = [rows[message_id] for message_id, _, _ in hits if message_id in rows]
+        serializer = FlatMessageListSerializer(ranked)
+        hits = {message_id: (score, snippet) for message_id, score, snippet in hits}
+        results = [
+            dict(item, score=hits[item['id']][0], snippet=hits[item['id']][1])
+            for item in serializer.data
+        ]
+        return Response({'results': results, 'archive_included': False, **serializer.sidecars()})
 
     @action(detail=False, methods=['get'], url_path='room/(?P<room_name>[^/.]+)')
     def room_messages(self, request, room_name=None):
         messages = Message.objects.filter(room_name=room_name).order_by('timestamp')
-        page = self.paginate_queryset(messages)
-        if page is not None:
-            serializer = self.get_serializer(page, many=True)
-            return self.get_paginated_response(serializer.data)
-        
-        serializer = self.get_serializer(messages, many=True)
-        return Response(serializer.data)
+        return self.list_messages(messages, archive_room=room_name)
 
     @action(detail=False, methods=['get'])
     def my_messages(self, request):
+        """The user's messages across rooms, newest first; archived ones are not included"""
         messages = Message.objects.filter(user=request.user).order_by('-timestamp')
-        page = self.paginate_queryset(messages)
-        if page is not None:
-            serializer = self.get_serializer(page, many=True)
-            return self.get_paginated_response(serializer.data)
-        
-        serializer = self.get_serializer(messages, many=True)
-        return Response(serializer.data)
\ No newline at end of file
+        return self.list_messages(messages)
+
+class OutboundStatsView(APIView):
+    """Outbound queue depth and drop counters of the WebSocket sockets served by this process"""
+    permission_classes = [permissions.IsAdminUser]
+
+    def get(self, request):
+        return Response(outbound_stats.snapshot())
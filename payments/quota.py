@@ -0,0 +1,366 @@
+import atexit
+import logging
+import threading
+import time
+from ChatApp.metrics import database_sync_to_async
+from django.conf import settings
+from django.db import IntegrityError, close_old_connections
+from django.db.models import F
+from django.utils import timezone
+from django.utils.module_loading import import_string
+from .models import MessageUsage, UserSubscription
+
+logger = logging.getLogger(__name__)
+
+COUNTER_TTL = 2 * 24 * 60 * 60
+
+QUOTA_DEFAULTS = {
+    'BACKEND': 'payments.quota.InMemoryQuotaStore',
+    'OPTIONS': {},
+    'SYNC_INTERVAL': 5,
+    'LIMIT_CACHE_TTL': 60,
+    'FREE_DAILY_LIMIT': 10,
+}
+
+_NOT_CACHED = object()
+
+# incr_if_below() results
+MISSING = -1
+DENIED = 0
+ALLOWED = 1
+
+
+class InMemoryQuotaStore:
+    """Day-bucketed counters for a single process"""
+
+    def __init__(self):
+        self._counters = {}
+        self._lock = threading.Lock()
+        self._next_prune = time.monotonic() + 3600
+
+    def get(self, key):
+        with self._lock:
+            entry = self._counters.get(key)
+            if entry is None or entry[1] < time.monotonic():
+                return None
+            return entry[0]
+
+    def seed(self, key, value, ttl=COUNTER_TTL):
+        with self._lock:
+            entry = self._counters.get(key)
+            if entry is None or entry[1] < time.monotonic():
+                self._counters[key] = [value, time.monotonic() + ttl]
+
+    def incr_if_below(self, key, limit):
+        with self._lock:
+            now = time.monotonic()
+            if now > self._next_prune:
+                self._prune(now)
+            entry = self._counters.get(key)
+            if entry is None or entry[1] < now:
+                return MISSING
+            if limit is not None and entry[0] >= limit:
+                return DENIED
+            entry[0] += 1
+            return ALLOWED
+
+    def decr(self, key):
+        with self._lock:
+            entry = self._counters.get(key)
+            if entry is not None and entry[1] >= time.monotonic() and entry[0] > 0:
+                entry[0] -= 1
+
+    def _prune(self, now):
+        self._counters = {k: v for k, v in self._counters.items() if v[1] >= now}
+        self._next_prune = now + 3600
+
+    async def aget(self, key):
+        return self.get(key)
+
+    async def aseed(self, key, value, ttl=COUNTER_TTL):
+        self.seed(key, value, ttl)
+
+    async def aincr_if_below(self, key, limit):
+        return self.incr_if_below(key, limit)
+
+    async def adecr(self, key):
+        self.decr(key)
+
+
+class RedisQuotaStore:
+    """Day-bucketed counters shared by every worker through Redis"""
+
+    INCR_IF_BELOW = """
+        local value = redis.call('GET', KEYS[1])
+        if not value then return -1 end
+        local limit = tonumber(ARGV[1])
+        if limit >= 0 and tonumber(value) >= limit then return 0 end
+        redis.call('INCR', KEYS[1])
+        return 1
+    """
+
+    DECR_IF_POSITIVE = """
+        local value = redis.call('GET', KEYS[1])
+        if value and tonumber(value) > 0 then return redis.call('DECR', KEYS[1]) end
+        return -1
+    """
+
+    def __init__(self, prefix='quota'):
+        self.prefix = prefix
+        self._script = None
+        self._decr_script = None
+        self._async_scripts = {}
+
+    def _key(self, key):
+        return f'{self.prefix}:{key}'
+
+    def get(self, key):
+        from ChatApp.redis_client import get_redis
+        value = get_redis().get(self._key(key))
+        return int(value) if value is not None else None
+
+    def seed(self, key, value, ttl=COUNTER_TTL):
+        from ChatApp.redis_client import get_redis
+        get_redis().set(self._key(key), value, nx=True, ex=ttl)
+
+    def incr_if_below(self, key, limit):
+        from ChatApp.redis_client import get_redis
+        if self._script is None:
+            self._script = get_redis().register_script(self.INCR_IF_BELOW)
+        return int(self._script(keys=[self._key(key)], args=[-1 if limit is None else limit]))
+
+    def decr(self, key):
+        from ChatApp.redis_client import get_redis
+        if self._decr_script is None:
+            self._decr_script = get_redis().register_script(self.DECR_IF_POSITIVE)
+        self._decr_script(keys=[self._key(key)])
+
+    async def aget(self, key):
+        from ChatApp.redis_client import get_async_redis
+        value = await get_async_redis().get(self._key(key))
+        return int(value) if value is not None else None
+
+    async def aseed(self, key, value, ttl=COUNTER_TTL):
+        from ChatApp.redis_client import get_async_redis
+        await get_async_redis().set(self._key(key), value, nx=True, ex=ttl)
+
+    def _async_script(self, source):
+        from ChatApp.redis_client import get_async_redis
+        client = get_async_redis()
+        script = self._async_scripts.get((id(client), source))
+        if script is None:
+            script = self._async_scripts[id(client), source] = client.register_script(source)
+        return script
+
+    async def aincr_if_below(self, key, limit):
+        script = self._async_script(self.INCR_IF_BELOW)
+        return int(await script(keys=[self._key(key)], args=[-1 if limit is None else limit]))
+
+    async def adecr(self, key):
+        await self._async_script(self.DECR_IF_POSITIVE)(keys=[self._key(key)])
+
+
+class MessageQuota:
+    """
+    Checks and counts a message against the sender's daily limit in one atomic
+    store operation. Counts are written back to MessageUsage every
+    SYNC_INTERVAL seconds instead of on every message, by a background thread
+    that runs while counts are pending.
+    """
+
+    def __init__(self, store, sync_interval=5, limit_cache_ttl=60, free_daily_limit=10):
+        self.store = store
+        self.sync_interval = sync_interval
+        self.limit_cache_ttl = limit_cache_ttl
+        self.free_daily_limit = free_daily_limit
+        self._limits = {}
+        self._pending = {}
+        self._pending_lock = threading.Lock()
+        self._last_sync = time.monotonic()
+        self._syncer = None
+
+    @staticmethod
+    def counter_key(user_id, day):
+        return f'{user_id}:{day.isoformat()}'
+
+    def consume(self, user):
+        """Count one message for user; return False if the daily limit is reached"""
+        user_id = user.pk
+        today = timezone.now().date()
+        key = self.counter_key(user_id, today)
+        limit = self._cached_limit(user_id)
+        if limit is _NOT_CACHED:
+            limit = self._load_limit(user_id)
+
+        result = self.store.incr_if_below(key, limit)
+        if result == MISSING:
+            self.store.seed(key, self._load_daily_count(user_id, today))
+            result = self.store.incr_if_below(key, limit)
+
+        if result == ALLOWED:
+            self._record(user_id, today)
+            if self.sync_due():
+                self.sync()
+        return result == ALLOWED
+
+    async def aconsume(self, user):
+        """Async variant of consume(); only touches the database on a cold cache"""
+        user_id = user.pk
+        today = timezone.now().date()
+        key = self.counter_key(user_id, today)
+        limit = self._cached_limit(user_id)
+        if limit is _NOT_CACHED:
+            limit = await database_sync_to_async(self._load_limit)(user_id)
+
+        result = await self.store.aincr_if_below(key, limit)
+        if result == MISSING:
+            count = await database_sync_to_async(self._load_daily_count)(user_id, today)
+            await self.store.aseed(key, count)
+            result = await self.store.aincr_if_below(key, limit)
+
+        if result == ALLOWED:
+            self._record(user_id, today)
+            if self.sync_due():
+                await database_sync_to_async(self.sync)()
+        return result == ALLOWED
+
+    def refund(self, user):
+        """Give back a message consume() counted, for a message that was not saved"""
+        today = timezone.now().date()
+        self.store.decr(self.counter_key(user.pk, today))
+        self._record(user.pk, today, -1)
+
+    async def arefund(self, user):
+        """Async variant of refund()"""
+        today = timezone.now().date()
+        await self.store.adecr(self.counter_key(user.pk, today))
+        self._record(user.pk, today, -1)
+
+    def _cached_limit(self, user_id):
+        cached = self._limits.get(user_id)
+        if cached is None or cached[2] < time.monotonic():
+            return _NOT_CACHED
+        return cached[0]
+
+    def get_plan(self, user_id):
+        """Return the user's plan type ('free' without an active subscription)"""
+        if self._cached_limit(user_id) is _NOT_CACHED:
+            self._load_limit(user_id)
+        return self._limits[user_id][1]
+
+    async def aget_plan(self, user_id):
+        if self._cached_limit(user_id) is _NOT_CACHED:
+            await database_sync_to_async(self._load_limit)(user_id)
+        return self._limits[user_id][1]
+
+    def invalidate_limit(self, user_id):
+        self._limits.pop(user_id, None)
+
+    def _load_limit(self, user_id):
+        limit, plan_type = self.free_daily_limit, 'free'
+        subscription = UserSubscription.objects.filter(user_id=user_id).select_related('plan').first()
+        if subscription and subscription.is_active_subscription():
+            limit, plan_type = subscription.plan.message_limit, subscription.plan.plan_type
+        self._limits[user_id] = (limit, plan_type, time.monotonic() + self.limit_cache_ttl)
+        return limit
+
+    def _load_daily_count(self, user_id, day):
+        usage = MessageUsage.objects.filter(user_id=user_id).values_list(
+            'daily_count', 'last_reset_date'
+        ).first()
+        if usage and usage[1] == day:
+            return usage[0]
+        return 0
+
+    def _record(self, user_id, day, delta=1):
+        with self._pending_lock:
+            key = (user_id, day)
+            self._pending[key] = self._pending.get(key, 0) + delta
+            if self._syncer is None:
+                self._syncer = threading.Thread(target=self._sync_periodically, name='quota-sync', daemon=True)
+                self._syncer.start()
+
+    def _sync_periodically(self):
+        """Sync every SYNC_INTERVAL until nothing is pending, so usage is current after a user stops sending"""
+        while True:
+            time.sleep(self.sync_interval)
+            try:
+                if self.sync_due():
+                    self.sync()
+            except Exception as e:
+                logger.error(f"Message usage sync failed: {e}")
+            finally:
+                close_old_connections()
+            with self._pending_lock:
+                if not self._pending:
+                    self._syncer = None
+                    return
+
+    def sync_due(self):
+        return bool(self._pending) and time.monotonic() - self._last_sync >= self.sync_interval
+
+    def sync(self):
+        """Write counts recorded since the last sync to MessageUsage"""
+        with self._pending_lock:
+            pending, self._pending = self._pending, {}
+            self._last_sync = time.monotonic()
+
+        try:
+            for (user_id, day), delta in sorted(pending.items(), key=lambda item: item[0][1]):
+                try:
+                    self._write_usage(user_id, day, delta)
+                except IntegrityError as e:
+                    # The user was deleted; retrying would fail every later sync
+                    logger.warning(f"Dropped {delta} message usage for user {user_id}: {e}")
+                del pending[(user_id, day)]
+        finally:
+            if pending:
+                with self._pending_lock:
+                    for key, delta in pending.items():
+                        self._pending[key] = self._pending.get(key, 0) + delta
+
+    def _write_usage(self, user_id, day, delta):
+        daily_count = self.store.get(self.counter_key(user_id, day))
+        if daily_count is None:
+            daily_count = delta
+        updated = MessageUsage.objects.filter(user_id=user_id).update(
+            daily_count=daily_count,
+            total_count=F('total_count') + delta,
+            last_reset_date=day,
+            updated_at=timezone.now(),
+        )
+        if not updated:
+            MessageUsage.objects.create(
+                user_id=user_id,
+                daily_count=daily_count,
+                total_count=delta,
+                last_reset_date=day,
+            )
+
+
+_quota = None
+
+
+def get_message_quota():
+    """Return the process-wide MessageQuota configured by settings.MESSAGE_QUOTA"""
+    global _quota
+    if _quota is None:
+        config = dict(QUOTA_DEFAULTS)
+        config.update(getattr(settings, 'MESSAGE_QUOTA', {}))
+        store = import_string(config['BACKEND'])(**config['OPTIONS'])
+        _quota = MessageQuota(
+            store,
+            sync_interval=config['SYNC_INTERVAL'],
+            limit_cache_ttl=config['LIMIT_CACHE_TTL'],
+            free_daily_limit=config['FREE_DAILY_LIMIT'],
+        )
+    return _quota
+
+
+@atexit.register
+def _sync_on_exit():
+    if _quota is not None and _quota._pending:
+        try:
+            _quota.sync()
+        except Exception:
+            pass
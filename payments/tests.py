@@ -1,3 +1,93 @@
-from django.test import TestCase
+import asyncio
+import threading
+import time
+from django.test import TestCase, TransactionTestCase
+from django.contrib.auth import get_user_model
+from .models import SubscriptionPlan, UserSubscription, MessageUsage
+from .quota import MessageQuota, InMemoryQuotaStore
 
-# Create your tests here.
+User = get_user_model()
+
+
+class MessageQuotaTestCase(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(email='quota@example.com', password='testpass123')
+        self.quota = MessageQuota(InMemoryQuotaStore(), sync_interval=3600, free_daily_limit=3)
+
+    def test_free_limit_enforced(self):
+        results = [self.quota.consume(self.user) for _ in range(5)]
+        self.assertEqual(results, [True, True, True, False, False])
+
+    def test_warm_counter_needs_no_queries(self):
+        self.quota.consume(self.user)
+        with self.assertNumQueries(0):
+            self.quota.consume(self.user)
+
+    def test_unlimited_plan(self):
+        plan = SubscriptionPlan.objects.create(
+            name='Pro', plan_type='pro', price=1, duration_days=1, message_limit=None
+        )
+        UserSubscription.objects.create(user=self.user, plan=plan)
+        self.assertTrue(all(self.quota.consume(self.user) for _ in range(20)))
+
+    def test_sync_writes_message_usage(self):
+        for _ in range(3):
+            self.quota.consume(self.user)
+        self.quota.sync()
+        usage = MessageUsage.objects.get(user=self.user)
+        self.assertEqual(usage.daily_count, 3)
+        self.assertEqual(usage.total_count, 3)
+
+        self.quota.sync()
+        usage.refresh_from_db()
+        self.assertEqual(usage.total_count, 3)
+
+    def test_refund_frees_the_message(self):
+        results = [self.quota.consume(self.user) for _ in range(3)]
+        self.quota.refund(self.user)
+        self.assertEqual(results + [self.quota.consume(self.user), self.quota.consume(self.user)],
+                         [True, True, True, True, False])
+
+    def test_async_refund_frees_the_message(self):
+        async def scenario():
+            results = [await self.quota.aconsume(self.user) for _ in range(3)]
+            await self.quota.arefund(self.user)
+            return results + [await self.quota.aconsume(self.user), await self.quota.aconsume(self.user)]
+
+        self.assertEqual(asyncio.run(scenario()), [True, True, True, True, False])
+
+    def test_counter_seeded_from_message_usage(self):
+        MessageUsage.objects.create(user=self.user, daily_count=2, total_count=40)
+        self.assertEqual([self.quota.consume(self.user) for _ in range(2)], [True, False])
+
+
+class MessageQuotaConcurrencyTestCase(TransactionTestCase):
+    def test_concurrent_senders_never_exceed_limit(self):
+        user = User.objects.create_user(email='racer@example.com', password='testpass123')
+        quota = MessageQuota(InMemoryQuotaStore(), sync_interval=3600, free_daily_limit=50)
+        quota.consume(user)
+        allowed = []
+
+        def send():
+            for _ in range(20):
+                if quota.consume(user):
+                    allowed.append(1)
+
+        threads = [threading.Thread(target=send) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(allowed), 49)
+
+    def test_usage_is_synced_after_sending_stops(self):
+        user = User.objects.create_user(email='quiet@example.com', password='testpass123')
+        quota = MessageQuota(InMemoryQuotaStore(), sync_interval=0.05, free_daily_limit=5)
+        for _ in range(3):
+            quota.consume(user)
+        quota.refund(user)
+        deadline = time.monotonic() + 5
+        while quota._syncer is not None and time.monotonic() < deadline:
+            time.sleep(0.05)
+        usage = MessageUsage.objects.get(user=user)
+        self.assertEqual((usage.daily_count, usage.total_count), (2, 2))
@@ -16,6 +16,7 @@ from .serializers import (
     PaymentSerializer,
     MessageUsageSerializer
 )
+from .quota import get_message_quota
 
 logger = logging.getLogger(__name__)
 
@@ -38,7 +39,7 @@ class MySubscription(APIView):
         try:
             subscription = UserSubscription.objects.filter(
                 user=request.user
-            ).select_related('plan').first()
+            ).select_related('plan', 'user').first()
             
             if not subscription:
                 return Response({
@@ -49,6 +50,9 @@ class MySubscription(APIView):
                 }, status=status.HTTP_200_OK)
             
             message_usage, _ = MessageUsage.objects.get_or_create(user=request.user)
+            # Reuse the user loaded with the subscription; its reverse cache
+            # holds the subscription that MessageUsage's limit checks read
+            message_usage.user = subscription.user
             
             subscription_data = UserSubscriptionSerializer(subscription).data
             message_usage_data = MessageUsageSerializer(message_usage).data
@@ -199,6 +203,7 @@ def handle_checkout_session_completed(session):
         )
         
         MessageUsage.objects.get_or_create(user=user)
+        get_message_quota().invalidate_limit(user.id)
         
         logger.info(f"Subscription {'created' if created else 'updated'} for user {user.email}")
         